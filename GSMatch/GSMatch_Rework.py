@@ -71,10 +71,10 @@ import traceback
 import itertools
 
 from collections import Counter
-from multiprocessing import Pool
 from itertools import chain, permutations
 
 from GSMatch.GSMatch_Core.Config import GSMConfig
+from GuiV2.GSMatch2_Core import parallel
 from GSMatch.GSMatch_Core.PeakAlignment import get_ms_alignment, get_peak_alignment
 from GSMatch.GSMatch_Core.charts import PlotSpectrum, box_whisker_wrapper, radar_chart_wrapper, mean_peak_area_wrapper, peak_area_wrapper
 from utils.pynist import *
@@ -262,16 +262,13 @@ def qualitative_processing(sample_name, rt_list):
 	
 	report_buffer.sort(key=operator.itemgetter(1))
 	
-	for row in report_buffer:
-		index = report_buffer.index(row)
-		
-		# if index == 19:
-		
-		ms = row[3]
-		
-		create_msp("{}_{}".format(sample_name, row[1]), ms.mass_list, ms.mass_spec)
-		n_hits = 10
-		matches_dict = nist_ms_comparison("{}_{}".format(sample_name, row[1]), ms.mass_list, ms.mass_spec, n_hits)
+	n_hits = 10
+	
+	# Search for all of the peaks at once
+	create_multi_msp(sample_name, [("{}_{}".format(sample_name, row[1]), row[3]) for row in report_buffer])
+	all_matches = nist_ms_batch_comparison(sample_name, len(report_buffer), n_hits)
+	
+	for index, (row, matches_dict) in enumerate(zip(report_buffer, all_matches)):
 		
 		combine_csv.write("{};{};Page {} of 80;;;;;;{}\n".format(row[1], row[4], index + 1, row[2]))
 		
@@ -284,8 +281,6 @@ def qualitative_processing(sample_name, rt_list):
 																												":"),
 															  matches_dict["Hit{}".format(hit)]["CAS"],
 															  ))
-		
-		time.sleep(2)
 	
 	combine_csv.close()
 	
@@ -294,12 +289,38 @@ def qualitative_processing(sample_name, rt_list):
 def create_msp(sample_name, mass_list, mass_spec):
 	"""Generate .MSP files for NIST MS Search"""
 	
-	msp_file = open(os.path.join(MSP_DIRECTORY, sample_name + ".MSP"), "w")
-	msp_file.write("Name: {}\n".format(sample_name))
-	msp_file.write("Num Peaks: {}\n".format(len(mass_list)))
-	for mass, intensity in zip(mass_list, mass_spec):
-		msp_file.write("{} {},\n".format(rounders(mass, "0.0"), intensity))
-	msp_file.close()
+	pynist.write_msp(os.path.join(MSP_DIRECTORY, sample_name + ".MSP"), [(sample_name, mass_list, mass_spec)])
+
+def create_multi_msp(msp_name, spectra):
+	"""Generate a single .MSP file containing several spectra, for NIST MS Search to search at once"""
+	
+	pynist.write_msp(
+			os.path.join(MSP_DIRECTORY, msp_name + ".MSP"),
+			((sample_name, ms.mass_list, ms.mass_spec) for sample_name, ms in spectra),
+			)
+
+def nist_ms_batch_comparison(msp_name, search_len, n_hits=5):
+	"""Search NIST MS Search for all of the spectra in the MSP file created by create_multi_msp"""
+	
+	if not search_len:
+		return []
+	
+	try:
+		pynist.generate_ini(nist_path, "mainlib", n_hits)
+		
+		raw_output = pynist.nist_db_connector(
+				nist_path, os.path.join(MSP_DIRECTORY, "{}.MSP".format(msp_name)), search_len=search_len)
+		
+		all_matches = pynist.parse_results(raw_output, n_hits)
+	
+	except:
+		traceback.print_exc()  # print the error
+		pynist.reload_ini(nist_path)
+		sys.exit(1)
+	
+	print("\r\033[KSearch Complete", end='')
+	pynist.reload_ini(nist_path)
+	return all_matches
 
 def nist_ms_comparison(sample_name, mass_list, mass_spec, n_hits=5):
 	data_dict = {}
@@ -595,8 +616,7 @@ def ms_comparisons(ms_data):
 		similarity_list = []
 		rows_list.append((ms_data.iloc[row_idx], perms))
 	
-	with Pool(len(ms_data)) as p:
-		ms_comparison = p.map(single_ms_comparison, rows_list)
+	ms_comparison = parallel.map(single_ms_comparison, rows_list)
 	
 	# for row_idx in range(len(ms_data)):
 	# similarity_list = []
@@ -781,10 +801,8 @@ def GenerateSpectraFromAlignment(rt_data, ms_data):
 	use_mp = True
 
 	if use_mp:
-		with Pool(len(rt_data)) as p:		
-			args = [(sample, rt_data, ms_data, path) for sample in rt_data.columns.values]
-		
-			p.map(SpectrumImageWrapper, args)
+		args = [(sample, rt_data, ms_data, path) for sample in rt_data.columns.values]
+		parallel.map(SpectrumImageWrapper, args)
 	else:
 		for sample in rt_data.columns.values:
 			GenerateSpectrumImage(sample, rt_data, ms_data, path)
@@ -943,8 +961,7 @@ if __name__ == '__main__':
 
 	if do_quantitative:
 		print("Quantitative Processing in Progress...")
-		with Pool(PL_len) as p:
-			p.map(quantitative_processing, [os.path.join(RAW_DIRECTORY,"{}.JDX".format(prefix)) for prefix in prefixList])
+		parallel.map(quantitative_processing, [os.path.join(RAW_DIRECTORY,"{}.JDX".format(prefix)) for prefix in prefixList])
 		for prefix in prefixList:
 		#	quantitative_processing(os.path.join(RAW_DIRECTORY,"{}.JDX".format(prefix)), False)
 			"""Read and Print Log"""
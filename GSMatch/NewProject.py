@@ -52,7 +52,6 @@ import traceback
 import itertools
 
 from collections import Counter
-from multiprocessing import Pool
 
 # 3rd party
 import numpy
@@ -90,6 +89,7 @@ from chemistry_tools import spectrum_similarity
 from GSMatch.utils.pynist import *
 from GSMatch.utils import DirectoryHash, pynist
 from GSMatch.GSMatch_Core.PeakAlignment import get_ms_alignment, get_peak_alignment
+from GuiV2.GSMatch2_Core import parallel
 
 sys.path.append("..")
 
@@ -331,12 +331,11 @@ class NewProject:
 			
 			if n_quant_workers:
 				# Perform Quantitative Processing in parallel
-				with Pool(n_quant_workers) as p:
-					p.map(
-						self.quantitative_processing, [os.path.join(
-							self.config.raw_dir,
-							"{}.JDX".format(prefix)
-						) for prefix in self.config.prefixList])
+				parallel.map(
+					self.quantitative_processing, [os.path.join(
+						self.config.raw_dir,
+						"{}.JDX".format(prefix)
+					) for prefix in self.config.prefixList])
 					
 			for prefix in self.config.prefixList:
 				if not n_quant_workers:
@@ -747,12 +746,10 @@ Retention Time;Peak Area;;Lib;Match;R Match;Name;CAS Number;Notes
 		:type mass_spec:
 		"""
 		
-		msp_file = open(os.path.join(self.config.msp_dir, sample_name + ".MSP"), "w")
-		msp_file.write("Name: {}\n".format(sample_name))
-		msp_file.write("Num Peaks: {}\n".format(len(mass_list)))
-		for mass, intensity in zip(mass_list, mass_spec):
-			msp_file.write("{} {},\n".format(rounders(mass, "0.0"), intensity))
-		msp_file.close()
+		pynist.write_msp(
+				os.path.join(self.config.msp_dir, sample_name + ".MSP"),
+				[(sample_name, mass_list, mass_spec)],
+				)
 	
 	def nist_ms_comparison(self, sample_name, mass_list, mass_spec, n_hits=5):
 		"""
@@ -1140,8 +1137,7 @@ Retention Time;Peak Area;;Lib;Match;R Match;Name;CAS Number;Notes
 			similarity_list = []
 			rows_list.append((ms_data.iloc[row_idx], perms))
 		
-		with Pool(len(ms_data)) as p:
-			ms_comparison = p.map(single_ms_comparison, rows_list)
+		ms_comparison = parallel.map(single_ms_comparison, rows_list)
 		
 		# TODO: linear mode
 		
@@ -1364,9 +1360,7 @@ in the hits, and the mass spectral similarity between samples.",
 		
 		if len(rt_data) > 20:
 			arguments = [(sample, rt_data, ms_data, path) for sample in rt_data.columns.values]
-			with Pool(len(arguments)) as p:
-				
-				p.map(self.spectrum_image_wrapper, arguments)
+			parallel.map(self.spectrum_image_wrapper, arguments)
 		else:
 			for sample in rt_data.columns.values:
 				self.generate_spectrum_image(sample, rt_data, ms_data, path)
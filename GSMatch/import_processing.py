@@ -246,12 +246,7 @@ def create_msp(sample_name, mass_list, mass_spec):
 	
 	if not os.path.exists("MSP"):
 		os.makedirs("MSP")
-	msp_file = open(os.path.join("MSP",sample_name + ".MSP"),"w")
-	msp_file.write("Name: {}\n".format(sample_name))
-	msp_file.write("Num Peaks: {}\n".format(len(mass_list)))
-	for mass, intensity in zip(mass_list, mass_spec):
-		msp_file.write("{} {},\n".format(rounders(mass,"0.0"),intensity))
-	msp_file.close()
+	pynist.write_msp(os.path.join("MSP",sample_name + ".MSP"), [(sample_name, mass_list, mass_spec)])
 
 def nist_ms_comparison(sample_name, mass_list, mass_spec):
 	data_dict = {}
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  fake_nist.py
+"""
+Stand-in for NIST MS Search, for testing the file-based interface in :mod:`pynist`
+without NIST MS Search installed.
+
+Reads the MSP file named in the locator file, and writes ``SRCRESLT.TXT`` and
+``SRCREADY.TXT`` to the NIST MS Search directory in the same format as NIST MS Search,
+with made-up hits for each spectrum.
+
+Usage::
+
+	python -m GSMatch.utils.fake_nist NIST_DIR [--delay SECONDS]
+
+or from Python::
+
+	pynist.nist_db_connector(
+			nist_dir, msp_file, search_len=n_spectra,
+			command=[sys.executable, "-m", "GSMatch.utils.fake_nist", nist_dir],
+			)
+"""
+#
+#  Copyright 2020 Dominic Davis-Foster <dominic@davis-foster.co.uk>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+
+# stdlib
+import argparse
+import configparser
+import os
+import sys
+import time
+
+# this package
+from GSMatch.utils.pynist import get_locator_path
+
+
+def get_n_hits(nist_dir, default=10):
+	"""
+	Returns the number of hits to print from ``nistms.INI``, as written by :func:`pynist.generate_ini`
+
+	:param nist_dir: The NIST MS Search directory
+	:type nist_dir: str
+	:param default: The number of hits if ``nistms.INI`` does not exist
+	:type default: int, optional
+
+	:rtype: int
+	"""
+
+	config = configparser.ConfigParser(strict=False, interpolation=None)
+	config.read(os.path.join(nist_dir, "nistms.INI"))
+
+	return config.getint("Search Options", "Hits to Print", fallback=default)
+
+
+def get_spectrum_names(msp_file):
+	"""
+	Returns the names of the spectra in the given MSP file
+
+	:param msp_file:
+	:type msp_file: str
+
+	:rtype: list of str
+	"""
+
+	with open(msp_file) as fp:
+		return [line.split(":", 1)[1].strip() for line in fp if line.lower().startswith("name:")]
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog="python -m GSMatch.utils.fake_nist", description=__doc__.split("\n\n")[0])
+	parser.add_argument("nist_dir", help="The NIST MS Search directory.")
+	parser.add_argument("--delay", type=float, default=0.0, help="The time taken to search each spectrum, in seconds.")
+	# Arguments passed to NIST MS Search, e.g. /par=2
+	args, _ = parser.parse_known_args(argv)
+
+	with open(get_locator_path(args.nist_dir)) as fp:
+		msp_file = fp.read().strip()
+
+	names = get_spectrum_names(msp_file)
+	n_hits = get_n_hits(args.nist_dir)
+
+	lines = []
+	for name in names:
+		time.sleep(args.delay)
+
+		lines.append(f"Unknown: {name}  Compound in Library Factor = -100")
+		for hit in range(1, n_hits + 1):
+			lines.append(
+					f"Hit {hit}  : <<Compound {hit}>>; <<C{hit}H{2 * hit + 2}>>; MF: {1000 - hit * 10}; "
+					f"RMF: {1000 - hit * 5}; Prob: {100 / (hit + 1):.2f}; CAS:{hit}-00-0; Mw: {14 * hit + 2}; "
+					f"Lib: <<mainlib>>; Id# {hit}."
+					)
+
+	# Write the results before SRCREADY.TXT, as NIST MS Search does,
+	# renaming them into place so a partially written file is never read
+	results_file = os.path.join(args.nist_dir, "SRCRESLT.TXT")
+	with open(results_file + ".tmp", "w", encoding="latin-1") as fp:
+		fp.write("\n".join(lines) + "\n")
+	os.replace(results_file + ".tmp", results_file)
+
+	ready_file = os.path.join(args.nist_dir, "SRCREADY.TXT")
+	with open(ready_file + ".tmp", "w") as fp:
+		fp.write(f"{len(names)}\n")
+	os.replace(ready_file + ".tmp", ready_file)
+
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -43,18 +43,28 @@ __version__ = 0.25
 __email__ = "dominic@davis-foster.co.uk"
 
 # stdlib
+import csv
 import io
 import os
 import platform
+import re
 import shutil
 import sys
+import threading
 import time
 import traceback
 from subprocess import PIPE, Popen
 
 # 3rd party
+import numpy
 from domdf_python_tools.paths import parent_path
 
+try:
+	from watchdog.observers import Observer
+except ImportError:
+	# Fall back to checking for the results at intervals
+	Observer = None
+
 
 def generate_ini(nist_path, lib_name, num_hits):
 	"""
@@ -1216,9 +1226,12 @@ def close_nist():
 	"""
 	
 	if platform.system() == "Linux":
-		Popen(["wine", "Taskkill", "/IM", "nistms.exe", "/F"], stdout=PIPE, stderr=PIPE)
+		process = Popen(["wine", "Taskkill", "/IM", "nistms.exe", "/F"], stdout=PIPE, stderr=PIPE)
 	else:
-		Popen(["Taskkill", "/IM", "nistms.exe", "/F"], stdout=PIPE, stderr=PIPE)
+		process = Popen(["Taskkill", "/IM", "nistms.exe", "/F"], stdout=PIPE, stderr=PIPE)
+	
+	# Wait for NIST MS Search to be closed before it is started again
+	process.communicate()
 
 
 class nistError(Exception):
@@ -1229,159 +1242,428 @@ class nistError(Exception):
 		return repr(self.parameter)
 
 
-def nist_db_connector(nist_dir, spectrum, search_len=1):
+def format_msp(name, mass_list, intensity_list):
+	"""
+	Format a mass spectrum as an entry in an MSP file
+	
+	The masses are rounded to one decimal place, half up.
+	
+	:param name: The name of the spectrum
+	:type name: str
+	:param mass_list: The m/z values
+	:type mass_list: list or numpy.ndarray
+	:param intensity_list: The intensities
+	:type intensity_list: list or numpy.ndarray
+	
+	:return: The MSP entry, ending with a blank line
+	:rtype: str
+	"""
+	
+	masses = (numpy.floor(numpy.asarray(mass_list, dtype=float) * 10 + 0.5) / 10).tolist()
+	intensities = numpy.asarray(intensity_list).tolist()
+	
+	# Format all of the peaks with a single call
+	peaks = ("%.1f %r,\n" * len(masses)) % tuple(value for peak in zip(masses, intensities) for value in peak)
+	
+	return f"Name: {name}\nNum Peaks: {len(masses)}\n{peaks}\n"
+
+
+class MSPWriter:
 	"""
+	Writes many mass spectra to a single MSP file, so they can be searched in one go.
 	
-	:param nist_dir:
-	:type nist_dir:
-	:param spectrum:
-	:type spectrum:
-	:param search_len:
-	:type search_len:
+	Writes are buffered, so spectra can be streamed to the file one at a time.
+	"""
+	
+	def __init__(self, filename, buffer_size=1048576):
+		"""
+		:param filename: The filename of the MSP file
+		:type filename: str or pathlib.Path
+		:param buffer_size: The size of the write buffer, in bytes
+		:type buffer_size: int, optional
+		"""
+		
+		self.filename = filename
+		self.n_spectra = 0
+		self._fp = open(filename, "w", buffering=buffer_size)
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+	
+	def write(self, name, mass_list, intensity_list):
+		"""
+		Add a mass spectrum to the MSP file
+		
+		:param name: The name of the spectrum
+		:type name: str
+		:param mass_list: The m/z values
+		:type mass_list: list or numpy.ndarray
+		:param intensity_list: The intensities
+		:type intensity_list: list or numpy.ndarray
+		"""
+		
+		self._fp.write(format_msp(name, mass_list, intensity_list))
+		self.n_spectra += 1
+	
+	def close(self):
+		"""
+		Flush the buffer and close the MSP file
+		"""
+		
+		self._fp.close()
+
+
+def write_msp(filename, spectra):
+	"""
+	Write the given mass spectra to a single MSP file
+	
+	:param filename: The filename of the MSP file
+	:type filename: str or pathlib.Path
+	:param spectra: ``(name, mass_list, intensity_list)`` tuples. May be a generator
+	:type spectra: iterable of tuple
+	
+	:return: The number of spectra written
+	:rtype: int
+	"""
+	
+	with MSPWriter(filename) as writer:
+		for name, mass_list, intensity_list in spectra:
+			writer.write(name, mass_list, intensity_list)
+	
+	return writer.n_spectra
+
+
+def read_msp(filename):
+	"""
+	Read the mass spectra from an MSP file, one at a time
+	
+	:param filename: The filename of the MSP file
+	:type filename: str or pathlib.Path
+	
+	:return: ``(name, mass_list, intensity_list)`` for each spectrum, in the order they appear in the file
+	:rtype: generator of tuple
+	"""
+	
+	name = None
+	mass_list = []
+	intensity_list = []
+	
+	with open(filename) as fp:
+		for line in fp:
+			line = line.strip()
+			
+			if not line:
+				continue
+			
+			key, sep, value = line.partition(":")
+			
+			if sep and key.strip().lower() == "name":
+				if name is not None:
+					yield name, mass_list, intensity_list
+				name = value.strip()
+				mass_list = []
+				intensity_list = []
+			
+			elif sep:
+				# e.g. Num Peaks
+				continue
+			
+			else:
+				# One or more "mass intensity" pairs, separated by commas or semicolons
+				for peak in re.split(r"[,;]", line):
+					peak = peak.split()
+					if len(peak) >= 2:
+						mass_list.append(float(peak[0]))
+						intensity_list.append(float(peak[1]))
+	
+	if name is not None:
+		yield name, mass_list, intensity_list
+
+
+def get_locator_path(nist_dir):
+	"""
+	Returns the path of the locator file that tells NIST MS Search which MSP file to import,
+	creating ``AUTOIMP.MSD`` if it does not already exist.
+	
+	:param nist_dir: The NIST MS Search directory
+	:type nist_dir: str
 	
 	:return:
-	:rtype:
+	:rtype: str
+	"""
+	
+	if not os.path.exists(os.path.join(nist_dir, "AUTOIMP.MSD")):
+		if not os.path.isdir("C:/SEARCH/"):
+			os.makedirs("C:/SEARCH/")
+		with open(os.path.join(nist_dir, "AUTOIMP.MSD"), "w") as f:
+			f.write("C:/SEARCH/SEARCH.MSD")
+	
+	with open(os.path.join(nist_dir, "AUTOIMP.MSD"), "r") as fp:
+		locator_path = fp.read()
+	
+	if platform.system() == "Linux":
+		import getpass
+		with open(os.path.join(nist_dir, "AUTOIMP.MSD"), "w") as f:
+			f.write("C:/SEARCH/SEARCH.MSD")
+		locator_path = "/home/{}/.wine/drive_c/SEARCH/SEARCH.MSD".format(getpass.getuser())
+	
+	return locator_path.lstrip(' ')
+
+
+class _ChangeHandler:
+	"""
+	Event handler for :class:`watchdog.observers.Observer` that sets a :class:`threading.Event`
+	whenever anything in the watched directory changes.
+	"""
+	
+	def __init__(self, changed):
+		self.changed = changed
+	
+	def dispatch(self, event):
+		self.changed.set()
+
+
+class ResultWatcher:
 	"""
+	Waits for NIST MS Search to write ``SRCREADY.TXT`` and ``SRCRESLT.TXT``.
 	
-	attempts = 101
-	while True:  # attempts > 100:
-		attempts = 0
-		# if type(spectrum) == dict
-		# still needs to be coded to convert from dictionary or list to MSP
-		spectrum_file = os.path.basename(spectrum)
-		file_extension = os.path.splitext(spectrum)[-1]
-		# still needs coding to convert from xy to msp.
-		# if file_extension.lower() == ".msp":
+	If the `watchdog <https://pypi.org/project/watchdog/>`_ package is installed the watcher
+	is woken as soon as anything in the NIST MS Search directory changes.
+	The files are also checked at intervals, starting at ``min_interval`` and doubling up to
+	``max_interval`` while nothing changes, in case watchdog is not installed or an event is missed.
+	"""
+	
+	def __init__(self, nist_dir, min_interval=0.01, max_interval=0.5):
+		"""
+		:param nist_dir: The NIST MS Search directory
+		:type nist_dir: str
+		:param min_interval: The initial interval between checks, in seconds
+		:type min_interval: float, optional
+		:param max_interval: The maximum interval between checks, in seconds
+		:type max_interval: float, optional
+		"""
 		
-		spectrum_name = os.path.splitext(spectrum_file)[0]
+		self.nist_dir = nist_dir
+		self.ready_file = os.path.join(nist_dir, "SRCREADY.TXT")
+		self.results_file = os.path.join(nist_dir, "SRCRESLT.TXT")
+		self.min_interval = min_interval
+		self.max_interval = max_interval
 		
-		if not os.path.exists(os.path.join(nist_dir, "AUTOIMP.MSD")):
-			if not os.path.isdir("C:/SEARCH/"):
-				os.makedirs("C:/SEARCH/")
-			with open(os.path.join(nist_dir, "AUTOIMP.MSD"), "w") as f:
-				f.write("C:/SEARCH/SEARCH.MSD")
+		self._changed = threading.Event()
+		self._observer = None
+	
+	def __enter__(self):
+		self.start()
+		return self
+	
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.stop()
+	
+	def start(self):
+		"""
+		Start watching the NIST MS Search directory for changes, if watchdog is installed
+		"""
 		
-		# locator_path = open(os.path.join(nist_dir,"AUTOIMP.MSD"),"r").read()
-		with open(os.path.join(nist_dir, "AUTOIMP.MSD"), "r") as fp:
-			locator_path = fp.read()
+		if Observer is not None and self._observer is None:
+			self._observer = Observer()
+			self._observer.schedule(_ChangeHandler(self._changed), self.nist_dir, recursive=False)
+			self._observer.start()
+	
+	def stop(self):
+		"""
+		Stop watching the NIST MS Search directory for changes
+		"""
 		
-		if platform.system() == "Linux":
-			import getpass
-			with open(os.path.join(nist_dir, "AUTOIMP.MSD"), "w") as f:
-				f.write("C:/SEARCH/SEARCH.MSD")
-			locator_path = "/home/{}/.wine/drive_c/SEARCH/SEARCH.MSD".format(getpass.getuser())
+		if self._observer is not None:
+			self._observer.stop()
+			self._observer.join()
+			self._observer = None
+	
+	def clear(self):
+		"""
+		Remove ``SRCREADY.TXT`` and ``SRCRESLT.TXT`` left over from a previous search
+		"""
 		
-		while locator_path[0] == ' ':
-			locator_path = locator_path[1:]
+		for filename in (self.ready_file, self.results_file):
+			try:
+				os.unlink(filename)
+			except FileNotFoundError:
+				pass
+	
+	def searches_done(self):
+		"""
+		Returns the number of searches NIST MS Search has completed,
+		or ``None`` if ``SRCREADY.TXT`` has not been written yet.
 		
-		if not os.path.exists(parent_path(locator_path)):
-			os.makedirs(parent_path(locator_path))
+		:rtype: int or None
+		"""
 		
-		shutil.copyfile(spectrum, os.path.join(parent_path(locator_path), spectrum_file))
+		try:
+			with open(self.ready_file) as fp:
+				return int(fp.readline().strip())
+		except (OSError, ValueError):
+			# Not written yet, or only partially written
+			return None
+	
+	def wait(self, search_len=1, timeout=300):
+		"""
+		Wait until NIST MS Search has completed ``search_len`` searches and written the results
 		
-		with open(locator_path, "w") as f:
-			f.write(os.path.join(parent_path(locator_path), spectrum_file))
+		:param search_len: The number of spectra being searched
+		:type search_len: int, optional
+		:param timeout: The maximum time to wait, in seconds
+		:type timeout: float, optional
 		
-		if os.path.exists(os.path.join(nist_dir, "SRCREADY.TXT")):
-			os.unlink(os.path.join(nist_dir, "SRCREADY.TXT"))
-		if os.path.exists(os.path.join(nist_dir, "SRCRESLT.TXT")):
-			os.unlink(os.path.join(nist_dir, "SRCRESLT.TXT"))
+		:raises: :class:`TimeoutError` if the searches have not completed within ``timeout`` seconds
+		"""
 		
+		deadline = time.monotonic() + timeout
+		interval = self.min_interval
+		last_done = -1
+		
+		while True:
+			self._changed.clear()
+			
+			searches_done = self.searches_done()
+			if searches_done is not None and searches_done >= search_len and os.path.isfile(self.results_file):
+				print("\r\033[K", end='')  # clear line
+				return
+			
+			if searches_done != last_done:
+				print(f"\rWaiting for searches to finish. Currently {searches_done or 0}/{search_len} done.\r", end='')
+				last_done = searches_done
+			
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				raise TimeoutError(f"NIST MS Search did not finish {search_len} searches within {timeout} seconds")
+			
+			if self._changed.wait(min(interval, remaining)):
+				# Something changed, so check again promptly next time
+				interval = self.min_interval
+			else:
+				interval = min(interval * 2, self.max_interval)
+
+
+def nist_db_connector(nist_dir, spectrum, search_len=1, timeout=300, max_attempts=3, command=None):
+	"""
+	Search NIST MS Search for the spectra in the given MSP file
+	
+	:param nist_dir: The NIST MS Search directory
+	:type nist_dir: str
+	:param spectrum: The MSP file to search. It may contain several spectra
+	:type spectrum: str
+	:param search_len: The number of spectra in the MSP file
+	:type search_len: int, optional
+	:param timeout: The maximum time to wait for each attempt, in seconds
+	:type timeout: float, optional
+	:param max_attempts: The number of times to start NIST MS Search before giving up
+	:type max_attempts: int, optional
+	:param command: The command to start NIST MS Search. Defaults to ``nistms$.exe /par=2``
+		in ``nist_dir``, run with wine on Linux. Can be used to start a stand-in for testing,
+		such as ``[sys.executable, "-m", "GSMatch.utils.fake_nist", nist_dir]``
+	:type command: list of str, optional
+	
+	:return: The contents of ``SRCRESLT.TXT``
+	:rtype: str
+	"""
+	
+	# if type(spectrum) == dict
+	# still needs to be coded to convert from dictionary or list to MSP
+	spectrum_file = os.path.basename(spectrum)
+	# still needs coding to convert from xy to msp.
+	# if file_extension.lower() == ".msp":
+	
+	locator_path = get_locator_path(nist_dir)
+	
+	if not os.path.exists(parent_path(locator_path)):
+		os.makedirs(parent_path(locator_path))
+	
+	shutil.copyfile(spectrum, os.path.join(parent_path(locator_path), spectrum_file))
+	
+	with open(locator_path, "w") as f:
+		f.write(os.path.join(parent_path(locator_path), spectrum_file))
+	
+	if command is None:
 		if not os.path.exists(os.path.join(nist_dir, "nistms$.exe")):
 			raise FileNotFoundError(f"NIST MS Search executable not found. Looking in {nist_dir}")
 		if platform.system() == "Linux":
-			Popen(["wine", os.path.join(nist_dir, "nistms$.exe"), "/par=2"], stdout=PIPE, stderr=PIPE)
+			command = ["wine", os.path.join(nist_dir, "nistms$.exe"), "/par=2"]
 		else:
-			Popen([os.path.join(nist_dir, "nistms$.exe"), "/par=2"], stdout=PIPE, stderr=PIPE)
-		
-		# while not os.path.exists(os.path.join(nist_dir,"SRCRESLT.TXT")):
-		# 	time.sleep(0.1)
-		# 	attempts += 1
-		# 	if attempts > 100:
-		# 		close_nist()
-		# 		#if platform.system() == "Linux":
-		# 		#	Popen(["wine","Taskkill", "/IM", "nistms.exe", "/F"],stdout=PIPE, stderr=STDOUT)
-		# 		#else:
-		# 		#	Popen(["Taskkill", "/IM", "nistms.exe", "/F"],stdout=PIPE, stderr=STDOUT)
-		#
-		# 		#raise nistError
-		
-		time.sleep(2 + (0.2 * search_len))
-		
-		# sys.stdout.write("\033[F") #back to previous line
-		# From https://www.quora.com/How-can-I-delete-the-last-printed-line-in-Python-language
-		# sys.stdout.write("\r\033[K")  # clear line
-		print("\r\033[K", end='')  # clear line
-		while not os.path.isfile(os.path.join(nist_dir, "SRCREADY.TXT")):
-			# print(attempts)
-			time.sleep(0.2)
-			# sys.stdout.write("\rWaiting for SRCREADY.TXT. Attempt {}".format(attempts))
-			print("\rWaiting for SRCREADY.TXT. Attempt {}\r".format(attempts), end='')
-			attempts += 1
-			if attempts > 300:
-				print("\rclosing nist line {}\r".format(sys._getframe().f_lineno), end='')
+			command = [os.path.join(nist_dir, "nistms$.exe"), "/par=2"]
+	
+	with ResultWatcher(nist_dir) as watcher:
+		for attempt in range(max_attempts):
+			watcher.clear()
+			
+			Popen(command, stdout=PIPE, stderr=PIPE)
+			
+			try:
+				watcher.wait(search_len, timeout)
+			except TimeoutError as e:
+				print(f"\r{e}; closing NIST MS Search")
 				close_nist()
-				search_results = ''
 				continue
-		
-		searches_done = 0
-		while searches_done != str(search_len):
-			ready_file = open(os.path.join(nist_dir, "SRCREADY.TXT"))
-			searches_done = ready_file.readlines()[0].rstrip("\r\n").replace("\n", "").replace("\r", "")
-			# print(searches_done)
-			ready_file.close()
-			# sys.stdout.write(
-			# 		"\rWaiting for searches to finish. Currently {}/{} done. Attempt {}".format(
-			# 				int(searches_done), int(search_len), int(attempts)
-			# 				)
-			# 		)
-			print(
-					f"\r\rWaiting for searches to finish. Currently {int(searches_done)}/{int(search_len)} done. "
-					f"Attempt {int(attempts)}\r", end=''),
-			time.sleep(0.5)
-			attempts += 1
-			if attempts > 300:
-				print("\rclosing nist line {}\r".format(sys._getframe().f_lineno), end='')
+			
+			with io.open(watcher.results_file, "rt", encoding="latin-1") as fp:
+				search_results = fp.read()
+			
+			try:
+				watcher.clear()
+			except OSError:
+				pass
+			
+			if len(search_results) == 0:
+				print("\rNo results from NIST MS Search; closing NIST MS Search")
 				close_nist()
-				continue
+			else:
+				return search_results
+	
+	raise nistError(f"NIST MS Search did not return results after {max_attempts} attempts")
+
+
+def parse_results(search_results, n_hits):
+	"""
+	Parse the contents of ``SRCRESLT.TXT``
+	
+	:param search_results: The contents of ``SRCRESLT.TXT``, from :func:`nist_db_connector`
+	:type search_results: str
+	:param n_hits: The maximum number of hits to parse for each spectrum
+	:type n_hits: int
+	
+	:return: A dictionary of hits for each spectrum, in the order the spectra were searched.
+		The hits are keyed ``Hit1``, ``Hit2`` etc. and each contain
+		the ``Name``, ``MF``, ``RMF``, ``CAS`` and ``Lib`` of the hit.
+	:rtype: list of dict
+	"""
+	
+	results = []
+	
+	# Each spectrum starts with a line "Unknown: <name>", followed by one line per hit
+	for block in re.split(r"^Unknown:", search_results, flags=re.MULTILINE)[1:]:
+		matches_dict = {}
 		
-		while not os.path.exists(os.path.join(nist_dir, "SRCRESLT.TXT")):
-			time.sleep(0.2)
-			print("\rWaiting for SRCRESLT.TXT, Attempt {}\r".format(attempts), end='')
-			attempts += 1
-			if attempts > 300:
-				print(f"\rclosing nist line {sys._getframe().f_lineno}\r", end='')
-				close_nist()
+		for line in block.splitlines()[1:n_hits + 1]:
+			line = re.sub(r"^Hit (\d+)\s*:\s", r"Hit\1;", line)
+			line = line.replace("<<", '"').replace(">>", '"')
+			row = list(csv.reader([line], delimiter=";", quotechar='"'))[0]
+			
+			if not row[0].startswith("Hit") or len(row) < 9:
 				continue
+			
+			matches_dict[row[0]] = {
+					"Name": row[1],
+					"MF": (row[3].replace("MF:", '').replace(" ", '')),
+					"RMF": (row[4].replace("RMF:", '').replace(" ", '')),
+					"CAS": (row[6].replace("CAS:", '').replace(" ", '')),
+					"Lib": (row[8].replace("Lib:", '').replace(" ", '').replace('"', '')),
+					}
 		
-		# search_results = open(os.path.join(nist_dir,"SRCRESLT.TXT"),"rt",encoding="latin-1").read() #
-		# search_results = io.open(os.path.join(nist_dir,"SRCRESLT.TXT"),"rt",encoding="latin-1").read() #
-		with io.open(os.path.join(nist_dir, "SRCRESLT.TXT"), "rt", encoding="latin-1") as fp:
-			search_results = fp.read()
-		
-		try:
-			os.unlink(os.path.join(nist_dir, "SRCRESLT.TXT"))
-			os.unlink(os.path.join(nist_dir, "SRCREADY.TXT"))
-		except:
-			pass
-		
-		if len(search_results) == 0:
-			print(f"\rclosing nist line {sys._getframe().f_lineno}\r", end='')
-			close_nist()
-			time.sleep(0.5)
-		else:
-			time.sleep(0.5)
-			break
-	
-	time.sleep(0.5)
-	
-	# try:
-	# 	os.unlink(os.path.join(nist_dir,"SRCRESLT.TXT"))
-	# except:
-	# 	time.sleep(2)
-	# 	os.unlink(os.path.join(nist_dir,"SRCRESLT.TXT"))
+		results.append(matches_dict)
 	
-	return search_results
+	return results
 
 #
 # def nist_cleanup(nist_path):
@@ -138,6 +138,13 @@ class InternalConfig:
 				"paths", "logdir",
 				fallback=(homedir / "Documents" / "GunShotMatch" / "Logs")
 				)).absolute()
+		self.expr_cache_dir = pathlib.Path(self.Config.get(
+				"paths", "ExprCachePath",
+				fallback=(pathlib.Path(appdirs.user_cache_dir("GunShotMatch")) / "Experiments")
+				)).absolute()
+		self.local_library_path = self.Config.get(
+				"paths", "LocalLibraryPath",
+				fallback='')
 		
 		# Recent Projects
 		for i in range(9, -1, -1):
@@ -180,6 +187,21 @@ class InternalConfig:
 		self.last_position = tuple(int(x) for x in self.Config.get(
 				"main", "last_position",
 				fallback="-1, -1").split(","))
+		self.n_workers = self.Config.getint(
+				"main", "n_workers",
+				fallback=0)
+		self.parallel_threshold = self.Config.getint(
+				"main", "parallel_threshold",
+				fallback=4)
+		self.expr_cache_size = self.Config.getint(
+				"main", "expr_cache_size",
+				fallback=4096)
+		self.search_cache_size = self.Config.getint(
+				"main", "search_cache_size",
+				fallback=256)
+		self.search_backend = self.Config.get(
+				"main", "search_backend",
+				fallback="nist")
 		
 		# Charts
 		self.chart_styles = self.Config.get(
@@ -650,6 +672,179 @@ class InternalConfig:
 	def last_size(self, value):
 		self._last_size = value
 	
+	@property
+	def n_workers(self):
+		"""
+		Returns the maximum number of processes to use for parallel processing.
+		If 0 the number of CPUs will be used.
+
+		:rtype: int
+		"""
+		
+		return self._n_workers
+	
+	@n_workers.setter
+	def n_workers(self, value):
+		"""
+		Sets the maximum number of processes to use for parallel processing.
+		If 0 the number of CPUs will be used.
+
+		:type value: int
+		"""
+		
+		self._n_workers = max(0, int(value))
+	
+	@property
+	def parallel_threshold(self):
+		"""
+		Returns the minimum number of items for processing to be performed in parallel.
+		Fewer items are processed one at a time, as starting the worker processes would take longer.
+
+		:rtype: int
+		"""
+		
+		return self._parallel_threshold
+	
+	@parallel_threshold.setter
+	def parallel_threshold(self, value):
+		"""
+		Sets the minimum number of items for processing to be performed in parallel.
+		Fewer items are processed one at a time, as starting the worker processes would take longer.
+
+		:type value: int
+		"""
+		
+		self._parallel_threshold = max(0, int(value))
+	
+	@property
+	def expr_cache_dir(self):
+		"""
+		Returns the directory where processed Experiment data will be cached
+
+		:rtype: str
+		"""
+		
+		return str(self._expr_cache_dir)
+	
+	@expr_cache_dir.setter
+	def expr_cache_dir(self, value):
+		"""
+		Sets the directory where processed Experiment data will be cached.
+		The directory will be created if it does not already exist.
+
+		:type value: str or pathlib.Path
+		"""
+		
+		if value:
+			if not isinstance(value, pathlib.Path):
+				value = pathlib.Path(value)
+			
+			self._expr_cache_dir = value
+			self._expr_cache_dir.mkdir(parents=True, exist_ok=True)
+	
+	@property
+	def expr_cache_size(self):
+		"""
+		Returns the maximum size of the processed Experiment cache, in megabytes.
+		If 0 the cache is disabled.
+
+		:rtype: int
+		"""
+		
+		return self._expr_cache_size
+	
+	@expr_cache_size.setter
+	def expr_cache_size(self, value):
+		"""
+		Sets the maximum size of the processed Experiment cache, in megabytes.
+		If 0 the cache is disabled.
+
+		:type value: int
+		"""
+		
+		self._expr_cache_size = max(0, int(value))
+	
+	@property
+	def search_cache_file(self):
+		"""
+		Returns the path of the database in which NIST MS Search results are cached
+
+		:rtype: str
+		"""
+		
+		return str(self._configfile.parent / "search_cache.sqlite")
+	
+	@property
+	def search_cache_size(self):
+		"""
+		Returns the maximum size of the NIST MS Search result cache, in megabytes.
+		If 0 the cache is disabled.
+
+		:rtype: int
+		"""
+		
+		return self._search_cache_size
+	
+	@search_cache_size.setter
+	def search_cache_size(self, value):
+		"""
+		Sets the maximum size of the NIST MS Search result cache, in megabytes.
+		If 0 the cache is disabled.
+
+		:type value: int
+		"""
+		
+		self._search_cache_size = max(0, int(value))
+	
+	@property
+	def search_backend(self):
+		"""
+		Returns the backend used for Compound Identification.
+		Either ``'nist'`` for NIST MS Search, or ``'local'`` for the
+		spectral library given by :attr:`local_library_path`.
+
+		:rtype: str
+		"""
+		
+		return self._search_backend
+	
+	@search_backend.setter
+	def search_backend(self, value):
+		"""
+		Sets the backend used for Compound Identification.
+		Either ``'nist'`` for NIST MS Search, or ``'local'`` for the
+		spectral library given by :attr:`local_library_path`.
+
+		:type value: str
+		"""
+		
+		value = str(value).strip().lower()
+		
+		if value not in {"nist", "local"}:
+			raise ValueError(f"Unknown search backend '{value}'")
+		
+		self._search_backend = value
+	
+	@property
+	def local_library_path(self):
+		"""
+		Returns the path of the MSP or JCAMP-DX spectral library searched by the local search backend
+
+		:rtype: str
+		"""
+		
+		return str(self._local_library_path)
+	
+	@local_library_path.setter
+	def local_library_path(self, value):
+		"""
+		Sets the path of the MSP or JCAMP-DX spectral library searched by the local search backend
+
+		:type value: str or pathlib.Path
+		"""
+		
+		self._local_library_path = value
+	
 	def save_config(self):
 		"""
 		Saves the configuration
@@ -667,6 +862,8 @@ class InternalConfig:
 		self.Config.set("paths", "msppath", process_path(self.msp_dir))
 		self.Config.set("paths", "resultspath", process_path(self.results_dir))
 		self.Config.set("paths", "logdir", process_path(self.log_dir))
+		self.Config.set("paths", "exprcachepath", process_path(self.expr_cache_dir))
+		self.Config.set("paths", "locallibrarypath", self.local_library_path.replace("\\", "/"))
 		
 		# Recent projects
 		for i in range(9, -1, -1):
@@ -688,6 +885,11 @@ class InternalConfig:
 		self.Config.set("main", "last_maximized", str(self.last_maximized))
 		self.Config.set("main", "last_size", ",".join([str(x) for x in self.last_size]))
 		self.Config.set("main", "last_position", ",".join([str(x) for x in self.last_position]))
+		self.Config.set("main", "n_workers", str(self.n_workers))
+		self.Config.set("main", "parallel_threshold", str(self.parallel_threshold))
+		self.Config.set("main", "expr_cache_size", str(self.expr_cache_size))
+		self.Config.set("main", "search_cache_size", str(self.search_cache_size))
+		self.Config.set("main", "search_backend", self.search_backend)
 		
 		# Charts
 		self.Config.set("charts", "styles", ",".join(self.chart_styles))
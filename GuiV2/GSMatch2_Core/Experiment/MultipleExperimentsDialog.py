@@ -40,6 +40,7 @@ from domdf_wxpython_tools.picker import file_picker
 # this package
 from GuiV2.GSMatch2_Core import Experiment, Method, SorterPanels
 from GuiV2.GSMatch2_Core.Config import internal_config
+from GuiV2.GSMatch2_Core.Experiment.batch import create_experiments
 from GuiV2.GSMatch2_Core.Experiment.DatafilePanel import DatafilePanel
 from GuiV2.GSMatch2_Core.Experiment.PropertiesPanel import PropertiesPanel
 from GuiV2.GSMatch2_Core.GUI.prog_dialog_indeterminate import AnimatedProgDialog
@@ -312,6 +313,14 @@ class MultipleExperimentsDialog(wx.Dialog, Method.MethodPickerMixin):
 				experiment.original_filetype = ID
 				return
 	
+	def update_prog_dialog(self, n_done, n_total, result):
+		"""
+		Update the progress dialog after each Experiment has been created
+		"""
+		
+		if hasattr(self, "prog_dialog"):
+			wx.CallAfter(self.prog_dialog.SetTitle, f"Created {n_done} of {n_total} Experiments...")
+	
 	def destroy_prog_dialog(self):
 		if hasattr(self, "prog_dialog"):
 			wx.CallAfter(self.prog_dialog.Destroy)
@@ -367,24 +376,35 @@ Do you want to replace it?""",
 		
 		# MultipleExperimentsProgressDialog(self, experiments_to_process)
 			
-		# Create progressbar and create experiment
-		thread = MultipleExperimentsThread(self, experiments_to_process)
+		# Create progressbar and create experiments
+		thread = MultipleExperimentsThread(self, experiments_to_process, n_workers=internal_config.n_workers or None)
 		thread.start()
-		# TODO: Give progress update to say which experiment is being created
 		self.prog_dialog = AnimatedProgDialog("Experiment Creation In Progress...", self)
 		self.prog_dialog.ShowModal()
 		
 		# ExperimentProgressDialog(self, self.experiment, self.datafile.expr_picker.GetValue(), selected_button)
 		
-		for experiment in experiments_to_process:
-			experiment.store()
+		failed = [result for result in thread.results if not result]
+		
+		if failed:
+			error_string = "The following Experiments could not be created:"
+			
+			for result in failed:
+				error_string += f"\n{result.name} ({result.original_filename}): {result.error}"
+				print(result.traceback)
 			
-		print("Experiments Created")
-		with wx.MessageDialog(
-				self,
-				"Experiments Created Successfully.",
-				"Experiments Created") as dlg:
-			dlg.ShowModal()
+			with wx.MessageDialog(
+					self, error_string, "Experiment Creation Failed",
+					style=wx.OK | wx.CENTRE | wx.ICON_ERROR) as dlg:
+				dlg.ShowModal()
+		
+		else:
+			print("Experiments Created")
+			with wx.MessageDialog(
+					self,
+					"Experiments Created Successfully.",
+					"Experiments Created") as dlg:
+				dlg.ShowModal()
 		
 		if self.IsModal():
 			wx.CallAfter(self.EndModal, wx.ID_OK)
@@ -464,11 +484,22 @@ class MultipleExperimentsThread(threading.Thread):
 	Thread for creating multiple Experiments
 	"""
 	
-	def __init__(self, parent, experiment_list):
+	def __init__(self, parent, experiment_list, n_workers=None):
+		"""
+		:param parent:
+		:type parent: MultipleExperimentsDialog
+		:param experiment_list: A list of :class:`Experiment` objects to create and store
+		:type experiment_list: list
+		:param n_workers: The maximum number of processes to use. Defaults to the number of CPUs.
+		:type n_workers: int, optional
+		"""
+		
 		threading.Thread.__init__(self)
 		
 		self.parent = parent
 		self.experiment_list = experiment_list
+		self.n_workers = n_workers
+		self.results = []
 	
 	def run(self):
 		"""
@@ -476,9 +507,11 @@ class MultipleExperimentsThread(threading.Thread):
 		"""
 		print("Experiment Creation in Progress...")
 		
-		for experiment in self.experiment_list:
-			# TODO: perform creation in parallel
-			experiment.run(experiment.original_filename, experiment.original_filetype)
+		self.results = create_experiments(
+				self.experiment_list,
+				n_workers=self.n_workers,
+				progress_callback=self.parent.update_prog_dialog,
+				)
 		self.parent.destroy_prog_dialog()
 
 
@@ -23,6 +23,7 @@
 #  MA 02110-1301, USA.
 #
 
+from GuiV2.GSMatch2_Core.Experiment.batch import BatchResult, create_experiment, create_experiments
 from GuiV2.GSMatch2_Core.Experiment.ChromatogramPanel import ChromatogramPanel
 from GuiV2.GSMatch2_Core.Experiment.DatafilePanel import DatafilePanel
 from GuiV2.GSMatch2_Core.Experiment.experiment import (Experiment, load, new, new_empty)
@@ -41,6 +42,9 @@ from GuiV2.GSMatch2_Core.Experiment.spectrum_panel import SpectrumPanel
 
 
 __all__ = [
+		"BatchResult",
+		"create_experiment",
+		"create_experiments",
 		"ChromatogramPanel",
 		"DatafilePanel",
 		"Experiment",
@@ -0,0 +1,173 @@
+#  !/usr/bin/env python
+#   -*- coding: utf-8 -*-
+#
+#  batch.py
+#
+#  This file is part of GunShotMatch
+#
+#  Copyright © 2020 Dominic Davis-Foster <dominic@davis-foster.co.uk>
+#
+#  GunShotMatch is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  GunShotMatch is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+
+# stdlib
+import os
+import traceback
+from concurrent.futures import as_completed, ProcessPoolExecutor
+
+
+class BatchResult:
+	"""
+	The outcome of creating a single Experiment as part of a batch
+	"""
+
+	def __init__(self, name, filename, original_filename, success, error=None, traceback=None):
+		"""
+		:param name: The name of the Experiment
+		:type name: str
+		:param filename: The filename the Experiment was to be saved as
+		:type filename: str
+		:param original_filename: The filename of the datafile the Experiment was created from
+		:type original_filename: str
+		:param success: Whether the Experiment was created and saved successfully
+		:type success: bool
+		:param error: If creation failed, a description of the error
+		:type error: str, optional
+		:param traceback: If creation failed, the formatted traceback of the error
+		:type traceback: str, optional
+		"""
+
+		self.name = name
+		self.filename = filename
+		self.original_filename = original_filename
+		self.success = bool(success)
+		self.error = error
+		self.traceback = traceback
+
+	def __bool__(self):
+		return self.success
+
+	def __repr__(self):
+		if self.success:
+			return f"BatchResult({self.name}: Success)"
+		else:
+			return f"BatchResult({self.name}: Failed - {self.error})"
+
+	def __str__(self):
+		return self.__repr__()
+
+
+def create_experiment(experiment):
+	"""
+	Run and store a single Experiment. Any error is captured in the returned
+	:class:`BatchResult` rather than being raised, so that a single bad
+	datafile does not stop the rest of the batch.
+
+	The ``original_filename`` and ``original_filetype`` attributes
+	must have already been set for the Experiment.
+
+	:param experiment: The Experiment to create
+	:type experiment: GuiV2.GSMatch2_Core.Experiment.Experiment
+
+	:rtype: BatchResult
+	"""
+
+	name = str(experiment.name)
+	filename = str(experiment.filename)
+	original_filename = str(experiment.original_filename)
+
+	try:
+		experiment.run(experiment.original_filename, experiment.original_filetype)
+		experiment.store()
+	except Exception as e:
+		return BatchResult(
+				name, filename, original_filename, False,
+				error=f"{type(e).__name__}: {e}",
+				traceback=traceback.format_exc(),
+				)
+
+	return BatchResult(name, filename, original_filename, True)
+
+
+def create_experiments(experiment_list, n_workers=None, progress_callback=None):
+	"""
+	Create and store multiple Experiments, spreading the work over a pool of processes.
+
+	The ``original_filename`` and ``original_filetype`` attributes
+	must have already been set for each Experiment.
+
+	:param experiment_list: The Experiments to create
+	:type experiment_list: list of :class:`GuiV2.GSMatch2_Core.Experiment.Experiment`
+	:param n_workers: The maximum number of processes to use.
+		Defaults to the number of CPUs. If 1 the Experiments are created sequentially in this process.
+	:type n_workers: int, optional
+	:param progress_callback: Function to call after each Experiment has been created.
+		Called with the number of Experiments completed, the total number
+		of Experiments, and the :class:`BatchResult` for the Experiment.
+	:type progress_callback: callable, optional
+
+	:return: The outcome for each Experiment, in the same order as ``experiment_list``
+	:rtype: list of BatchResult
+	"""
+
+	experiment_list = list(experiment_list)
+	n_experiments = len(experiment_list)
+
+	if not n_experiments:
+		return []
+
+	if n_workers is None:
+		n_workers = os.cpu_count() or 1
+
+	n_workers = max(1, min(int(n_workers), n_experiments))
+
+	results = [None] * n_experiments
+
+	def report(n_done, result):
+		print(f"Created {n_done} of {n_experiments} Experiments ({result})")
+		if progress_callback:
+			progress_callback(n_done, n_experiments, result)
+
+	if n_workers == 1:
+		for n_done, (idx, experiment) in enumerate(enumerate(experiment_list), start=1):
+			results[idx] = create_experiment(experiment)
+			report(n_done, results[idx])
+
+		return results
+
+	with ProcessPoolExecutor(max_workers=n_workers) as executor:
+		futures = {
+				executor.submit(create_experiment, experiment): idx
+				for idx, experiment in enumerate(experiment_list)
+				}
+
+		for n_done, future in enumerate(as_completed(futures), start=1):
+			idx = futures[future]
+			experiment = experiment_list[idx]
+
+			try:
+				results[idx] = future.result()
+			except Exception as e:
+				# The worker process itself failed, e.g. the Experiment could not be pickled
+				results[idx] = BatchResult(
+						str(experiment.name), str(experiment.filename), str(experiment.original_filename), False,
+						error=f"{type(e).__name__}: {e}",
+						traceback=traceback.format_exc(),
+						)
+
+			report(n_done, results[idx])
+
+	return results
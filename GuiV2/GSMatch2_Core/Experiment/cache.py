@@ -0,0 +1,429 @@
+#  !/usr/bin/env python
+#   -*- coding: utf-8 -*-
+#
+#  cache.py
+#
+#  This file is part of GunShotMatch
+#
+#  Copyright © 2020 Dominic Davis-Foster <dominic@davis-foster.co.uk>
+#
+#  GunShotMatch is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  GunShotMatch is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  On-disk cache of processed Experiment data.
+#
+#  Each entry is an uncompressed tarfile named after a hash of the raw datafile
+#  and the settings in the ``expr_creation`` section of the Method, containing:
+#
+#  * The raw data and intensity matrix, in the same columnar format as Experiment files
+#  * ``tic.dat``: The pickled Total Ion Chromatogram
+#  * ``peaks.dat``: The pickled peak list, after filtering and with peak areas
+#
+#  Entries are evicted in least recently used order once the total size
+#  of the cache exceeds the limit set in the internal configuration.
+#
+#  The cache can be inspected and purged from the command line with
+#  ``python -m GuiV2.GSMatch2_Core.Experiment.cache``
+#
+
+# stdlib
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import pickle
+import sys
+import tarfile
+import tempfile
+
+# this package
+from GuiV2.GSMatch2_Core.Config import internal_config
+from GuiV2.GSMatch2_Core.Experiment import payload
+from GuiV2.GSMatch2_Core.io import add_bytes_to_archive, close_archive, open_archive
+
+
+# Increment when the processing in Experiment.run changes, to invalidate existing entries
+CACHE_VERSION = 2
+
+
+def hash_datafile(filename, chunk_size=1048576):
+	"""
+	Returns the SHA-1 hash of the given datafile.
+
+	If ``filename`` is a directory, the hash covers every file within it.
+
+	:param filename:
+	:type filename: str or pathlib.Path
+	:param chunk_size: The number of bytes to read at once
+	:type chunk_size: int, optional
+
+	:rtype: str
+	"""
+
+	filename = pathlib.Path(filename)
+	sha1 = hashlib.sha1()
+
+	if filename.is_dir():
+		file_list = sorted(path for path in filename.rglob("*") if path.is_file())
+	else:
+		file_list = [filename]
+
+	for path in file_list:
+		if filename.is_dir():
+			sha1.update(path.relative_to(filename).as_posix().encode("utf-8"))
+
+		with open(path, "rb") as fp:
+			for chunk in iter(lambda: fp.read(chunk_size), b''):
+				sha1.update(chunk)
+
+	return sha1.hexdigest()
+
+
+def method_settings(method):
+	"""
+	Returns the settings from the ``expr_creation`` section of the Method that affect the processed data
+
+	:param method:
+	:type method: GuiV2.GSMatch2_Core.Method.Method
+
+	:rtype: dict
+	"""
+
+	return {
+			"enable_sav_gol": bool(method.expr_creation_enable_sav_gol),
+			"enable_tophat": bool(method.expr_creation_enable_tophat),
+			"tophat_struct": str(method.tophat_struct),
+			"bb_points": int(method.expr_creation_bb_points),
+			"bb_scans": int(method.expr_creation_bb_scans),
+			"enable_noise_filter": bool(method.expr_creation_enable_noise_filter),
+			"noise_thresh": int(method.expr_creation_noise_thresh),
+			"mass_range": [float(x) for x in method.mass_range[:2]],
+			"base_peak_filter": sorted(float(x) for x in method.base_peak_filter),
+			}
+
+
+def cache_key(original_filename, original_filetype, method):
+	"""
+	Returns the key for the processed data for the given datafile and Method
+
+	:param original_filename: The filename of the raw datafile
+	:type original_filename: str or pathlib.Path
+	:param original_filetype: The ID of the filetype of the raw datafile
+	:type original_filetype: int
+	:param method:
+	:type method: GuiV2.GSMatch2_Core.Method.Method
+
+	:rtype: str
+	"""
+
+	settings = json.dumps({
+			"version": CACHE_VERSION,
+			"datafile": hash_datafile(original_filename),
+			"filetype": int(original_filetype),
+			"method": method_settings(method),
+			}, sort_keys=True)
+
+	return hashlib.sha1(settings.encode("utf-8")).hexdigest()
+
+
+class CachedExperiment:
+	"""
+	Processed Experiment data retrieved from the cache
+	"""
+
+	def __init__(self, gcms_data, intensity_matrix, tic, peak_list):
+		"""
+		:param gcms_data: The raw data
+		:type gcms_data: GuiV2.GSMatch2_Core.Experiment.ingest.ScanData
+		:param intensity_matrix: The filtered intensity matrix
+		:type intensity_matrix: pyms.IntensityMatrix.IntensityMatrix
+		:param tic: The Total Ion Chromatogram
+		:type tic: pyms.GCMS.Class.IonChromatogram
+		:param peak_list: The filtered list of peaks
+		:type peak_list: list of pyms.Peak.Class.Peak
+		"""
+
+		self.gcms_data = gcms_data
+		self.intensity_matrix = intensity_matrix
+		self.tic = tic
+		self.peak_list = peak_list
+
+
+class ExperimentCache:
+	"""
+	On-disk cache of processed Experiment data
+	"""
+
+	def __init__(self, directory, max_size):
+		"""
+		:param directory: The directory to store the cache in
+		:type directory: str or pathlib.Path
+		:param max_size: The maximum total size of the cache, in bytes
+		:type max_size: int
+		"""
+
+		self.directory = pathlib.Path(directory)
+		self.max_size = int(max_size)
+
+	def path_for(self, key):
+		"""
+		Returns the path of the cache entry with the given key
+
+		:param key:
+		:type key: str
+
+		:rtype: pathlib.Path
+		"""
+
+		return self.directory / f"{key}.tar"
+
+	def get(self, key):
+		"""
+		Returns the processed data for the given key, or ``None`` if it is not in the cache
+
+		:param key:
+		:type key: str
+
+		:rtype: CachedExperiment or None
+		"""
+
+		path = self.path_for(key)
+
+		if not path.is_file():
+			return None
+
+		try:
+			archive = open_archive(path)
+
+			# Read into memory so the entry can be evicted while the data is in use
+			cached = CachedExperiment(
+					payload.load_gcms_data(archive, mmap=False),
+					payload.load_intensity_matrix(archive, mmap=False),
+					pickle.loads(archive.read("tic.dat")),
+					pickle.loads(archive.read("peaks.dat")),
+					)
+		except Exception as e:
+			# Corrupt or incomplete entry
+			print(f"Unable to read cached Experiment data from {path}: {e}")
+			self.remove(key)
+			return None
+
+		# Record the access for least recently used eviction
+		os.utime(path)
+
+		return cached
+
+	def put(self, key, gcms_data, intensity_matrix, tic, peak_list):
+		"""
+		Add processed data to the cache, then evict the least recently used entries
+		if the cache is larger than the maximum size.
+
+		:param key:
+		:type key: str
+		:param gcms_data: The raw data
+		:type gcms_data: GuiV2.GSMatch2_Core.Experiment.ingest.ScanData
+		:param intensity_matrix: The filtered intensity matrix
+		:type intensity_matrix: pyms.IntensityMatrix.IntensityMatrix
+		:param tic: The Total Ion Chromatogram
+		:type tic: pyms.GCMS.Class.IonChromatogram
+		:param peak_list: The filtered list of peaks
+		:type peak_list: list of pyms.Peak.Class.Peak
+		"""
+
+		self.directory.mkdir(parents=True, exist_ok=True)
+		path = self.path_for(key)
+
+		# Write to a temporary file first so a partially written entry is never read
+		fd, tmp_filename = tempfile.mkstemp(suffix=".tmp", dir=str(self.directory))
+		os.close(fd)
+
+		try:
+			with tarfile.open(tmp_filename, mode="w") as archive:
+				payload.store_gcms_data(archive, gcms_data)
+				payload.store_intensity_matrix(archive, intensity_matrix)
+				add_bytes_to_archive(archive, pickle.dumps(tic), "tic.dat")
+				add_bytes_to_archive(archive, pickle.dumps(peak_list), "peaks.dat")
+
+			close_archive(path)
+			os.replace(tmp_filename, str(path))
+		except BaseException:
+			os.unlink(tmp_filename)
+			raise
+
+		self.evict()
+
+	def remove(self, key):
+		"""
+		Remove the entry with the given key from the cache
+
+		:param key:
+		:type key: str
+		"""
+
+		path = self.path_for(key)
+		close_archive(path)
+
+		try:
+			path.unlink()
+		except FileNotFoundError:
+			pass
+
+	def entries(self):
+		"""
+		Returns the entries in the cache, least recently used first
+
+		:return: List of ``(key, size in bytes, last used)`` tuples
+		:rtype: list of tuple
+		"""
+
+		entries = []
+
+		if not self.directory.is_dir():
+			return entries
+
+		for path in self.directory.glob("*.tar"):
+			try:
+				stat = path.stat()
+			except FileNotFoundError:
+				continue
+
+			entries.append((path.stem, stat.st_size, datetime.datetime.fromtimestamp(stat.st_mtime)))
+
+		entries.sort(key=lambda entry: entry[2])
+
+		return entries
+
+	@property
+	def total_size(self):
+		"""
+		Returns the total size of the cache, in bytes
+
+		:rtype: int
+		"""
+
+		return sum(entry[1] for entry in self.entries())
+
+	def evict(self):
+		"""
+		Remove the least recently used entries until the cache is no larger than the maximum size
+		"""
+
+		entries = self.entries()
+		total_size = sum(entry[1] for entry in entries)
+
+		for key, size, _ in entries:
+			if total_size <= self.max_size:
+				break
+
+			try:
+				self.remove(key)
+			except OSError as e:
+				# e.g. the file is in use by another process
+				print(f"Unable to remove cached Experiment data {key}: {e}")
+				continue
+
+			total_size -= size
+
+	def purge(self, older_than=None):
+		"""
+		Remove entries from the cache
+
+		:param older_than: If given, only remove entries not used since this time
+		:type older_than: datetime.datetime, optional
+
+		:return: The number of entries removed
+		:rtype: int
+		"""
+
+		n_removed = 0
+
+		for key, size, last_used in self.entries():
+			if older_than is None or last_used < older_than:
+				self.remove(key)
+				n_removed += 1
+
+		return n_removed
+
+
+def get_cache():
+	"""
+	Returns the processed Experiment cache, using the settings from the internal configuration,
+	or ``None`` if the cache is disabled.
+
+	:rtype: ExperimentCache or None
+	"""
+
+	if not internal_config.expr_cache_size:
+		return None
+
+	return ExperimentCache(internal_config.expr_cache_dir, internal_config.expr_cache_size * 1024 * 1024)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(
+			prog="python -m GuiV2.GSMatch2_Core.Experiment.cache",
+			description="Inspect or purge the cache of processed Experiment data.",
+			)
+	subparsers = parser.add_subparsers(dest="command")
+
+	subparsers.add_parser("info", help="Show the location, size and number of entries of the cache.")
+	subparsers.add_parser("list", help="List the entries in the cache, least recently used first.")
+
+	purge_parser = subparsers.add_parser("purge", help="Remove entries from the cache.")
+	purge_parser.add_argument(
+			"--older-than",
+			type=float,
+			dest="older_than",
+			metavar="DAYS",
+			help="Only remove entries that have not been used for this many days.",
+			)
+
+	args = parser.parse_args(argv)
+
+	cache = ExperimentCache(internal_config.expr_cache_dir, internal_config.expr_cache_size * 1024 * 1024)
+
+	if args.command == "info":
+		entries = cache.entries()
+		print(f"Location:      {cache.directory}")
+		print(f"Entries:       {len(entries)}")
+		print(f"Total size:    {sum(entry[1] for entry in entries) / 1048576:0.1f} MB")
+		if internal_config.expr_cache_size:
+			print(f"Maximum size:  {internal_config.expr_cache_size} MB")
+		else:
+			print("Maximum size:  Cache disabled")
+
+	elif args.command == "list":
+		for key, size, last_used in cache.entries():
+			print(f"{key}  {size / 1048576:8.1f} MB  {last_used:%Y-%m-%d %H:%M:%S}")
+
+	elif args.command == "purge":
+		if args.older_than is None:
+			older_than = None
+		else:
+			older_than = datetime.datetime.now() - datetime.timedelta(days=args.older_than)
+
+		print(f"Removed {cache.purge(older_than)} entries")
+
+	else:
+		parser.print_help()
+		return 1
+
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
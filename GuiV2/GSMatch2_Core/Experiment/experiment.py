@@ -33,11 +33,9 @@ import pickle
 import sys
 import tarfile
 import tempfile
-import time
 import traceback
 from decimal import Decimal
 from io import BytesIO
-from statistics import mean, median
 
 # 3rd party
 import numpy
@@ -48,22 +46,24 @@ from mathematical.utils import rounders
 from pyms.BillerBiemann import BillerBiemann, num_ions_threshold
 from pyms.Experiment import store_expr
 from pyms.GCMS.Class import IonChromatogram
-from pyms.IntensityMatrix import build_intensity_matrix_i
 from pyms.Noise.Analysis import window_analyzer
-from pyms.Noise.SavitzkyGolay import savitzky_golay
 from pyms.Peak.Function import peak_sum_area
 from pyms.Peak.List.IO import store_peaks
-from pyms.TopHat import tophat
 
 # this package
 from GSMatch.utils import pynist
 from GuiV2.GSMatch2_Core import Base, Method
 from GuiV2.GSMatch2_Core.Config import internal_config
+from GuiV2.GSMatch2_Core.Experiment import cache as expr_cache, ingest, payload
+from GuiV2.GSMatch2_Core.Experiment.filtering import filter_intensity_matrix
 from GuiV2.GSMatch2_Core.Experiment.identification import QualifiedPeak
-from GuiV2.GSMatch2_Core.Experiment.identification.functions import create_msp
+from GuiV2.GSMatch2_Core.Experiment.identification.functions import create_multi_msp
 from GuiV2.GSMatch2_Core.IDs import *
 from GuiV2.GSMatch2_Core.InfoProperties import massrange, Property, rtrange
-from GuiV2.GSMatch2_Core.io import get_file_from_archive, load_info_json
+from GuiV2.GSMatch2_Core.nist_search import identify_peaks, SearchEngine
+from GuiV2.GSMatch2_Core.io import (
+	add_bytes_to_archive, close_archive, get_file_from_archive, load_info_json, open_archive,
+	)
 from GuiV2.GSMatch2_Core.utils import filename_only
 from GuiV2.GSMatch2_Core.watchdog import AuditRecord, time_now
 
@@ -132,12 +132,16 @@ class Experiment(Base.GSMBase):
 		# 	if experiment["Method"] not in self._method_files:
 		# 		self._method_files.add(experiment["Method"])
 		
-		self.expr = None
-		self.tic = None
-		self.intensity_matrix = None
-		self.gcms_data = None
-		self.peak_list = None
-		self.ident_peaks = None
+		# Whether the data can be loaded from the Experiment file on first access.
+		# Set when the Experiment is loaded from or saved to a file.
+		self._lazy_load = False
+		
+		self._expr = None
+		self._tic = None
+		self._intensity_matrix = None
+		self._gcms_data = None
+		self._peak_list = None
+		self._ident_peaks = None
 		
 		self.time_step = Property(
 				f"{name}_time_step", None, float,
@@ -183,27 +187,50 @@ class Experiment(Base.GSMBase):
 	
 	def get_info_from_gcms_data(self):
 		"""
-		Method to get information from the :class:`pyms.GCMS.Class.GCMS_data` object contained within experiment
+		Method to get information from the raw scans contained within experiment
 		"""
 		
-		# TODO: within pyms make read only properties for these private attributes
+		self._set_scan_statistics(self.gcms_data.statistics())
+	
+	def _set_scan_statistics(self, scan_stats):
+		"""
+		Set the properties describing the raw scans from the given statistics
 		
-		self.data_rt_range.value = (self.gcms_data._min_rt / 60, self.gcms_data._max_rt / 60)
-		self.time_step.value = self.gcms_data._time_step
-		self.time_step_stdev.value = self.gcms_data._time_step_std
-		self.n_scans.value = len(self.gcms_data.scan_list)
-		self.data_mz_range.value = (self.gcms_data._min_mass, self.gcms_data._max_mass)
+		:param scan_stats: Dictionary of statistics,
+			from :meth:`GuiV2.GSMatch2_Core.Experiment.ingest.ScanData.statistics`
+		:type scan_stats: dict
+		"""
 		
-		# calculate median number of m/z values measured per scan
-		n_list = []
-		scan_list = self.gcms_data.scan_list
-		for ii in range(len(scan_list)):
-			scan = scan_list[ii]
-			n = len(scan)
-			n_list.append(n)
-		self.data_n_mz_mean.value = mean(n_list)
-		self.data_n_mz_median.value = median(n_list)
+		self.data_rt_range.value = (scan_stats["rt_range"][0] / 60, scan_stats["rt_range"][1] / 60)
+		self.time_step.value = scan_stats["time_step"]
+		self.time_step_stdev.value = scan_stats["time_step_stdev"]
+		self.n_scans.value = scan_stats["n_scans"]
+		self.data_mz_range.value = tuple(scan_stats["mz_range"])
+		self.data_n_mz_mean.value = scan_stats["n_mz_mean"]
+		self.data_n_mz_median.value = scan_stats["n_mz_median"]
+	
+	@property
+	def scan_statistics(self):
+		"""
+		Returns the statistics describing the raw scans, in the same form as
+		:meth:`GuiV2.GSMatch2_Core.Experiment.ingest.ScanData.statistics`
 		
+		:rtype: dict
+		"""
+		
+		if self.n_scans.value is None:
+			self.get_info_from_gcms_data()
+		
+		return {
+				"n_scans": self.n_scans.value,
+				"rt_range": [self.data_rt_range.value[0] * 60, self.data_rt_range.value[1] * 60],
+				"time_step": self.time_step.value,
+				"time_step_stdev": self.time_step_stdev.value,
+				"mz_range": list(self.data_mz_range.value),
+				"n_mz_mean": float(self.data_n_mz_mean.value),
+				"n_mz_median": self.data_n_mz_median.value,
+				}
+	
 	@classmethod
 	def load(cls, filename):
 		"""
@@ -216,20 +243,145 @@ class Experiment(Base.GSMBase):
 		experiment_data = load_info_json(filename)
 		
 		expr = cls(**experiment_data, filename=filename)
-		expr.gcms_data = pickle.load(get_file_from_archive(expr.filename.Path, "gcms_data.dat"))
-		expr.expr = pickle.load(get_file_from_archive(expr.filename.Path, "experiment.expr"))
-		expr.peak_list = pickle.load(get_file_from_archive(expr.filename.Path, "peaks.dat"))
-		expr.intensity_matrix = pickle.load(get_file_from_archive(expr.filename.Path, "intensity_matrix.dat"))
 		
-		if expr.identification_performed:
-			expr.ident_peaks = pickle.load(get_file_from_archive(expr.filename.Path, "ident_peaks.dat"))
+		archive = open_archive(expr.filename.Path)
 		
-		expr.tic = expr.tic_data[1]
-
-		expr.get_info_from_gcms_data()
+		if "scan_stats.json" in archive:
+			# Files created before the statistics were stored are handled by _get_all_properties
+			expr._set_scan_statistics(json.loads(archive.read("scan_stats.json").decode("utf-8")))
+		
+		# The remaining data is loaded from the file when it is first accessed
+		expr._lazy_load = True
 		
 		return expr
 	
+	def _load_gcms_data(self):
+		"""
+		Load the raw scans and the :class:`pyms.IntensityMatrix.IntensityMatrix` from the Experiment file
+		"""
+		
+		if payload.has_columnar_payload(self.filename.Path):
+			self._gcms_data = payload.load_gcms_data(self.filename.Path)
+			self._intensity_matrix = payload.load_intensity_matrix(self.filename.Path)
+		else:
+			# Files created before version 1.1.0 contain pickled objects
+			self._gcms_data = ingest.ScanData.from_gcms_data(
+					pickle.load(get_file_from_archive(self.filename.Path, "gcms_data.dat"))
+					)
+			self._intensity_matrix = pickle.load(get_file_from_archive(self.filename.Path, "intensity_matrix.dat"))
+	
+	@property
+	def gcms_data(self):
+		"""
+		The :class:`~GuiV2.GSMatch2_Core.Experiment.ingest.ScanData` object containing the raw data.
+		Loaded from the Experiment file on first access.
+		"""
+		
+		if self._gcms_data is None and self._lazy_load:
+			self._load_gcms_data()
+		
+		return self._gcms_data
+	
+	@gcms_data.setter
+	def gcms_data(self, value):
+		self._gcms_data = value
+	
+	@property
+	def intensity_matrix(self):
+		"""
+		The filtered :class:`pyms.IntensityMatrix.IntensityMatrix`.
+		Loaded from the Experiment file on first access.
+		"""
+		
+		if self._intensity_matrix is None and self._lazy_load:
+			if payload.has_columnar_payload(self.filename.Path):
+				self._intensity_matrix = payload.load_intensity_matrix(self.filename.Path)
+			else:
+				self._load_gcms_data()
+		
+		return self._intensity_matrix
+	
+	@intensity_matrix.setter
+	def intensity_matrix(self, value):
+		self._intensity_matrix = value
+	
+	@property
+	def expr(self):
+		"""
+		The :class:`pyms.Experiment.Experiment` object.
+		Loaded from the Experiment file on first access.
+		"""
+		
+		if self._expr is None and self._lazy_load:
+			self._expr = pickle.load(get_file_from_archive(self.filename.Path, "experiment.expr"))
+		
+		return self._expr
+	
+	@expr.setter
+	def expr(self, value):
+		self._expr = value
+	
+	@property
+	def peak_list(self):
+		"""
+		The list of peaks in the Experiment.
+		Loaded from the Experiment file on first access.
+		"""
+		
+		if self._peak_list is None and self._lazy_load:
+			self._peak_list = pickle.load(get_file_from_archive(self.filename.Path, "peaks.dat"))
+		
+		return self._peak_list
+	
+	@peak_list.setter
+	def peak_list(self, value):
+		self._peak_list = value
+	
+	@property
+	def ident_peaks(self):
+		"""
+		The list of :class:`~GuiV2.GSMatch2_Core.Experiment.identification.QualifiedPeak`
+		objects from Compound Identification. Loaded from the Experiment file on first access.
+		"""
+		
+		if self._ident_peaks is None and self._lazy_load and self.identification_performed:
+			self._ident_peaks = pickle.load(get_file_from_archive(self.filename.Path, "ident_peaks.dat"))
+		
+		return self._ident_peaks
+	
+	@ident_peaks.setter
+	def ident_peaks(self, value):
+		self._ident_peaks = value
+	
+	@property
+	def tic(self):
+		"""
+		The Total Ion Chromatogram.
+		Loaded from the Experiment file on first access.
+		"""
+		
+		if self._tic is None and self._lazy_load:
+			self._tic = self.tic_data[1]
+		
+		return self._tic
+	
+	@tic.setter
+	def tic(self, value):
+		self._tic = value
+	
+	def unload(self):
+		"""
+		Release the raw data, intensity matrix and TIC to free up memory.
+		They will be loaded from the Experiment file again when next accessed.
+		
+		Has no effect if the Experiment has not been loaded from or saved to a file.
+		"""
+		
+		if self._lazy_load:
+			self._gcms_data = None
+			self._intensity_matrix = None
+			self._tic = None
+	
 	def store(self, filename=None):
 		"""
 		Save the Project to a file
@@ -241,11 +393,6 @@ class Experiment(Base.GSMBase):
 		:rtype:
 		"""
 		
-		if filename:
-			self.filename.value = filename
-		
-		self.date_modified.value = time_now()
-		
 		if any((
 				self.expr is None,
 				self.tic is None,
@@ -255,14 +402,25 @@ class Experiment(Base.GSMBase):
 				)):
 			raise ValueError("Must call 'Experiment.run()' before 'store()'")
 		
+		# Read any memory-mapped or not yet loaded data into memory before the file is overwritten
+		self.intensity_matrix = payload.unmap_intensity_matrix(self.intensity_matrix)
+		self.gcms_data = payload.unmap_gcms_data(self.gcms_data)
+		ident_peaks = self.ident_peaks
+		scan_stats = self.scan_statistics
+		
+		# The data has been read from the current file, so the new filename can now be set
+		if filename:
+			self.filename.value = filename
+		
+		self.date_modified.value = time_now()
+		
 		# Write experiment, tic and peak list to temporary directory
 		with tempfile.TemporaryDirectory() as tmp:
-			self.gcms_data.dump(os.path.join(tmp, "gcms_data.dat"))
-			self.intensity_matrix.dump(os.path.join(tmp, "intensity_matrix.dat"))
 			self.tic.write(os.path.join(tmp, "tic.dat"), formatting=False)
 			store_peaks(self.peak_list, os.path.join(tmp, "peaks.dat"), 3)
 			store_expr(os.path.join(tmp, "experiment.expr"), self.expr)
 			
+			close_archive(self.filename.value)
 			with tarfile.open(self.filename.value, mode="w") as experiment_file:
 				# # Add the method files
 				# for method in self._method_files:
@@ -275,7 +433,7 @@ class Experiment(Base.GSMBase):
 					"date_created": float(self.date_created),
 					"date_modified": float(self.date_modified),
 					"description": str(self.description),
-					"version": "1.0.0",
+					"version": payload.PAYLOAD_VERSION,
 					"method": str(self.method),
 					"original_filename": str(self.original_filename),
 					"original_filetype": int(self.original_filetype),
@@ -285,9 +443,16 @@ class Experiment(Base.GSMBase):
 				
 				if self.identification_performed:
 					experiment_data["ident_audit_record"] = dict(self.ident_audit_record)
-					store_peaks(self.ident_peaks, os.path.join(tmp, "ident_peaks.dat"), 3)
+					store_peaks(ident_peaks, os.path.join(tmp, "ident_peaks.dat"), 3)
 					experiment_file.add(os.path.join(tmp, "ident_peaks.dat"), arcname="ident_peaks.dat")
 				
+				# Add the statistics for the raw scans, so they don't need to be recalculated when loading
+				add_bytes_to_archive(
+						experiment_file,
+						json.dumps(scan_stats, indent=4).encode("utf-8"),
+						"scan_stats.json",
+						)
+				
 				# Add the info file to the archive
 				info_json = json.dumps(experiment_data, indent=4).encode("utf-8")
 				tarinfo = tarfile.TarInfo('info.json')
@@ -297,66 +462,81 @@ class Experiment(Base.GSMBase):
 				# Add the method to the archive
 				experiment_file.add(self.method.value, arcname=filename_only(self.method.value))
 				
-				# Add the experiment, tic, intrnsity_matrix, gcms_data and peak list
+				# Add the experiment, tic and peak list
 				experiment_file.add(os.path.join(tmp, "experiment.expr"), arcname="experiment.expr")
 				experiment_file.add(os.path.join(tmp, "tic.dat"), arcname="tic.dat")
 				experiment_file.add(os.path.join(tmp, "peaks.dat"), arcname="peaks.dat")
-				experiment_file.add(os.path.join(tmp, "gcms_data.dat"), arcname="gcms_data.dat")
-				experiment_file.add(os.path.join(tmp, "intensity_matrix.dat"), arcname="intensity_matrix.dat")
+				
+				# Add the gcms_data and intensity_matrix as arrays which can be memory-mapped
+				payload.store_gcms_data(experiment_file, self.gcms_data)
+				payload.store_intensity_matrix(experiment_file, self.intensity_matrix)
+		
+		# The data can now be reloaded from the file after calling unload()
+		self._lazy_load = True
 		
 		return self.filename
 	
-	def run(self, original_filename, original_filetype):
+	def run(self, original_filename, original_filetype, use_cache=True):
 		"""
 		Load the original data from the given datafile and perform quantitative analysis
 		
+		If the same datafile has previously been processed with the same Method settings
+		the processed data is retrieved from the cache instead.
+		
 		:param original_filename:
 		:type original_filename:
 		:param original_filetype:
 		:type original_filetype:
+		:param use_cache: Whether to use the cache of processed Experiment data. Default True
+		:type use_cache: bool, optional
 		"""
 		
 		self.original_filename = str(original_filename)
 		self.original_filetype = int(original_filetype)
 		
-		print("Quantitative Processing in Progress...")
+		method = Method.Method(self.method.value)
 		
-		# TODO: Include data etc. in experiment file
+		cache = None
+		key = None
 		
-		if self.original_filetype == ID_Format_jcamp:
-			# Load data using JCAMP_reader
-			from pyms.GCMS.IO.JCAMP import JCAMP_reader
-			self.gcms_data = JCAMP_reader(self.original_filename)
+		if use_cache:
+			cache = expr_cache.get_cache()
 		
-		elif self.original_filetype == ID_Format_mzML:
-			# Load data using JCAMP_reader
-			from pyms.GCMS.IO.MZML import mzML_reader
-			self.gcms_data = mzML_reader(self.original_filename)
+		if cache is not None:
+			key = expr_cache.cache_key(self.original_filename, self.original_filetype, method)
+			cached = cache.get(key)
+			
+			if cached is not None:
+				print("Using cached processed data")
+				
+				self.gcms_data = cached.gcms_data
+				self.intensity_matrix = cached.intensity_matrix
+				self.tic = cached.tic
+				self.peak_list = cached.peak_list
+				
+				self.get_info_from_gcms_data()
+				self._create_pyms_experiment(method)
+				return
 		
-		elif self.original_filetype == ID_Format_ANDI:
-			# Load data using JCAMP_reader
-			from pyms.GCMS.IO.ANDI import ANDI_reader
-			self.gcms_data = ANDI_reader(self.original_filename)
+		print("Quantitative Processing in Progress...")
 		
-		else:
+		# Read the scans into flat arrays, without creating a Scan object for each scan
+		self.gcms_data = ingest.read_datafile(self.original_filename, self.original_filetype)
+		
+		if self.gcms_data is None:
 			# Unknown Format
 			return
 		# TODO: Waters RAW, Thermo RAW, Agilent .d
 		
-		method = Method.Method(self.method.value)
-		
-		# list of all retention times, in seconds
-		# times = self.gcms_data.get_time_list()
 		# get Total Ion Chromatogram
 		self.tic = self.gcms_data.get_tic()
-		# RT Range, time step, no. scans, min, max, mean and median m/z
-		self.gcms_data.info()
 		
+		# RT Range, time step, no. scans, min, max, mean and median m/z
 		self.get_info_from_gcms_data()
 		
 		# Build "intensity matrix" by binning data with integer bins and a
 		# 	window of -0.3 to +0.7, the same as NIST uses
-		self.intensity_matrix = build_intensity_matrix_i(self.gcms_data)
+		self.intensity_matrix = self.gcms_data.build_intensity_matrix_i()
 		
 		# Show the m/z of the maximum and minimum bins
 		print(" Minimum m/z bin: {}".format(self.intensity_matrix.get_min_mass()))
@@ -371,27 +551,13 @@ class Experiment(Base.GSMBase):
 			max_mass = self.intensity_matrix.get_max_mass()
 		self.intensity_matrix.crop_mass(min_mass, max_mass)
 		
-		# Perform Data filtering
-		n_scan, n_mz = self.intensity_matrix.get_size()
-		
-		# Iterate over each IC in the intensity matrix
-		for ii in range(n_mz):
-			# print("\rWorking on IC#", ii+1, '  ',end='')
-			ic = self.intensity_matrix.get_ic_at_index(ii)
-			
-			if method.expr_creation_enable_sav_gol:
-				# Perform Savitzky-Golay smoothing.
-				# Note that Turbomass does not use smoothing for qualitative method.
-				ic = savitzky_golay(ic)
-			
-			if method.expr_creation_enable_tophat:
-				# Perform Tophat baseline correction
-				# Top-hat baseline Correction seems to bring down noise,
-				#  		retaining shapes, but keeps points on actual peaks
-				ic = tophat(ic, struct=method.tophat_struct)
-			
-			# Set the IC in the intensity matrix to the filtered one
-			self.intensity_matrix.set_ic_at_index(ii, ic)
+		# Perform Data filtering on the whole intensity matrix at once
+		self.intensity_matrix = filter_intensity_matrix(
+				self.intensity_matrix,
+				enable_sav_gol=method.expr_creation_enable_sav_gol,
+				enable_tophat=method.expr_creation_enable_tophat,
+				tophat_struct=method.tophat_struct,
+				)
 			
 		# Peak Detection based on Biller and Biemann (1974), with a window
 		# 	of <points>, and combining <scans> if they apex next to each other
@@ -438,7 +604,19 @@ class Experiment(Base.GSMBase):
 			
 		print(" Number of peaks identified: {}".format(len(self.peak_list)))
 		
-		# Create an experiment
+		if cache is not None:
+			cache.put(key, self.gcms_data, self.intensity_matrix, self.tic, self.peak_list)
+		
+		self._create_pyms_experiment(method)
+	
+	def _create_pyms_experiment(self, method):
+		"""
+		Create the :class:`pyms.Experiment.Experiment` object from the peak list
+		
+		:param method:
+		:type method: GuiV2.GSMatch2_Core.Method.Method
+		"""
+		
 		self.expr = pyms.Experiment.Experiment(self.name, self.peak_list)
 		self.expr.sele_rt_range(["{}m".format(method.target_range[0]), "{}m".format(method.target_range[1])])
 		
@@ -508,25 +686,16 @@ class Experiment(Base.GSMBase):
 			# Sort by retention time
 			report_buffer.sort(key=operator.itemgetter(1))
 			
+			# Search for all of the peaks at once
+			all_matches = self.nist_ms_batch_comparison(
+					[("{}_{}".format(self.name, row[1]), row[3]) for row in report_buffer],
+					n_hits,
+					)
+			
 			# Iterate over peaks
-			for row_idx, row in enumerate(report_buffer):
-				# TODO: some tidying up here; is writing to disk the most efficient?
-				# 	DDF 20/11/19
-				
-				# Get mass spectrum
-				ms = row[3]
-				
+			for row_idx, (row, matches_dict) in enumerate(zip(report_buffer, all_matches)):
 				qualified_peak = QualifiedPeak.from_peak(row[5])
 				
-				# Create MSP file for the peak
-				create_msp("{}_{}".format(self.name, row[1]), ms.mass_list, ms.mass_spec)
-				
-				matches_dict = self.nist_ms_comparison(
-						"{}_{}".format(self.name, row[1]),
-						# ms.mass_list, ms.mass_spec,
-						n_hits
-						)
-				
 				combine_csv.write("{};{};Page {} of 80;;;;;;{}\n".format(row[1], row[4], row_idx + 1, row[2]))
 				
 				for hit in range(1, n_hits + 1):
@@ -542,8 +711,6 @@ class Experiment(Base.GSMBase):
 								))
 					
 					qualified_peak.hits.append(search_result)
-					
-				time.sleep(2)
 		
 		return 0
 		
@@ -562,58 +729,31 @@ class Experiment(Base.GSMBase):
 		# # Obtain area for each peak
 		# peak_area_list = get_area_list(self.peak_list)
 		
-		# Convert float retention times to Decimal
-		# rt_list = [rounders(rt, "0.0000000000") for rt in target_times]
-		target_times = target_times.apply(round_rt)
-		# Remove NaN values
-		rt_list = [rt for rt in target_times if not rt.is_nan()]
-		# Sort smallest to largest
-		rt_list.sort()
-		
 		# Write output to CSV file
 		combined_csv_file = os.path.join("/home/domdf/.config/GunShotMatch", "{}_COMBINED.csv".format(self.name))
 		with open(combined_csv_file, "w") as combine_csv:
 			
 			# Sample name and header row
 			combine_csv.write(f"{self.name}\n{csv_header_row}\n")
-			peaks = []
 			
-			# Filter to those peaks present in all samples, by UID
-			for peak in self.peak_list:
-				
-				rt = (peak.rt / 60)
-				rounded_rt = round_rt(rt)
+			# Filter to those peaks present in all samples
+			peaks = self.get_peaks_to_identify(target_times)
+			
+			# Actual Search, for all of the peaks at once
+			all_matches = self.nist_ms_batch_comparison(
+					[("{}_{}".format(self.name, peak.rt / 60), peak.mass_spectrum) for peak in peaks],
+					n_hits,
+					)
+			
+			for qualified_peak, matches_dict in zip(peaks, all_matches):
+				# Add search results to peak
+				for hit in range(1, n_hits + 1):
+					search_result = pyms_nist_search.SearchResult.from_pynist(matches_dict["Hit{}".format(hit)])
+					qualified_peak.hits.append(search_result)
 				
-				if rounded_rt in rt_list:
-					qualified_peak = QualifiedPeak.from_peak(peak)
-					qualified_peak.peak_number = target_times[target_times == rounded_rt].index[0]
-					
-					ms = qualified_peak.mass_spectrum
-
-					# Create MSP file for the peak
-					create_msp(
-							"{}_{}".format(self.name, rt),
-							ms.mass_list,
-							ms.mass_spec)
-					
-					# Actual Search
-					matches_dict = self.nist_ms_comparison(
-							"{}_{}".format(self.name, rt),
-							n_hits
-							)
-					
-					# Add search results to peak
-					for hit in range(1, n_hits + 1):
-						search_result = pyms_nist_search.SearchResult.from_pynist(matches_dict["Hit{}".format(hit)])
-						qualified_peak.hits.append(search_result)
-					
-					# Write to file
-					for row in qualified_peak.to_csv():
-						combine_csv.write(f'{";".join(row)}\n')
-						
-					peaks.append(qualified_peak)
-					
-					time.sleep(2)
+				# Write to file
+				for row in qualified_peak.to_csv():
+					combine_csv.write(f'{";".join(row)}\n')
 		
 		# Add peaks to experiment and save
 		self.ident_peaks = peaks
@@ -622,7 +762,7 @@ class Experiment(Base.GSMBase):
 		
 		return peaks
 		
-	def identify_compounds3(self, target_times, n_hits=10):
+	def identify_compounds3(self, target_times, n_hits=10, search=None):
 		"""
 		Identify the compounds that produced each of the peaks in the Chromatogram
 		
@@ -630,79 +770,135 @@ class Experiment(Base.GSMBase):
 		:type target_times:
 		:param n_hits: The number of hits to return from NIST MS Search
 		:type n_hits: int
+		:param search: The search engine to use. If not given a search engine
+			is initialised for this Experiment and uninitialised afterwards.
+		:type search: GuiV2.GSMatch2_Core.nist_search.SearchEngine, optional
 		"""
 		
 		print(f"Identifying Compounds for {self.name}")
 		
-		peaks = []
-		
-		# Initialise search engine.
-		# TODO: Ideally this can be done once and shared between all experiments
-		#  but it breaks when loading the Method editor
-		search = pyms_nist_search.Engine(
-				Base.FULL_PATH_TO_MAIN_LIBRARY,
-				pyms_nist_search.NISTMS_MAIN_LIB,
-				Base.FULL_PATH_TO_WORK_DIR,
-				debug=True,
-				)
+		# Initialise search engine, unless one is being shared between experiments
+		own_search = search is None
+		if own_search:
+			search = SearchEngine(debug=True)
 		
-		# Wrap search in try/except so that the search engine will be uninitialised in the event of an error
+		# Wrap search in try/finally so that the search engine will be uninitialised in the event of an error
 		try:
-			# Convert float retention times to Decimal
-			# rt_list = [rounders(rt, "0.0000000000") for rt in target_times]
-			target_times = target_times.apply(round_rt)
-			# Remove NaN values
-			rt_list = [rt for rt in target_times if not rt.is_nan()]
-			# Sort smallest to largest
-			rt_list.sort()
-			
-			# # Obtain area for each peak
-			# peak_area_list = get_area_list(self.peak_list)
-			
-			# Write output to CSV file
-			combined_csv_file = os.path.join("/home/domdf/.config/GunShotMatch", "{}_COMBINED.csv".format(self.name))
-			with open(combined_csv_file, "w") as combine_csv:
-				
-				# Sample name and header row
-				combine_csv.write(f"{self.name}\n{csv_header_row}\n")
-				
-				# Filter to those peaks present in all samples, by UID
-				for peak in self.peak_list:
-					
-					rounded_rt = round_rt(peak.rt / 60)
-					
-					if rounded_rt in rt_list:
-						qualified_peak = QualifiedPeak.from_peak(peak)
-						qualified_peak.peak_number = target_times[target_times == rounded_rt].index[0]
-						
-						ms = qualified_peak.mass_spectrum
-	
-						print(f"Identifying peak at rt {rounded_rt} minutes...")
-						
-						hit_list = search.full_spectrum_search(ms, n_hits)
-						
-						# Add search results to peak
-						for hit in hit_list:
-							qualified_peak.hits.append(hit)
-						
-						# Write to file
-						for row in qualified_peak.to_csv():
-							combine_csv.write(f'{";".join(row)}\n')
-							
-						peaks.append(qualified_peak)
-			
-			# Add peaks to experiment and save
-			self.ident_peaks = peaks
-			self.identification_performed = True
-			self.ident_audit_record = AuditRecord()
+			peaks = self.get_peaks_to_identify(target_times)
+			identify_peaks(peaks, search, n_hits)
+			self.set_identified_peaks(peaks)
+		
+		finally:
+			if own_search:
+				search.uninit()
+		
+		return peaks
+	
+	def get_peaks_to_identify(self, target_times, peak_indices=None):
+		"""
+		Returns the peaks in the Chromatogram at the given retention times,
+		ready for Compound Identification.
+		
+		:param target_times: The retention times of the aligned peaks to identify, in minutes,
+			indexed by the aligned peak number
+		:type target_times: pandas.Series
+		:param peak_indices: The index of each aligned peak in the peak list, or -1 if this
+			Experiment does not have that peak. If not given the peaks are found from the retention times.
+		:type peak_indices: pandas.Series or numpy.ndarray, optional
+		
+		:rtype: list of :class:`~GuiV2.GSMatch2_Core.Experiment.identification.QualifiedPeak`
+		"""
+		
+		peak_numbers = target_times.index.to_numpy()
+		
+		if peak_indices is None:
+			peak_indices = self.get_peak_indices(target_times.to_numpy(dtype=float))
+		else:
+			peak_indices = numpy.asarray(peak_indices, dtype=int)
+		
+		# Keep the peaks in retention time order, with the first aligned peak number for each peak
+		found = numpy.flatnonzero(peak_indices >= 0)
+		found = found[numpy.argsort(peak_indices[found], kind="stable")]
+		
+		peaks = []
+		last_peak_idx = -1
+		
+		for aligned_idx in found:
+			peak_idx = peak_indices[aligned_idx]
+			if peak_idx == last_peak_idx:
+				continue
 			
-		except Exception:
-			search.uninit()
-			raise
+			qualified_peak = QualifiedPeak.from_peak(self.peak_list[peak_idx])
+			qualified_peak.peak_number = peak_numbers[aligned_idx]
+			peaks.append(qualified_peak)
+			last_peak_idx = peak_idx
 		
-		search.uninit()
 		return peaks
+	
+	def get_peak_indices(self, target_times, tolerance=1e-9):
+		"""
+		Returns the index in the peak list of the peak at each of the given retention times.
+		
+		Peak alignment data is stored with the retention times rounded to 10 decimal places,
+		so each time is matched to the peak with the nearest retention time, within ``tolerance``.
+		
+		:param target_times: Retention times, in minutes. ``NaN`` for aligned peaks not in this Experiment
+		:type target_times: numpy.ndarray
+		:param tolerance: The maximum difference in retention time, in minutes
+		:type tolerance: float, optional
+		
+		:return: The index of the peak at each retention time, or -1 if there is no peak at that time
+		:rtype: numpy.ndarray
+		"""
+		
+		target_times = numpy.asarray(target_times, dtype=float)
+		peak_list = self.peak_list
+		
+		if not peak_list:
+			return numpy.full(target_times.shape, -1, dtype=int)
+		
+		peak_times = numpy.fromiter((peak.rt for peak in peak_list), dtype=float, count=len(peak_list)) / 60
+		order = numpy.argsort(peak_times, kind="stable")
+		sorted_times = peak_times[order]
+		
+		# The peaks either side of each target time
+		right = numpy.clip(numpy.searchsorted(sorted_times, target_times), 0, len(sorted_times) - 1)
+		left = numpy.clip(right - 1, 0, len(sorted_times) - 1)
+		
+		with numpy.errstate(invalid="ignore"):
+			nearest = numpy.where(
+					numpy.abs(sorted_times[right] - target_times) < numpy.abs(sorted_times[left] - target_times),
+					right,
+					left,
+					)
+			matched = numpy.abs(sorted_times[nearest] - target_times) <= tolerance
+		
+		return numpy.where(matched, order[nearest], -1)
+	
+	def set_identified_peaks(self, peaks):
+		"""
+		Store the results of Compound Identification for the Experiment
+		
+		:param peaks: The peaks, with the hits from NIST MS Search
+		:type peaks: list of :class:`~GuiV2.GSMatch2_Core.Experiment.identification.QualifiedPeak`
+		"""
 		
+		# Write output to CSV file
+		combined_csv_file = os.path.join("/home/domdf/.config/GunShotMatch", "{}_COMBINED.csv".format(self.name))
+		with open(combined_csv_file, "w") as combine_csv:
+			
+			# Sample name and header row
+			combine_csv.write(f"{self.name}\n{csv_header_row}\n")
+			
+			for qualified_peak in peaks:
+				for row in qualified_peak.to_csv():
+					combine_csv.write(f'{";".join(row)}\n')
+		
+		# Add peaks to experiment and save
+		self.ident_peaks = peaks
+		self.identification_performed = True
+		self.ident_audit_record = AuditRecord()
+	
 	def nist_ms_comparison(self, sample_name, n_hits=5):
 		"""
 		
@@ -762,6 +958,45 @@ class Experiment(Base.GSMBase):
 		pynist.reload_ini(internal_config.nist_path)
 		return matches_dict
 	
+	def nist_ms_batch_comparison(self, spectra, n_hits=5):
+		"""
+		Search NIST MS Search for several spectra at once, using a single MSP file
+		
+		:param spectra: List of ``(spectrum name, mass spectrum)`` tuples
+		:type spectra: list of tuple
+		:param n_hits: The number of hits to return for each spectrum
+		:type n_hits: int
+		
+		:return: A dictionary of hits for each spectrum, in the same order as ``spectra``
+		:rtype: list of dict
+		
+		:raises: :class:`GSMatch.utils.pynist.nistError` if the search could not be performed
+		"""
+		
+		if not spectra:
+			return []
+		
+		try:
+			create_multi_msp(self.name, spectra)
+			pynist.generate_ini(internal_config.nist_path, "mainlib", n_hits)
+			
+			raw_output = pynist.nist_db_connector(
+					internal_config.nist_path,
+					os.path.join(internal_config.msp_dir, "{}.MSP".format(self.name)),
+					search_len=len(spectra),
+					)
+			
+			all_matches = pynist.parse_results(raw_output, n_hits)
+		
+		except (pynist.nistError, TimeoutError, OSError) as e:
+			raise pynist.nistError(f"NIST MS Search failed for {self.name}: {e}") from e
+		
+		finally:
+			pynist.reload_ini(internal_config.nist_path)
+		
+		print("\r\033[KSearch Complete")  # , end='')
+		return all_matches
+	
 	@property
 	def experiment_data(self):
 		"""
@@ -825,6 +1060,10 @@ class Experiment(Base.GSMBase):
 		:rtype: list
 		"""
 		
+		if self.n_scans.value is None and self.gcms_data is not None:
+			# The raw data is only loaded once the information is needed
+			self.get_info_from_gcms_data()
+		
 		all_props = Base.GSMBase._get_all_properties(self)
 		all_props = all_props[:-2] + [
 				self.data_rt_range,
@@ -0,0 +1,244 @@
+#  !/usr/bin/env python
+#   -*- coding: utf-8 -*-
+#
+#  filtering.py
+#
+#  This file is part of GunShotMatch
+#
+#  Copyright © 2020 Dominic Davis-Foster <dominic@davis-foster.co.uk>
+#
+#  GunShotMatch is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  GunShotMatch is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Savitzky-Golay coefficient calculation based on PyMassSpec
+#  Copyright (C) Uwe Schmitt
+#
+
+# stdlib
+import math
+
+# 3rd party
+import numpy
+from pyms.IntensityMatrix import IntensityMatrix
+from pyms.Utils.Time import time_str_secs
+from scipy import ndimage
+
+
+# Same defaults as pyms.Noise.SavitzkyGolay.savitzky_golay
+SAV_GOL_WINDOW = 7
+SAV_GOL_DEGREE = 2
+
+
+def window_points(time_step, window, half_window=False):
+	"""
+	Converts the window selection parameter into points based on the time step of the data.
+
+	Equivalent to :func:`pyms.GCMS.Function.ic_window_points`, but does not require an IonChromatogram.
+
+	:param time_step: The time step of the data, in seconds
+	:type time_step: float
+	:param window: The window selection parameter. This can be an integer or time string.
+		If integer, taken as the number of points. If a string, must of the form
+		"<NUMBER>s" or "<NUMBER>m", specifying a time in seconds or minutes, respectively
+	:type window: int or str
+	:param half_window: Specifies whether to return half-window
+	:type half_window: bool, optional
+
+	:rtype: int
+	"""
+
+	if not isinstance(window, (int, str)):
+		raise TypeError("'window' must be either an integer or a string")
+
+	if isinstance(window, int):
+		if half_window:
+			if window % 2 == 0:
+				raise ValueError("window must be an odd number of points")
+			else:
+				points = int(math.floor(window * 0.5))
+		else:
+			points = window
+	else:
+		time = time_str_secs(window)
+
+		if half_window:
+			time = time * 0.5
+
+		points = int(math.floor(time / time_step))
+
+	if half_window:
+		if points < 1:
+			raise ValueError(f"window too small (half window={points:d})")
+	else:
+		if points < 2:
+			raise ValueError(f"window too small (window={points})")
+
+	return points
+
+
+def sav_gol_coefficients(half_window, degree=SAV_GOL_DEGREE):
+	"""
+	Calculates the coefficients for a symmetric Savitzky-Golay smoothing filter,
+	in the same way as :mod:`pyms.Noise.SavitzkyGolay`.
+
+	:param half_window: Means that 2*half_window+1 values contribute to the smoother
+	:type half_window: int
+	:param degree: The degree of the fitting polynomial
+	:type degree: int, optional
+
+	:rtype: numpy.ndarray
+	"""
+
+	offsets = numpy.arange(-half_window, half_window + 1, dtype=float)
+	A = numpy.power.outer(offsets, numpy.arange(degree + 1))
+
+	# Row 0 of inv(A^T A), by Cholesky decomposition and resubstitution
+	D = numpy.linalg.cholesky(numpy.dot(A.transpose(), A))
+	rhs = numpy.zeros((degree + 1,), float)
+	rhs[0] = 1
+	wvec = numpy.linalg.solve(D.transpose(), numpy.linalg.solve(D, rhs))
+
+	return numpy.dot(A, wvec)
+
+
+def savitzky_golay_array(intensity_array, window=SAV_GOL_WINDOW, degree=SAV_GOL_DEGREE, time_step=None):
+	"""
+	Applies a Savitzky-Golay filter to every ion chromatogram in an intensity array at once.
+
+	:param intensity_array: Array of intensities, with one row per scan and one column per m/z
+	:type intensity_array: numpy.ndarray
+	:param window: The window selection parameter. See :func:`window_points`
+	:type window: int or str, optional
+	:param degree: The degree of the fitting polynomial
+	:type degree: int, optional
+	:param time_step: The time step of the data, in seconds. Required if ``window`` is a time string
+	:type time_step: float, optional
+
+	:return: The smoothed intensity array
+	:rtype: numpy.ndarray
+	"""
+
+	coeff = sav_gol_coefficients(window_points(time_step, window, half_window=True), degree)
+
+	# Zero-padded at the edges, the same as numpy.convolve in pyms
+	return ndimage.convolve1d(
+			numpy.asarray(intensity_array, dtype=float), coeff[::-1],
+			axis=0, mode="constant", cval=0.0,
+			)
+
+
+def tophat_array(intensity_array, struct, time_step):
+	"""
+	Applies Top-hat baseline correction to every ion chromatogram in an intensity array at once.
+
+	:param intensity_array: Array of intensities, with one row per scan and one column per m/z
+	:type intensity_array: numpy.ndarray
+	:param struct: Top-hat structural element as a time string
+	:type struct: str
+	:param time_step: The time step of the data, in seconds
+	:type time_step: float
+
+	:return: The baseline corrected intensity array
+	:rtype: numpy.ndarray
+	"""
+
+	struct_pts = window_points(time_step, struct)
+
+	# A flat structural element spanning ``struct_pts`` scans and a single m/z,
+	# so each ion chromatogram is corrected independently
+	footprint = numpy.ones((struct_pts, 1), dtype=bool)
+
+	return ndimage.white_tophat(numpy.asarray(intensity_array, dtype=float), footprint=footprint)
+
+
+def filter_intensity_matrix(intensity_matrix, enable_sav_gol=True, enable_tophat=True, tophat_struct=None):
+	"""
+	Perform Savitzky-Golay smoothing and Top-hat baseline correction on
+	the whole intensity matrix in a single pass along the time axis.
+
+	Gives the same result as calling :func:`pyms.Noise.SavitzkyGolay.savitzky_golay`
+	and :func:`pyms.TopHat.tophat` on each ion chromatogram in turn, to within
+	floating point rounding of the smoothing step. Top-hat correction is identical.
+
+	:param intensity_matrix:
+	:type intensity_matrix: pyms.IntensityMatrix.IntensityMatrix
+	:param enable_sav_gol: Whether Savitzky-Golay smoothing should be performed
+	:type enable_sav_gol: bool, optional
+	:param enable_tophat: Whether Top-hat baseline correction should be performed
+	:type enable_tophat: bool, optional
+	:param tophat_struct: Top-hat structural element as a time string
+	:type tophat_struct: str, optional
+
+	:return: A new intensity matrix containing the filtered data
+	:rtype: pyms.IntensityMatrix.IntensityMatrix
+	"""
+
+	time_list = intensity_matrix.time_list
+	intensity_array = intensity_matrix.intensity_array
+
+	# The same time step as pyms.IonChromatogram.IonChromatogram
+	time_step = numpy.diff(time_list).mean()
+
+	if enable_sav_gol:
+		# Note that Turbomass does not use smoothing for qualitative method.
+		intensity_array = savitzky_golay_array(intensity_array, time_step=time_step)
+
+	if enable_tophat:
+		# Top-hat baseline Correction seems to bring down noise,
+		#  		retaining shapes, but keeps points on actual peaks
+		if tophat_struct:
+			intensity_array = tophat_array(intensity_array, tophat_struct, time_step)
+		else:
+			struct_pts = int(round(len(time_list) * 0.2))
+			intensity_array = ndimage.white_tophat(intensity_array, footprint=numpy.ones((struct_pts, 1), dtype=bool))
+
+	return IntensityMatrix(time_list, intensity_matrix.mass_list, intensity_array)
+
+
+if __name__ == "__main__":
+	# Benchmark against the per-IC filtering, using a typical sized dataset
+	# stdlib
+	import timeit
+
+	# 3rd party
+	from pyms.Noise.SavitzkyGolay import savitzky_golay
+	from pyms.TopHat import tophat
+
+	n_scans, n_mz = 3000, 450
+
+	rng = numpy.random.RandomState(1234)
+	im = IntensityMatrix(
+			[float(x) for x in numpy.arange(n_scans) * 0.5 + 180],
+			[float(x) for x in range(50, 50 + n_mz)],
+			rng.gamma(1.0, 1000.0, size=(n_scans, n_mz)),
+			)
+
+	def per_ic():
+		for ii in range(n_mz):
+			ic = im.get_ic_at_index(ii)
+			ic = savitzky_golay(ic)
+			ic = tophat(ic, struct="1.5m")
+			im.set_ic_at_index(ii, ic)
+
+	def whole_matrix():
+		return filter_intensity_matrix(im, tophat_struct="1.5m")
+
+	filtered = whole_matrix().intensity_array
+	per_ic_time = timeit.timeit(per_ic, number=1)
+	print(f"Maximum difference from per-IC filtering: {numpy.abs(filtered - im.intensity_array).max()}")
+
+	matrix_time = min(timeit.repeat(whole_matrix, number=1, repeat=3))
+	print(f"Per-IC filtering:       {per_ic_time:.3f} s")
+	print(f"Whole matrix filtering: {matrix_time:.3f} s ({per_ic_time / matrix_time:.1f}x faster)")
@@ -26,10 +26,8 @@
 # stdlib
 import os
 
-# 3rd party
-from mathematical.utils import rounders
-
 # this package
+from GSMatch.utils.pynist import write_msp
 from GuiV2.GSMatch2_Core.Config import internal_config
 
 
@@ -45,10 +43,24 @@ def create_msp(sample_name, mass_list, mass_spec):
 	:type mass_spec:
 	"""
 	
-	# print(os.path.join(internal_config.msp_dir, sample_name + ".MSP"))
-	msp_file = open(os.path.join(internal_config.msp_dir, sample_name + ".MSP"), "w")
-	msp_file.write("Name: {}\n".format(sample_name))
-	msp_file.write("Num Peaks: {}\n".format(len(mass_list)))
-	for mass, intensity in zip(mass_list, mass_spec):
-		msp_file.write("{} {},\n".format(rounders(mass, "0.0"), intensity))
-	msp_file.close()
+	write_msp(os.path.join(internal_config.msp_dir, sample_name + ".MSP"), [(sample_name, mass_list, mass_spec)])
+
+
+def create_multi_msp(name, spectra):
+	"""
+	Generate a single .MSP file containing several spectra,
+	so that NIST MS Search can search them all at once
+
+	:param name: The name of the MSP file
+	:type name: str
+	:param spectra: ``(spectrum name, mass spectrum)`` tuples. May be a generator
+	:type spectra: iterable of tuple
+
+	:return: The number of spectra written
+	:rtype: int
+	"""
+	
+	return write_msp(
+			os.path.join(internal_config.msp_dir, name + ".MSP"),
+			((spectrum_name, mass_spec.mass_list, mass_spec.mass_spec) for spectrum_name, mass_spec in spectra),
+			)
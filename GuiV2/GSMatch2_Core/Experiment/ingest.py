@@ -0,0 +1,471 @@
+#  !/usr/bin/env python
+#   -*- coding: utf-8 -*-
+#
+#  ingest.py
+#
+#  This file is part of GunShotMatch
+#
+#  Copyright © 2020 Dominic Davis-Foster <dominic@davis-foster.co.uk>
+#
+#  GunShotMatch is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  GunShotMatch is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Intensity matrix binning based on PyMassSpec
+#  Copyright (C) 2005-2012 Vladimir Likic
+#
+
+# 3rd party
+import numpy
+from pyms.GCMS.Class import GCMS_data, IonChromatogram
+from pyms.IntensityMatrix import IntensityMatrix
+from pyms.Spectrum import Scan
+
+# this package
+from GuiV2.GSMatch2_Core.IDs import ID_Format_ANDI, ID_Format_jcamp, ID_Format_mzML
+
+
+# The number of scans to bin into the intensity matrix at once
+BIN_CHUNK_SIZE = 256
+
+
+class ScanData:
+	"""
+	The raw scans from a datafile, stored as flat arrays rather than as
+	one :class:`pyms.Spectrum.Scan` object per scan.
+
+	The scans are stored in compressed sparse row form, the same as in Experiment files.
+	See :mod:`GuiV2.GSMatch2_Core.Experiment.payload`.
+	"""
+
+	def __init__(self, time_list, scan_index, scan_mass, scan_intensity):
+		"""
+		:param time_list: The retention time of each scan, in seconds
+		:type time_list: numpy.ndarray
+		:param scan_index: The offset of the first point of each scan within ``scan_mass``
+			and ``scan_intensity``, followed by the total number of points
+		:type scan_index: numpy.ndarray
+		:param scan_mass: The m/z values of every scan, concatenated
+		:type scan_mass: numpy.ndarray
+		:param scan_intensity: The intensities of every scan, concatenated
+		:type scan_intensity: numpy.ndarray
+		"""
+
+		self.time_array = numpy.asarray(time_list, dtype=float)
+		self.scan_index = numpy.asarray(scan_index, dtype=numpy.int64)
+		self.scan_mass = scan_mass
+		self.scan_intensity = scan_intensity
+
+		if len(self.scan_index) != len(self.time_array) + 1:
+			raise ValueError("'scan_index' must have one more element than 'time_list'")
+
+	@classmethod
+	def from_gcms_data(cls, gcms_data):
+		"""
+		Construct a :class:`ScanData` object from a :class:`pyms.GCMS.Class.GCMS_data` object
+
+		:param gcms_data:
+		:type gcms_data: pyms.GCMS.Class.GCMS_data
+
+		:rtype: ScanData
+		"""
+
+		scan_list = gcms_data.scan_list
+
+		scan_index = numpy.zeros(len(scan_list) + 1, dtype=numpy.int64)
+		numpy.cumsum([len(scan) for scan in scan_list], out=scan_index[1:])
+
+		scan_mass = numpy.empty(scan_index[-1], dtype=float)
+		scan_intensity = numpy.empty(scan_index[-1], dtype=float)
+
+		for idx, scan in enumerate(scan_list):
+			scan_mass[scan_index[idx]:scan_index[idx + 1]] = scan.mass_list
+			scan_intensity[scan_index[idx]:scan_index[idx + 1]] = scan.intensity_list
+
+		return cls(gcms_data.time_list, scan_index, scan_mass, scan_intensity)
+
+	def to_gcms_data(self):
+		"""
+		Returns a :class:`pyms.GCMS.Class.GCMS_data` object containing the scans
+
+		:rtype: pyms.GCMS.Class.GCMS_data
+		"""
+
+		return GCMS_data(self.time_list, self.scan_list)
+
+	@property
+	def n_scans(self):
+		"""
+		Returns the number of scans
+
+		:rtype: int
+		"""
+
+		return len(self.time_array)
+
+	def __len__(self):
+		return self.n_scans
+
+	@property
+	def time_list(self):
+		"""
+		Returns the retention time of each scan, in seconds
+
+		:rtype: list of float
+		"""
+
+		return self.time_array.tolist()
+
+	@property
+	def point_counts(self):
+		"""
+		Returns the number of m/z values in each scan
+
+		:rtype: numpy.ndarray
+		"""
+
+		return numpy.diff(self.scan_index)
+
+	def statistics(self):
+		"""
+		Returns summary statistics for the scans
+
+		:return: Dictionary with the keys ``n_scans``, ``rt_range`` (in seconds),
+			``time_step`` and ``time_step_stdev`` (in seconds), ``mz_range``,
+			and ``n_mz_mean`` and ``n_mz_median`` (the number of m/z values per scan)
+		:rtype: dict
+		"""
+
+		time_diff = numpy.diff(self.time_array)
+		point_counts = self.point_counts
+
+		return {
+				"n_scans": self.n_scans,
+				"rt_range": [float(self.time_array.min()), float(self.time_array.max())],
+				"time_step": float(time_diff.mean()),
+				"time_step_stdev": float(time_diff.std(ddof=1)),
+				"mz_range": [self.min_mass, self.max_mass],
+				"n_mz_mean": float(point_counts.mean()),
+				"n_mz_median": float(numpy.median(point_counts)),
+				}
+
+	def get_scan(self, idx):
+		"""
+		Returns the scan at the given index
+
+		:param idx:
+		:type idx: int
+
+		:rtype: pyms.Spectrum.Scan
+		"""
+
+		start, end = self.scan_index[idx], self.scan_index[idx + 1]
+		return Scan(self.scan_mass[start:end].tolist(), self.scan_intensity[start:end].tolist())
+
+	@property
+	def scan_list(self):
+		"""
+		Returns a list of :class:`pyms.Spectrum.Scan` objects.
+
+		The objects are created each time this property is accessed,
+		so should be avoided for large datasets.
+
+		:rtype: list of pyms.Spectrum.Scan
+		"""
+
+		return [self.get_scan(idx) for idx in range(self.n_scans)]
+
+	@property
+	def min_mass(self):
+		"""
+		Returns the minimum m/z value in the data
+
+		:rtype: float
+		"""
+
+		return float(numpy.min(self.scan_mass))
+
+	@property
+	def max_mass(self):
+		"""
+		Returns the maximum m/z value in the data
+
+		:rtype: float
+		"""
+
+		return float(numpy.max(self.scan_mass))
+
+	def get_tic(self):
+		"""
+		Returns the Total Ion Chromatogram
+
+		:rtype: pyms.GCMS.Class.IonChromatogram
+		"""
+
+		return IonChromatogram(tic_from_csr(self.scan_index, self.scan_intensity), self.time_list)
+
+	def build_intensity_matrix_i(self, bin_left=-0.3, bin_right=0.7):
+		"""
+		Sets the full intensity matrix with integer bins.
+
+		Equivalent to :func:`pyms.IntensityMatrix.build_intensity_matrix_i`, but bins the
+		data straight into a preallocated array without creating :class:`pyms.Spectrum.Scan` objects.
+
+		:param bin_left: Left bin boundary offset
+		:type bin_left: float, optional
+		:param bin_right: Right bin boundary offset
+		:type bin_right: float, optional
+
+		:rtype: pyms.IntensityMatrix.IntensityMatrix
+		"""
+
+		bin_left = abs(bin_left)
+		bin_right = abs(bin_right)
+
+		if not abs(bin_left + bin_right - 1) < 1.0e-6:
+			raise ValueError("there should be no gaps or overlap.")
+
+		# To convert to int range, ensure bounds are < 1
+		bin_left = bin_left - int(bin_left)
+
+		# Calculate integer min mass. Equal to PyMassSpec's ``int(min_mass + 1 - bin_right)``,
+		# as the bins have no gaps or overlap
+		min_mass = int(self.min_mass + bin_left)
+		max_mass = self.max_mass
+
+		n_bins = int(max_mass + bin_left - min_mass) + 1
+		mass_list = [ii + min_mass for ii in range(n_bins)]
+
+		intensity_array = numpy.zeros((self.n_scans, n_bins), dtype=float)
+
+		for start in range(0, self.n_scans, BIN_CHUNK_SIZE):
+			end = min(start + BIN_CHUNK_SIZE, self.n_scans)
+			first_point, last_point = self.scan_index[start], self.scan_index[end]
+
+			# The row (relative to the start of the chunk) and column of each point
+			rows = numpy.repeat(numpy.arange(end - start), numpy.diff(self.scan_index[start:end + 1]))
+			cols = (self.scan_mass[first_point:last_point] + bin_left - min_mass).astype(numpy.int64)
+
+			intensity_array[start:end] = numpy.bincount(
+					rows * n_bins + cols,
+					weights=self.scan_intensity[first_point:last_point],
+					minlength=(end - start) * n_bins,
+					).reshape(end - start, n_bins)
+
+		return IntensityMatrix(self.time_list, mass_list, intensity_array)
+
+
+def tic_from_csr(scan_index, scan_intensity):
+	"""
+	Returns the total intensity of each scan
+
+	:param scan_index:
+	:type scan_index: numpy.ndarray
+	:param scan_intensity:
+	:type scan_intensity: numpy.ndarray
+
+	:rtype: numpy.ndarray
+	"""
+
+	scan_ids = numpy.repeat(numpy.arange(len(scan_index) - 1), numpy.diff(scan_index))
+	return numpy.bincount(scan_ids, weights=scan_intensity, minlength=len(scan_index) - 1)
+
+
+class _GrowableArray:
+	"""
+	A 1D array that can be appended to, growing geometrically when full
+	"""
+
+	def __init__(self, capacity=1048576, dtype=float):
+		self._array = numpy.empty(max(1, int(capacity)), dtype=dtype)
+		self._size = 0
+
+	def extend(self, values):
+		values = numpy.asarray(values)
+		new_size = self._size + len(values)
+
+		if new_size > len(self._array):
+			new_array = numpy.empty(max(new_size, len(self._array) * 2), dtype=self._array.dtype)
+			new_array[:self._size] = self._array[:self._size]
+			self._array = new_array
+
+		self._array[self._size:new_size] = values
+		self._size = new_size
+
+	def finalise(self):
+		"""
+		Returns the array, trimmed to its length
+		"""
+
+		if self._size == len(self._array):
+			return self._array
+
+		return self._array[:self._size].copy()
+
+
+def read_andi(filename, chunk_size=1048576):
+	"""
+	Read the scans from an ANDI-MS (netCDF) file.
+
+	The m/z values and intensities are copied from the file in chunks
+	into arrays preallocated from the number of points in the file.
+
+	:param filename:
+	:type filename: str or pathlib.Path
+	:param chunk_size: The number of points to copy at once
+	:type chunk_size: int, optional
+
+	:rtype: ScanData
+	"""
+
+	from netCDF4 import Dataset
+
+	print(f" -> Reading netCDF file '{filename}'")
+
+	with Dataset(str(filename), 'r') as rootgrp:
+		time_list = numpy.asarray(rootgrp.variables["scan_acquisition_time"][:], dtype=float)
+		point_count = numpy.asarray(rootgrp.variables["point_count"][:], dtype=numpy.int64)
+
+		scan_index = numpy.zeros(len(point_count) + 1, dtype=numpy.int64)
+		numpy.cumsum(point_count, out=scan_index[1:])
+
+		mass_values = rootgrp.variables["mass_values"]
+		intensity_values = rootgrp.variables["intensity_values"]
+		n_points = int(scan_index[-1])
+
+		scan_mass = numpy.empty(n_points, dtype=float)
+		scan_intensity = numpy.empty(n_points, dtype=float)
+
+		for start in range(0, n_points, chunk_size):
+			end = min(start + chunk_size, n_points)
+			scan_mass[start:end] = mass_values[start:end]
+			scan_intensity[start:end] = intensity_values[start:end]
+
+	return ScanData(time_list, scan_index, scan_mass, scan_intensity)
+
+
+def read_mzml(filename):
+	"""
+	Read the MS1 scans from an mzML file, one spectrum at a time.
+
+	:param filename:
+	:type filename: str or pathlib.Path
+
+	:rtype: ScanData
+	"""
+
+	import pymzml
+
+	print(f" -> Reading mzML file '{filename}'")
+
+	reader = pymzml.run.Reader(str(filename))
+
+	try:
+		n_spectra = reader.get_spectrum_count()
+	except Exception:
+		n_spectra = None
+
+	time_list = _GrowableArray(n_spectra or 4096)
+	point_counts = _GrowableArray(n_spectra or 4096, dtype=numpy.int64)
+	scan_mass = _GrowableArray()
+	scan_intensity = _GrowableArray()
+
+	for spectrum in reader:
+		if spectrum.ms_level != 1:
+			continue
+
+		mass_array = numpy.asarray(spectrum.mz, dtype=float)
+		intensity_array = numpy.asarray(spectrum.i, dtype=float)
+
+		time_list.extend([spectrum.scan_time_in_minutes() * 60.0])
+		point_counts.extend([len(mass_array)])
+		scan_mass.extend(mass_array)
+		scan_intensity.extend(intensity_array)
+
+	point_counts = point_counts.finalise()
+	scan_index = numpy.zeros(len(point_counts) + 1, dtype=numpy.int64)
+	numpy.cumsum(point_counts, out=scan_index[1:])
+
+	return ScanData(time_list.finalise(), scan_index, scan_mass.finalise(), scan_intensity.finalise())
+
+
+def read_jcamp(filename):
+	"""
+	Read the scans from a JCAMP-DX file.
+
+	JCAMP-DX files are text, so are read with :func:`pyms.GCMS.IO.JCAMP.JCAMP_reader`
+	and then converted.
+
+	:param filename:
+	:type filename: str or pathlib.Path
+
+	:rtype: ScanData
+	"""
+
+	from pyms.GCMS.IO.JCAMP import JCAMP_reader
+
+	return ScanData.from_gcms_data(JCAMP_reader(str(filename)))
+
+
+def read_datafile(filename, filetype):
+	"""
+	Read the scans from the given datafile
+
+	:param filename:
+	:type filename: str or pathlib.Path
+	:param filetype: The ID of the filetype
+	:type filetype: int
+
+	:return: The scans, or ``None`` if the filetype is not supported
+	:rtype: ScanData or None
+	"""
+
+	if filetype == ID_Format_jcamp:
+		return read_jcamp(filename)
+	elif filetype == ID_Format_mzML:
+		return read_mzml(filename)
+	elif filetype == ID_Format_ANDI:
+		return read_andi(filename)
+	else:
+		return None
+
+
+if __name__ == "__main__":
+	# Check the intensity matrix against PyMassSpec's, for random scans with non-integer m/z values
+	# 3rd party
+	from pyms.IntensityMatrix import build_intensity_matrix_i
+
+	rng = numpy.random.RandomState(1234)
+
+	n_points = rng.randint(50, 200, 500)
+	scan_index = numpy.concatenate(([0], numpy.cumsum(n_points)))
+
+	# m/z values in ascending order within each scan
+	scan_mass = rng.uniform(45.0, 500.0, scan_index[-1])
+	scan_mass = scan_mass[numpy.lexsort((scan_mass, numpy.repeat(numpy.arange(len(n_points)), n_points)))]
+
+	scan_data = ScanData(
+			numpy.arange(len(n_points)) * 0.25 + 180,
+			scan_index,
+			scan_mass,
+			rng.uniform(0, 1e5, scan_index[-1]),
+			)
+
+	expected = build_intensity_matrix_i(scan_data.to_gcms_data())
+	actual = scan_data.build_intensity_matrix_i()
+
+	assert list(actual.mass_list) == list(expected.mass_list)
+	difference = numpy.abs(numpy.asarray(actual.intensity_array) - numpy.asarray(expected.intensity_array)).max()
+	print(f"Largest difference from PyMassSpec: {difference:0.2e}")
+	assert difference < 1e-6
@@ -0,0 +1,186 @@
+#  !/usr/bin/env python
+#   -*- coding: utf-8 -*-
+#
+#  payload.py
+#
+#  This file is part of GunShotMatch
+#
+#  Copyright © 2020 Dominic Davis-Foster <dominic@davis-foster.co.uk>
+#
+#  GunShotMatch is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  GunShotMatch is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Columnar storage of the raw data and intensity matrix within Experiment files.
+#
+#  From version 1.1.0 of the Experiment file format the raw scans and the
+#  intensity matrix are stored as ``.npy`` files inside the (uncompressed)
+#  Experiment tarfile, rather than as pickled PyMassSpec objects.
+#  As tarfile members start on 512 byte boundaries these can be memory-mapped
+#  directly from the Experiment file.
+#
+#  The raw scans are stored in compressed sparse row form:
+#
+#  * ``scan_time.npy``: The retention time of each scan, in seconds
+#  * ``scan_index.npy``: The offset of the first point of each scan within
+#    ``scan_mass.npy`` and ``scan_intensity.npy``, followed by the total number of points
+#  * ``scan_mass.npy``: The m/z values of every scan, concatenated
+#  * ``scan_intensity.npy``: The intensities of every scan, concatenated
+#
+#  The intensity matrix is stored as:
+#
+#  * ``time_list.npy``: The retention time of each scan, in seconds
+#  * ``mass_list.npy``: The m/z value of each column
+#  * ``intensity_array.npy``: The intensities, with one row per scan and one column per m/z
+#
+
+# 3rd party
+import numpy
+from pyms.IntensityMatrix import IntensityMatrix
+
+# this package
+from GuiV2.GSMatch2_Core.Experiment.ingest import ScanData
+from GuiV2.GSMatch2_Core.io import add_array_to_archive, archive_contains, load_array_from_archive
+
+
+# The version of the Experiment file format that introduced the columnar payload
+PAYLOAD_VERSION = "1.1.0"
+
+
+def has_columnar_payload(archive):
+	"""
+	Returns whether the given Experiment file uses the columnar payload
+
+	:param archive:
+	:type archive: str or pathlib.Path or io.BytesIO or tarfile.TarFile
+
+	:rtype: bool
+	"""
+
+	return archive_contains(archive, "intensity_array.npy")
+
+
+def store_intensity_matrix(archive, intensity_matrix):
+	"""
+	Add the given intensity matrix to the Experiment file
+
+	:param archive:
+	:type archive: tarfile.TarFile
+	:param intensity_matrix:
+	:type intensity_matrix: pyms.IntensityMatrix.IntensityMatrix
+	"""
+
+	add_array_to_archive(archive, numpy.asarray(intensity_matrix.time_list, dtype=float), "time_list.npy")
+	add_array_to_archive(archive, numpy.asarray(intensity_matrix.mass_list, dtype=float), "mass_list.npy")
+	add_array_to_archive(archive, intensity_matrix.intensity_array, "intensity_array.npy")
+
+
+def load_intensity_matrix(archive, mmap=True):
+	"""
+	Load the intensity matrix from the Experiment file
+
+	:param archive:
+	:type archive: str or pathlib.Path or io.BytesIO or tarfile.TarFile
+	:param mmap: Whether to memory-map the intensity array if possible. Default True
+	:type mmap: bool, optional
+
+	:rtype: pyms.IntensityMatrix.IntensityMatrix
+	"""
+
+	time_list = load_array_from_archive(archive, "time_list.npy", mmap=False).tolist()
+	mass_list = load_array_from_archive(archive, "mass_list.npy", mmap=False).tolist()
+	intensity_array = load_array_from_archive(archive, "intensity_array.npy", mmap=mmap)
+
+	return IntensityMatrix(time_list, mass_list, intensity_array)
+
+
+def unmap_intensity_matrix(intensity_matrix):
+	"""
+	Returns a new intensity matrix with the intensity array read into memory,
+	in case it is memory-mapped from an Experiment file.
+
+	This must be done before the Experiment file is overwritten.
+
+	:param intensity_matrix:
+	:type intensity_matrix: pyms.IntensityMatrix.IntensityMatrix
+
+	:rtype: pyms.IntensityMatrix.IntensityMatrix
+	"""
+
+	# intensity_array returns an in-memory copy of the array
+	return IntensityMatrix(
+			intensity_matrix.time_list,
+			intensity_matrix.mass_list,
+			intensity_matrix.intensity_array,
+			)
+
+
+def store_gcms_data(archive, gcms_data):
+	"""
+	Add the raw scans to the Experiment file
+
+	:param archive:
+	:type archive: tarfile.TarFile
+	:param gcms_data:
+	:type gcms_data: GuiV2.GSMatch2_Core.Experiment.ingest.ScanData or pyms.GCMS.Class.GCMS_data
+	"""
+
+	if not isinstance(gcms_data, ScanData):
+		gcms_data = ScanData.from_gcms_data(gcms_data)
+
+	add_array_to_archive(archive, gcms_data.time_array, "scan_time.npy")
+	add_array_to_archive(archive, gcms_data.scan_index, "scan_index.npy")
+	add_array_to_archive(archive, gcms_data.scan_mass, "scan_mass.npy")
+	add_array_to_archive(archive, gcms_data.scan_intensity, "scan_intensity.npy")
+
+
+def unmap_gcms_data(gcms_data):
+	"""
+	Returns a new :class:`~GuiV2.GSMatch2_Core.Experiment.ingest.ScanData` object with the scans
+	read into memory, in case they are memory-mapped from an Experiment file.
+
+	This must be done before the Experiment file is overwritten.
+
+	:param gcms_data:
+	:type gcms_data: GuiV2.GSMatch2_Core.Experiment.ingest.ScanData
+
+	:rtype: GuiV2.GSMatch2_Core.Experiment.ingest.ScanData
+	"""
+
+	return ScanData(
+			gcms_data.time_array,
+			gcms_data.scan_index,
+			numpy.array(gcms_data.scan_mass),
+			numpy.array(gcms_data.scan_intensity),
+			)
+
+
+def load_gcms_data(archive, mmap=True):
+	"""
+	Load the raw scans from the Experiment file
+
+	:param archive:
+	:type archive: str or pathlib.Path or io.BytesIO or tarfile.TarFile
+	:param mmap: Whether to memory-map the arrays if possible. Default True
+	:type mmap: bool, optional
+
+	:rtype: GuiV2.GSMatch2_Core.Experiment.ingest.ScanData
+	"""
+
+	return ScanData(
+			load_array_from_archive(archive, "scan_time.npy", mmap=False),
+			load_array_from_archive(archive, "scan_index.npy", mmap=False),
+			load_array_from_archive(archive, "scan_mass.npy", mmap=mmap),
+			load_array_from_archive(archive, "scan_intensity.npy", mmap=mmap),
+			)
@@ -488,6 +488,22 @@ Please choose a different project.""",
 				)
 			return
 		
+		n_experiments = len(project.experiment_file_list)
+		
+		if n_experiments:
+			prog_dialog = wx.ProgressDialog(
+					"Opening Project", f"Loading Experiments for {project.name}",
+					maximum=n_experiments, parent=self, style=wx.PD_APP_MODAL | wx.PD_AUTO_HIDE,
+					)
+			
+			def update_prog_dialog(n_done, n_total, experiment_name):
+				prog_dialog.Update(n_done, f"Loaded {experiment_name} ({n_done} of {n_total})")
+			
+			try:
+				project.load_experiments(progress_callback=update_prog_dialog)
+			finally:
+				prog_dialog.Destroy()
+		
 		page = self.notebook.add_project(project)
 		self.opened_projects[project.name] = page
 		self.project_navigator.add_project(project)
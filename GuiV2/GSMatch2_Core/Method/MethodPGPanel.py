@@ -224,6 +224,11 @@ class MethodPGPanel(wx.Panel):
 				label="Minimum Peaks")
 		self._properties.add(min_peaks_property)
 		
+		engine_property = self.add_string_property(
+				name="alignment_engine",
+				label="Alignment Engine")
+		self._properties.add(engine_property)
+		
 		# ---------------------------------------------------------------------
 		# Compound Identification
 		self.new_category("Compound Identification")
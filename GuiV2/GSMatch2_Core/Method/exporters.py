@@ -72,6 +72,7 @@ class MethodPDFExporter(PDFExporterBase):
 				["Retention Time Modulation", self.method.alignment_rt_modulation, "seconds"],
 				["Gap Penalty", self.method.alignment_gap_penalty, ""],
 				["Minimum Peaks", self.method.alignment_min_peaks, ""],
+				["Alignment Engine", self.method.alignment_engine, ""],
 				]
 		
 		ident_data = [
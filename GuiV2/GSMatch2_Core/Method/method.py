@@ -223,6 +223,10 @@ class Method:
 		MethodProperty(self, "alignment", "gap_penalty", 0.3, float)
 		MethodProperty(self, "alignment", "min_peaks", 2, int)
 		
+		MethodProperty(self, "alignment", "engine", "pyms", str)
+		# "pyms" for PyMassSpec's pairwise alignment, or "banded" for the faster
+		# alignment in GuiV2.GSMatch2_Core.Project.alignment, which gives the same results
+		
 		# Project Comparison Settings
 		MethodProperty(self, "comparison", "a", 0.05, float)
 		MethodProperty(self, "comparison", "rt_modulation", 2.5, float)
@@ -459,6 +463,7 @@ class Method:
 		self._alignment_rt_modulation.save_property(self.Config)
 		self._alignment_gap_penalty.save_property(self.Config)
 		self._alignment_min_peaks.save_property(self.Config)
+		self._alignment_engine.save_property(self.Config)
 		# self.Config.set("alignment", "rt_modulation", str(self.rt_modulation))
 		# self.Config.set("alignment", "gap_penalty", str(self.gap_penalty))
 		# self.Config.set("alignment", "min_peaks", str(self.min_peaks))
@@ -514,6 +519,9 @@ descriptions = {
 		"alignment_gap_penalty": "",
 		"alignment_min_peaks": "Only aligned peaks that appear in more samples than this value will be "
 							   "included in the results.",
+		"alignment_engine": "The method used to align the peaks. Either `pyms`, for PyMassSpec's "
+							"pairwise alignment, or `banded`, which gives the same alignment faster "
+							"by only comparing peaks with similar retention times.",
 		
 		"ident_min_match_factor": "When identifying compounds any hits where BOTH the Match "
 								  "Factor and the Reverse Match Factor are less this value "
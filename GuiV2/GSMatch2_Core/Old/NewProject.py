@@ -48,7 +48,6 @@ import traceback
 import itertools
 
 from collections import Counter
-from multiprocessing import Pool
 
 # 3rd party
 import numpy
@@ -86,6 +85,7 @@ from chemistry_tools import SpectrumSimilarity
 from GSMatch.utils.pynist import *
 from GSMatch.utils import DirectoryHash, pynist
 from GSMatch.GSMatch_Core.PeakAlignment import get_ms_alignment, get_peak_alignment
+from GuiV2.GSMatch2_Core import parallel
 
 
 sys.path.append("..")
@@ -708,8 +708,7 @@ class NewProject:
 			similarity_list = []
 			rows_list.append((ms_data.iloc[row_idx], perms))
 		
-		with Pool(len(ms_data)) as p:
-			ms_comparison = p.map(single_ms_comparison, rows_list)
+		ms_comparison = parallel.map(single_ms_comparison, rows_list)
 		
 		# TODO: linear mode
 		
@@ -932,9 +931,7 @@ in the hits, and the mass spectral similarity between samples.",
 		
 		if len(rt_data) > 20:
 			arguments = [(sample, rt_data, ms_data, path) for sample in rt_data.columns.values]
-			with Pool(len(arguments)) as p:
-				
-				p.map(self.spectrum_image_wrapper, arguments)
+			parallel.map(self.spectrum_image_wrapper, arguments)
 		else:
 			for sample in rt_data.columns.values:
 				self.generate_spectrum_image(sample, rt_data, ms_data, path)
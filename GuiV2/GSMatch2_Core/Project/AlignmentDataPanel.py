@@ -170,11 +170,13 @@ class AlignmentDataPanel(wx.Panel):
 	def on_view_spectra(self, event):
 		row, col = self.alignment_table.GetDoubleClickedCell()
 		selected_experiment = self.project.experiment_name_list[col - 1]
-		retention_time = self.project.rt_alignment[selected_experiment][row]
+		peak_number = self.project.rt_alignment.index.values[row]
+		retention_time = self.project.rt_alignment[selected_experiment][peak_number]
+		peak_index = self.project.peak_index_alignment[selected_experiment][peak_number]
 		
 		print(
 				f"Now the Mass Spectrum needs to be opened for "
-				f"'{selected_experiment}' at retention time {retention_time}"
+				f"'{selected_experiment}' at retention time {retention_time} (peak {peak_index})"
 				)
 		
 		event.Skip()
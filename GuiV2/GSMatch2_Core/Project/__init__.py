@@ -29,6 +29,9 @@ from GuiV2.GSMatch2_Core.Project.compounds_data_panel import CompoundsDataPanel
 from GuiV2.GSMatch2_Core.Project.consolidate import ConsolidatedPeak, ConsolidatedSearchResult, ConsolidateEncoder
 from GuiV2.GSMatch2_Core.Project.DataViewer import DataViewer
 from GuiV2.GSMatch2_Core.Project.exporters import AlignmentPDFExporter, ConsolidatePDFExporter, InfoPDFExporter
+from GuiV2.GSMatch2_Core.Project.identify_pipeline import (
+	IdentificationCancelled, IdentificationPipeline, IdentificationProgress,
+	)
 from GuiV2.GSMatch2_Core.Project.NewProjectDialog import NewProjectDialog
 from GuiV2.GSMatch2_Core.Project.pdf_reports import ProjectReportPDFExporter
 from GuiV2.GSMatch2_Core.Project.project import (
@@ -50,6 +53,9 @@ __all__ = [
 		"AlignmentPDFExporter",
 		"ConsolidatePDFExporter",
 		"InfoPDFExporter",
+		"IdentificationCancelled",
+		"IdentificationPipeline",
+		"IdentificationProgress",
 		"NewProjectDialog",
 		"ProjectReportPDFExporter",
 		"align_in_separate_process",
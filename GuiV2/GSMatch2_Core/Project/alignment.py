@@ -0,0 +1,643 @@
+#  !/usr/bin/env python
+#   -*- coding: utf-8 -*-
+#
+#  alignment.py
+#
+#  This file is part of GunShotMatch
+#
+#  Copyright © 2020 Dominic Davis-Foster <dominic@davis-foster.co.uk>
+#
+#  GunShotMatch is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  GunShotMatch is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Progressive peak alignment restricted to a retention time band.
+#
+#  A drop-in alternative to ``pyms.DPA.PairwiseAlignment.PairwiseAlignment`` and
+#  ``align_with_tree``, giving the same alignment.
+#
+#  ``position_similarity`` in PyMassSpec scores any pair of peaks further apart than
+#  ``D * sqrt(-2 ln 0.001)`` as 1, the worst score. The score matrix is therefore
+#  calculated only for peaks within that band, with numpy. A match scoring more than
+#  twice the gap penalty is never better than two gaps, so the dynamic programming
+#  only visits the cells around the matches that score less than that.
+#
+#  The scores for each pair of Experiments, used to build the guide tree, are calculated
+#  in parallel. The guide tree can be saved and reused for the same Experiments and settings.
+#
+#  New Experiments can also be aligned to an existing alignment, one at a time,
+#  without aligning the existing Experiments again.
+#
+
+# stdlib
+import copy
+import hashlib
+import math
+
+# 3rd party
+import numpy
+
+# this package
+from GuiV2.GSMatch2_Core import parallel
+
+
+# Peaks further apart than this many multiples of D are given the worst score.
+# The same tolerance as pyms.DPA.PairwiseAlignment.position_similarity
+RT_CUTOFF = math.sqrt(-2.0 * math.log(0.001))
+
+# The number of pairs of peaks for which the spectra are compared at a time, to limit memory usage
+_PAIRS_PER_BLOCK = 20000
+
+
+class PositionArrays:
+	"""
+	The peaks in an alignment, as arrays
+
+	:param alignment:
+	:type alignment: pyms.DPA.Alignment.Alignment
+	"""
+
+	def __init__(self, alignment):
+		peakalgt = alignment.peakalgt
+
+		self.n_positions = len(peakalgt)
+
+		positions = []
+		rts = []
+		spectra = []
+
+		for position_idx, position in enumerate(peakalgt):
+			for peak in position:
+				if peak is not None:
+					positions.append(position_idx)
+					rts.append(peak.rt)
+					spectra.append(numpy.asarray(peak.mass_spectrum.mass_spec, dtype=float))
+
+		#: The index of the position of each peak
+		self.positions = numpy.array(positions, dtype=int)
+
+		#: The retention time of each peak
+		self.rts = numpy.array(rts, dtype=float)
+
+		#: The number of peaks at each position
+		self.counts = numpy.bincount(self.positions, minlength=self.n_positions)
+
+		# Mass spectra scaled to unit length, so the dot product is the cosine similarity.
+		# Empty spectra are left as zero, giving a similarity of 0 as in PyMassSpec
+		if spectra:
+			spectra = numpy.vstack(spectra)
+		else:
+			spectra = numpy.zeros((0, 0))
+
+		norms = numpy.sqrt(numpy.sum(spectra ** 2, axis=1))
+		norms[norms == 0] = 1
+
+		#: The mass spectrum of each peak, scaled to unit length
+		self.unit_spectra = spectra / norms[:, None]
+
+	def digest(self):
+		"""
+		Returns a hash of the retention times and mass spectra of the peaks.
+
+		:rtype: bytes
+		"""
+
+		sha = hashlib.sha256()
+		sha.update(self.positions.tobytes())
+		sha.update(self.rts.tobytes())
+		sha.update(self.unit_spectra.tobytes())
+		return sha.digest()
+
+
+def score_matrix(arrays1, arrays2, D):
+	"""
+	Calculates the score matrix between two alignments.
+
+	Gives the same scores as :func:`pyms.DPA.PairwiseAlignment.score_matrix`,
+	where 0 is the best score and 1 is the worst.
+
+	:param arrays1: The peaks in the first alignment
+	:type arrays1: PositionArrays
+	:param arrays2: The peaks in the second alignment
+	:type arrays2: PositionArrays
+	:param D: Retention time tolerance, in seconds
+	:type D: float
+
+	:rtype: numpy.ndarray
+	"""
+
+	cutoff = D * RT_CUTOFF
+
+	# The peaks in the second alignment within the cutoff of each peak in the first alignment.
+	# The window is widened slightly and then trimmed, so rounding gives the same pairs as PyMassSpec
+	order2 = numpy.argsort(arrays2.rts, kind="stable")
+	sorted_rts2 = arrays2.rts[order2]
+	window = cutoff * (1 + 1e-9) + 1e-9
+	starts = numpy.searchsorted(sorted_rts2, arrays1.rts - window, side="left")
+	stops = numpy.searchsorted(sorted_rts2, arrays1.rts + window, side="right")
+
+	lengths = stops - starts
+	peaks1 = numpy.repeat(numpy.arange(len(arrays1.rts)), lengths)
+	offsets = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+	peaks2 = order2[numpy.repeat(starts, lengths) + offsets]
+
+	delta = arrays1.rts[peaks1] - arrays2.rts[peaks2]
+	in_range = numpy.abs(delta) <= cutoff
+	peaks1, peaks2, delta = peaks1[in_range], peaks2[in_range], delta[in_range]
+
+	# Similarity of each pair of peaks within the cutoff
+	cos = numpy.empty(len(peaks1))
+	for start in range(0, len(peaks1), _PAIRS_PER_BLOCK):
+		block = slice(start, start + _PAIRS_PER_BLOCK)
+		cos[block] = numpy.einsum(
+				"ij,ij->i",
+				arrays1.unit_spectra[peaks1[block]],
+				arrays2.unit_spectra[peaks2[block]],
+				)
+
+	rtime = numpy.exp(-(delta / float(D)) ** 2 / 2.0)
+
+	n1, n2 = arrays1.n_positions, arrays2.n_positions
+	similarity = numpy.bincount(
+			arrays1.positions[peaks1] * n2 + arrays2.positions[peaks2],
+			weights=cos * rtime,
+			minlength=n1 * n2,
+			).reshape(n1, n2)
+
+	# Pairs of peaks outside of the cutoff each score 1
+	count = numpy.outer(arrays1.counts, arrays2.counts).astype(float)
+
+	with numpy.errstate(divide="ignore", invalid="ignore"):
+		scores = (count - similarity) / count
+
+	scores[count == 0] = 1.0
+
+	return scores
+
+
+def band_limits(S, gap):
+	"""
+	Returns the range of columns of the dynamic programming matrix to visit in each row.
+
+	The range covers every cell where two positions can be matched, and the cells before them,
+	and is widened so the visited cells form a connected band from the top left to the bottom right
+	of the matrix. Positions can only be matched where the score is no more than twice the gap penalty,
+	as otherwise leaving a gap in each alignment is better.
+
+	:param S: Score matrix
+	:type S: numpy.ndarray
+	:param gap: Gap penalty
+	:type gap: float
+
+	:return: The first and last columns to visit in each of the ``len(S) + 1`` rows
+	:rtype: tuple of numpy.ndarray
+	"""
+
+	n1, n2 = S.shape
+
+	first = numpy.full(n1 + 1, n2 + 1, dtype=int)
+	last = numpy.full(n1 + 1, -1, dtype=int)
+
+	rows, columns = numpy.nonzero(S <= 2 * gap)
+
+	# Cell (i + 1, j + 1) is the match of rows i and j of S, reached from cell (i, j)
+	for row_offset in (0, 1):
+		numpy.minimum.at(first, rows + row_offset, columns + row_offset)
+		numpy.maximum.at(last, rows + row_offset, columns + row_offset)
+
+	# The band starts at the top left and finishes at the bottom right
+	first[0] = 0
+	last[0] = max(last[0], 0)
+	first[n1] = min(first[n1], n2)
+	last[n1] = n2
+
+	# Bands must not move left going down, and each row must overlap the one above
+	last = numpy.maximum.accumulate(last)
+	first = numpy.minimum.accumulate(first[::-1])[::-1]
+	first[1:] = numpy.minimum(first[1:], last[:-1])
+	last = numpy.maximum(last, first)
+
+	return first, last
+
+
+def dp(S, gap_penalty):
+	"""
+	Solves optimal path in score matrix based on global sequence alignment,
+	visiting only the cells within the band returned by :func:`band_limits`.
+
+	Gives the same alignment as :func:`pyms.DPA.PairwiseAlignment.dp`.
+
+	:param S: Score matrix
+	:type S: numpy.ndarray
+	:param gap_penalty: Gap penalty
+	:type gap_penalty: float
+
+	:return: The traceback, where 0 is a match, 1 is a gap in the second alignment
+		and 2 is a gap in the first alignment
+	:rtype: list of int
+	"""
+
+	n1, n2 = S.shape
+
+	if n1 == 0 or n2 == 0:
+		raise IndexError('Zero length alignment found: Samples with no peaks cannot be aligned')
+
+	first, last = band_limits(S, gap_penalty)
+	first, last = first.tolist(), last.tolist()
+	scores = S.tolist()
+
+	inf = math.inf
+
+	# D contains the score of the optimal alignment, for the cells within the band
+	D = [[inf] * (n2 + 1) for _ in range(n1 + 1)]
+
+	# Directions for trace
+	# 0 - match               (move diagonal)
+	# 1 - peaks1 has no match (move up)
+	# 2 - peaks2 has no match (move left)
+	# 3 - stop
+	trace_matrix = [[3] * (n2 + 1) for _ in range(n1 + 1)]
+
+	for j in range(1, last[0] + 1):
+		D[0][j] = gap_penalty * j
+		trace_matrix[0][j] = 2
+	D[0][0] = 0.0
+
+	for i in range(1, n1 + 1):
+		D_row, D_above = D[i], D[i - 1]
+		trace_row = trace_matrix[i]
+		S_row = scores[i - 1]
+
+		j = first[i]
+		if j == 0:
+			D_row[0] = gap_penalty * i
+			trace_row[0] = 1
+			j = 1
+
+		for j in range(j, last[i] + 1):
+			darray = [D_above[j - 1] + S_row[j - 1], D_above[j] + gap_penalty, D_row[j - 1] + gap_penalty]
+			D_row[j] = min(darray)
+			# Store direction in trace matrix
+			trace_row[j] = darray.index(D_row[j])
+
+	# Trace back from bottom right
+	trace = []
+	i, j = n1, n2
+	direction = trace_matrix[i][j]
+
+	while direction != 3:
+		if direction == 0:  # Match
+			i -= 1
+			j -= 1
+		elif direction == 1:  # peaks1 has no match
+			i -= 1
+		elif direction == 2:  # peaks2 has no match
+			j -= 1
+		trace.append(direction)
+		direction = trace_matrix[i][j]
+
+	trace.reverse()
+
+	return trace
+
+
+def align(a1, a2, D, gap):
+	"""
+	Aligns two alignments
+
+	:param a1: The first alignment
+	:type a1: pyms.DPA.Alignment.Alignment
+	:param a2: The second alignment
+	:type a2: pyms.DPA.Alignment.Alignment
+	:param D: Retention time tolerance
+	:type D: float
+	:param gap: Gap penalty
+	:type gap: float
+
+	:return: Aligned alignments
+	:rtype: pyms.DPA.Alignment.Alignment
+	"""
+
+	from pyms.DPA.PairwiseAlignment import alignment_similarity, merge_alignments
+
+	S = score_matrix(PositionArrays(a1), PositionArrays(a2), D)
+	trace = dp(S, gap)
+
+	# make composite alignment from the results
+	ma = merge_alignments(a1, a2, trace)
+
+	# calculate the similarity score
+	ma.similarity = alignment_similarity(trace, S, gap)
+
+	return ma
+
+
+def _pair_similarity(args):
+	arrays1, arrays2, D, gap = args
+
+	from pyms.DPA.PairwiseAlignment import alignment_similarity
+
+	S = score_matrix(arrays1, arrays2, D)
+	return alignment_similarity(dp(S, gap), S, gap)
+
+
+class BandedPairwiseAlignment:
+	"""
+	Models pairwise alignment of alignments, restricting each alignment to a retention time band.
+
+	Has the same attributes as :class:`pyms.DPA.PairwiseAlignment.PairwiseAlignment`,
+	except that ``tree`` is a list of ``(left, right)`` pairs.
+
+	:param alignments: A list of alignments
+	:type alignments: list of pyms.DPA.Alignment.Alignment
+	:param D: Retention time tolerance parameter for pairwise alignments
+	:type D: float
+	:param gap: Gap parameter for pairwise alignments
+	:type gap: float
+	:param guide_tree: A guide tree saved from :attr:`guide_tree`. It is used if it was created
+		for the same alignments and parameters, saving the pairwise alignment of every pair of alignments.
+	:type guide_tree: dict, optional
+	"""
+
+	def __init__(self, alignments, D, gap, guide_tree=None):
+		if not isinstance(alignments, list) or not alignments:
+			raise TypeError("'alignments' must be a list")
+
+		self.alignments = alignments
+		self.D = float(D)
+		self.gap = float(gap)
+
+		arrays = [PositionArrays(alignment) for alignment in alignments]
+		self.key = self._key(arrays)
+
+		self.sim_matrix = None
+		self.dist_matrix = None
+
+		if guide_tree is not None and guide_tree.get("key") == self.key:
+			print(f" Using saved guide tree for {len(alignments):d} alignments")
+			self.tree = [tuple(node) for node in guide_tree["tree"]]
+		else:
+			self._sim_matrix(arrays)
+			self._dist_matrix()
+			self._guide_tree()
+
+	def _key(self, arrays):
+		sha = hashlib.sha256()
+		sha.update(repr((self.D, self.gap)).encode("utf-8"))
+
+		for alignment, position_arrays in zip(self.alignments, arrays):
+			sha.update(repr(alignment.expr_code).encode("utf-8"))
+			sha.update(position_arrays.digest())
+
+		return sha.hexdigest()
+
+	def _sim_matrix(self, arrays):
+		"""
+		Calculates the similarity matrix for the set of alignments, in parallel
+		"""
+
+		n = len(self.alignments)
+		pairs = [(i, j) for i in range(n - 1) for j in range(i + 1, n)]
+
+		print(f" Calculating pairwise alignments for {n:d} alignments (D={self.D:.2f}, gap={self.gap:.2f})")
+
+		# The same precision as PyMassSpec, so the guide tree is the same
+		self.sim_matrix = numpy.zeros((n, n), dtype='f')
+
+		similarities = parallel.imap(
+				_pair_similarity,
+				[(arrays[i], arrays[j], self.D, self.gap) for i, j in pairs],
+				chunksize=1,
+				min_items=2,
+				)
+
+		for remaining, ((i, j), similarity) in enumerate(zip(pairs, similarities), start=1):
+			self.sim_matrix[i, j] = self.sim_matrix[j, i] = similarity
+			print(f" -> {len(pairs) - remaining:d} pairs remaining")
+
+	def _dist_matrix(self):
+		"""
+		Converts similarity matrix into a distance matrix
+		"""
+
+		# change similarity matrix entries (i,j) to max{matrix}-(i,j)
+		self.dist_matrix = numpy.max(self.sim_matrix) - self.sim_matrix
+		numpy.fill_diagonal(self.dist_matrix, 0)
+
+	def _guide_tree(self):
+		"""
+		Build a guide tree from the distance matrix
+		"""
+
+		from pyms.DPA.PairwiseAlignment import treecluster
+
+		n = len(self.dist_matrix)
+
+		if n == 1:
+			self.tree = []
+			return
+
+		print(f" -> Clustering {n * (n - 1):d} pairwise alignments.", end='')
+		tree = treecluster(data=None, distancematrix=self.dist_matrix, method='a')
+		self.tree = [(node.left, node.right) for node in tree[:]]
+		print("Done")
+
+	@property
+	def guide_tree(self):
+		"""
+		Returns the guide tree, with the key identifying the alignments and parameters it was created for.
+
+		:rtype: dict
+		"""
+
+		return {"key": self.key, "tree": [list(node) for node in self.tree]}
+
+
+def align_with_tree(T, min_peaks=1):
+	"""
+	Aligns a list of alignments using the supplied guide tree
+
+	:param T: The pairwise alignment object
+	:type T: BandedPairwiseAlignment
+	:param min_peaks:
+	:type min_peaks: int, optional
+
+	:return: The final alignment consisting of aligned input alignments
+	:rtype: pyms.DPA.Alignment.Alignment
+	"""
+
+	print(f" Aligning {len(T.alignments):d} items with guide tree (D={T.D:.2f}, gap={T.gap:.2f})")
+
+	# Items are numbered 0, ... , n-1 and the nodes of the tree -1, ... , -(n-1),
+	# as for Bio.Cluster.treecluster
+	As = copy.deepcopy(T.alignments) + [None for _ in range(len(T.alignments))]
+
+	index = 0
+
+	for left, right in T.tree:
+		index = index - 1
+		As[index] = align(As[left], As[right], T.D, T.gap)
+		print(f" -> {len(T.tree) + index:d} item(s) remaining")
+
+	# the final alignment is in the root. Filter min peaks and return
+	final_algt = As[index]
+
+	# useful for within state alignment only
+	if min_peaks > 1:
+		final_algt.filter_min_peaks(min_peaks)
+
+	return final_algt
+
+
+def consensus_alignment(experiments, peak_index_alignment):
+	"""
+	Recreate an alignment of Experiments from the index of each aligned peak in each Experiment's peak list
+
+	:param experiments: The aligned Experiments
+	:type experiments: list of GuiV2.GSMatch2_Core.Experiment.Experiment
+	:param peak_index_alignment: The index of each aligned peak in the peak list of each Experiment,
+		or -1 if the Experiment does not have that peak, with one column per Experiment
+	:type peak_index_alignment: pandas.DataFrame
+
+	:rtype: pyms.DPA.Alignment.Alignment
+	"""
+
+	from pyms.DPA.Alignment import Alignment
+
+	consensus = Alignment(None)
+
+	for experiment in experiments:
+		peak_list = experiment.peak_list
+
+		consensus.expr_code.append(experiment.name)
+		consensus.peakpos.append([
+				None if peak_idx < 0 else copy.deepcopy(peak_list[peak_idx])
+				for peak_idx in peak_index_alignment[experiment.name].tolist()
+				])
+
+	consensus.peakalgt = numpy.transpose(consensus.peakpos)
+
+	return consensus
+
+
+def align_to_consensus(consensus, alignments, D, gap, engine="banded", min_peaks=1):
+	"""
+	Aligns alignments to an existing alignment, one at a time, without realigning the existing alignment
+
+	:param consensus: The existing alignment
+	:type consensus: pyms.DPA.Alignment.Alignment
+	:param alignments: The alignments to add
+	:type alignments: list of pyms.DPA.Alignment.Alignment
+	:param D: Retention time tolerance
+	:type D: float
+	:param gap: Gap penalty
+	:type gap: float
+	:param engine: ``"banded"`` to use :func:`align`, or ``"pyms"`` to use PyMassSpec's ``align``
+	:type engine: str, optional
+	:param min_peaks: Only aligned peaks in at least this many Experiments are kept
+	:type min_peaks: int, optional
+
+	:return: The final alignment consisting of the existing and new alignments
+	:rtype: pyms.DPA.Alignment.Alignment
+	"""
+
+	if engine == "pyms":
+		from pyms.DPA.PairwiseAlignment import align as align_pair
+	elif engine == "banded":
+		align_pair = align
+	else:
+		raise ValueError(f"Unknown alignment engine '{engine}'. Must be one of 'pyms' or 'banded'.")
+
+	print(f" Aligning {len(alignments):d} items to the existing alignment (D={D:.2f}, gap={gap:.2f})")
+
+	final_algt = consensus
+
+	for idx, new_algt in enumerate(alignments):
+		final_algt = align_pair(final_algt, copy.deepcopy(new_algt), D, gap)
+		print(f" -> {len(alignments) - idx - 1:d} item(s) remaining")
+
+	if min_peaks > 1:
+		final_algt.filter_min_peaks(min_peaks)
+
+	return final_algt
+
+
+def compare_alignments(rt_alignment, other_rt_alignment):
+	"""
+	Compare the retention times of the aligned peaks from two alignments of the same Experiments
+
+	:param rt_alignment: The retention times of the aligned peaks, from ``get_peak_alignment``
+	:type rt_alignment: pandas.DataFrame
+	:param other_rt_alignment: The retention times of the aligned peaks from the other alignment
+	:type other_rt_alignment: pandas.DataFrame
+
+	:return: The number of aligned peaks in each alignment, and the number of aligned peaks in
+		the first alignment that are in the second alignment, i.e. with the same peaks from each Experiment
+	:rtype: tuple of int
+	"""
+
+	def rows(alignment):
+		return {
+				tuple(round(rt, 6) if rt == rt else None for rt in row)
+				for row in alignment.to_numpy(dtype=float).tolist()
+				}
+
+	rows1 = rows(rt_alignment)
+	rows2 = rows(other_rt_alignment[list(rt_alignment.columns)])
+
+	return len(rt_alignment), len(other_rt_alignment), len(rows1 & rows2)
+
+
+if __name__ == "__main__":
+	# Validate the banded alignment against PyMassSpec's alignment on an existing Project, e.g.
+	#   python -m GuiV2.GSMatch2_Core.Project.alignment my_project.gsmp
+	# stdlib
+	import sys
+	import time
+
+	# 3rd party
+	from pyms.DPA import PairwiseAlignment
+	from pyms.DPA.Alignment import exprl2alignment
+
+	# this package
+	from GuiV2.GSMatch2_Core.Project.project import Project
+
+	for filename in sys.argv[1:]:
+		project = Project.load(filename)
+		method = project.method_data
+		alignments = exprl2alignment([experiment.experiment_data for experiment in project.experiment_objects])
+
+		start = time.perf_counter()
+		reference = PairwiseAlignment.align_with_tree(
+				PairwiseAlignment.PairwiseAlignment(alignments, method.alignment_rt_modulation, method.alignment_gap_penalty),
+				min_peaks=method.alignment_min_peaks,
+				)
+		reference_time = time.perf_counter() - start
+
+		start = time.perf_counter()
+		banded = align_with_tree(
+				BandedPairwiseAlignment(alignments, method.alignment_rt_modulation, method.alignment_gap_penalty),
+				min_peaks=method.alignment_min_peaks,
+				)
+		banded_time = time.perf_counter() - start
+
+		n_reference, n_banded, n_same = compare_alignments(
+				reference.get_peak_alignment(require_all_expr=False),
+				banded.get_peak_alignment(require_all_expr=False),
+				)
+
+		print(f"{filename}: {len(alignments)} Experiments")
+		print(f"  PyMassSpec: {n_reference} aligned peaks in {reference_time:0.2f} s")
+		print(f"  Banded:     {n_banded} aligned peaks in {banded_time:0.2f} s")
+		print(f"  {n_same} aligned peaks are the same")
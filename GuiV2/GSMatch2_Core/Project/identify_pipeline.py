@@ -0,0 +1,234 @@
+#  !/usr/bin/env python
+#   -*- coding: utf-8 -*-
+#
+#  identify_pipeline.py
+#
+#  This file is part of GunShotMatch
+#
+#  Copyright © 2020 Dominic Davis-Foster <dominic@davis-foster.co.uk>
+#
+#  GunShotMatch is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  GunShotMatch is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Compound Identification for a Project, one Experiment at a time.
+#
+#  Each Experiment is saved to the Project file as soon as its peaks have been
+#  identified, so that if Compound Identification is cancelled or crashes
+#  the completed Experiments are kept, and can be skipped when it is resumed.
+#  The search results are shared between the Experiments, so a spectrum found
+#  in several Experiments is only searched once.
+#
+
+# stdlib
+import asyncio
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# this package
+from GuiV2.GSMatch2_Core.nist_search import identify_peaks
+
+
+class IdentificationCancelled(Exception):
+	"""
+	Raised within the pipeline when Compound Identification is cancelled
+	"""
+
+
+IdentificationProgress = namedtuple(
+		"IdentificationProgress",
+		"event experiment experiments_done n_experiments searches_done n_searches message",
+		)
+IdentificationProgress.__doc__ = """
+Progress of Compound Identification, sent to the ``progress_callback`` of :class:`IdentificationPipeline`.
+
+``event`` is one of:
+
+* ``"experiment_started"``
+* ``"peak"``: after each unique spectrum in the Experiment has been searched
+* ``"experiment_done"``: after the Experiment has been saved
+* ``"finished"``, ``"cancelled"`` or ``"failed"``, once at the end
+
+``searches_done`` and ``n_searches`` count the unique spectra searched in the current Experiment,
+excluding those already searched for an earlier Experiment.
+``message`` is the error message for ``"failed"`` events.
+"""
+
+
+class IdentificationPipeline:
+	"""
+	Perform Compound Identification on the Experiments in a Project, one Experiment at a time,
+	sending progress events and checking for cancellation after each peak is searched.
+
+	Experiments that have already been identified are skipped, so an interrupted
+	Compound Identification can be resumed by running a new pipeline.
+	"""
+
+	def __init__(self, project, progress_callback=None, cancel_event=None, checkpoint=True):
+		"""
+		:param project:
+		:type project: GuiV2.GSMatch2_Core.Project.Project
+		:param progress_callback: Function called with an :class:`IdentificationProgress`
+			for each event. It is called from the thread the pipeline is running in.
+		:type progress_callback: function, optional
+		:param cancel_event: Event which cancels Compound Identification when set.
+			A :class:`multiprocessing.Event` allows it to be cancelled from another process.
+		:type cancel_event: threading.Event or multiprocessing.Event, optional
+		:param checkpoint: Whether to save each Experiment to the Project file once it has been identified.
+			Default True
+		:type checkpoint: bool, optional
+		"""
+
+		self.project = project
+		self.progress_callback = progress_callback
+		self.checkpoint = checkpoint
+
+		if cancel_event is None:
+			cancel_event = threading.Event()
+		self.cancel_event = cancel_event
+
+		self._experiments_done = 0
+		self._n_experiments = 0
+
+	def cancel(self):
+		"""
+		Cancel Compound Identification.
+
+		The search in progress is finished first, and the Experiment being
+		identified at the time is not saved.
+		"""
+
+		self.cancel_event.set()
+
+	@property
+	def cancelled(self):
+		"""
+		Returns whether Compound Identification has been cancelled
+
+		:rtype: bool
+		"""
+
+		return self.cancel_event.is_set()
+
+	def run(self):
+		"""
+		Perform Compound Identification, blocking until it has finished or been cancelled
+
+		:return: Whether Compound Identification was completed for every Experiment
+		:rtype: bool
+		"""
+
+		project = self.project
+		experiment_peaks = project.get_peaks_to_identify()
+
+		self._n_experiments = len(project.experiment_objects)
+		self._experiments_done = self._n_experiments - len(experiment_peaks)
+
+		# Search results for every Experiment so far, keyed by spectrum fingerprint
+		search_results = {}
+
+		try:
+			for experiment, peaks in experiment_peaks:
+				self._check_cancelled()
+				self._send("experiment_started", experiment.name)
+				print(f"Identifying Compounds for {experiment.name}")
+
+				identify_peaks(
+						peaks,
+						project.search_engine,
+						n_hits=project.method_data.ident_nist_n_hits,
+						chunk_size=1,
+						progress_callback=lambda done, total, name=experiment.name: self._on_search(name, done, total),
+						results=search_results,
+						)
+
+				# Don't save the Experiment if it was cancelled during the last search
+				self._check_cancelled()
+				experiment.set_identified_peaks(peaks)
+
+				if self.checkpoint:
+					try:
+						project.store(resave_experiments=[experiment.name])
+					except Exception:
+						# Match the Project file, so the Experiment is identified again when resumed
+						experiment.identification_performed = False
+						experiment.ident_peaks = None
+						experiment.ident_audit_record = None
+						raise
+
+				self._experiments_done += 1
+				self._send("experiment_done", experiment.name)
+
+		except IdentificationCancelled:
+			print("Compound Identification Cancelled")
+			self._send("cancelled")
+			return False
+
+		except Exception as e:
+			self._send("failed", message=str(e))
+			raise
+
+		self._send("finished")
+		return True
+
+	def start(self, executor=None):
+		"""
+		Perform Compound Identification in the background
+
+		:param executor: The executor to run the pipeline in. If not given a new thread is used.
+		:type executor: concurrent.futures.Executor, optional
+
+		:return: A future for the result of :meth:`run`
+		:rtype: concurrent.futures.Future
+		"""
+
+		if executor is None:
+			executor = ThreadPoolExecutor(max_workers=1)
+			future = executor.submit(self.run)
+			executor.shutdown(wait=False)
+			return future
+
+		return executor.submit(self.run)
+
+	async def run_async(self):
+		"""
+		Perform Compound Identification without blocking the event loop.
+
+		Cancelling the task cancels Compound Identification.
+
+		:return: Whether Compound Identification was completed for every Experiment
+		:rtype: bool
+		"""
+
+		try:
+			return await asyncio.wrap_future(self.start())
+		except asyncio.CancelledError:
+			self.cancel()
+			raise
+
+	def _check_cancelled(self):
+		if self.cancelled:
+			raise IdentificationCancelled
+
+	def _on_search(self, experiment_name, searches_done, n_searches):
+		self._send("peak", experiment_name, searches_done, n_searches)
+		self._check_cancelled()
+
+	def _send(self, event, experiment_name=None, searches_done=0, n_searches=0, message=None):
+		if self.progress_callback is not None:
+			self.progress_callback(IdentificationProgress(
+					event, experiment_name, self._experiments_done, self._n_experiments,
+					searches_done, n_searches, message,
+					))
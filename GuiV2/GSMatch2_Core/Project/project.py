@@ -32,29 +32,34 @@ import shutil
 import tarfile
 import tempfile
 from collections import Counter
+from concurrent.futures import as_completed, ThreadPoolExecutor
 from io import BytesIO
-from multiprocessing import Pool
 
 # 3rd party
 import numpy
 import pandas
-from chemistry_tools import spectrum_similarity
 from domdf_python_tools.doctools import is_documented_by
 from domdf_python_tools.paths import maybe_make
 from mathematical.utils import rounders
-import pyms_nist_search
 
 
 # this package
-from GuiV2.GSMatch2_Core import Ammunition, Base, Experiment, watchdog
+from GSMatch.utils.pynist import write_msp
+from GuiV2.GSMatch2_Core import Ammunition, Base, Experiment, parallel, watchdog
 from GuiV2.GSMatch2_Core.Config import internal_config
 from GuiV2.GSMatch2_Core.InfoProperties import Property
-from GuiV2.GSMatch2_Core.io import get_file_from_archive, load_info_json
+from GuiV2.GSMatch2_Core.nist_search import create_search_engine
+from GuiV2.GSMatch2_Core.io import (
+	add_bytes_to_archive, add_removed_marker, close_archive, compact_archive, load_info_json,
+	open_archive,
+	)
 from GuiV2.GSMatch2_Core.Project.consolidate import (
 	ConsolidatedPeak, ConsolidatedSearchResult, ConsolidateEncoder,
 	ConsolidatePeakFilter,
 	)
 from GuiV2.GSMatch2_Core.Project.exporters import MatchesCSVExporter, StatisticsXLSXExporter
+from GuiV2.GSMatch2_Core.Project import alignment, similarity
+from GuiV2.GSMatch2_Core.Project.identify_pipeline import IdentificationPipeline
 from GuiV2.GSMatch2_Core.utils import filename_only
 
 
@@ -65,7 +70,7 @@ class Project(Base.GSMBase):
 	def __init__(
 			self, name, method, user, device, date_created, date_modified,
 			version, description='', experiments=None, filename=None, ammo_details=None,
-			alignment_performed=False, alignment_audit_record=None,
+			alignment_performed=False, alignment_audit_record=None, alignment_history=None,
 			consolidate_performed=False, consolidate_audit_record=None, **_
 		):
 		"""
@@ -96,6 +101,9 @@ class Project(Base.GSMBase):
 		:type alignment_performed: bool
 		:param alignment_audit_record: If alignment was performed, when and by whom
 		:type alignment_audit_record: watchdog.AuditRecord
+		:param alignment_history: The Experiments aligned to the existing alignment after it was performed,
+			with when and by whom
+		:type alignment_history: list of dict
 		:param consolidate_performed: Whether consolidate was performed
 		:type consolidate_performed: bool
 		:param consolidate_audit_record: If consolidate was performed, when and by whom
@@ -116,10 +124,14 @@ class Project(Base.GSMBase):
 
 		self._experiment_objects = None
 		
+		# The NIST MS Search engine shared between the experiments. Initialised when first used
+		self._search_engine = None
+		
 		# Setup Variables
 		self.rt_alignment = None
 		self.ms_alignment = None
 		self.area_alignment = None
+		self._peak_index_alignment = None
 		self.consolidated_peaks = None
 
 		self.alignment_performed = alignment_performed
@@ -127,6 +139,12 @@ class Project(Base.GSMBase):
 			self.alignment_audit_record = watchdog.AuditRecord(record_dict=alignment_audit_record)
 		else:
 			self.alignment_audit_record = None
+		
+		# The Experiments aligned to the existing alignment, and when and by whom
+		self.alignment_history = [
+				(watchdog.AuditRecord(record_dict=entry["audit_record"]), entry["experiments"])
+				for entry in (alignment_history or [])
+				]
 			
 		self.consolidate_performed = consolidate_performed
 		if self.consolidate_performed:
@@ -228,6 +246,12 @@ class Project(Base.GSMBase):
 			# If alignment was performed, when and by whom
 			"alignment_audit_record": None,
 			
+			# Experiments aligned to the existing alignment, and when and by whom
+			"alignment_history": [
+					{"audit_record": dict(audit_record), "experiments": list(experiments)}
+					for audit_record, experiments in self.alignment_history
+					],
+			
 			# Whether consolidate was performed
 			"consolidate_performed": self.consolidate_performed,
 			
@@ -243,37 +267,50 @@ class Project(Base.GSMBase):
 			
 		return project_info
 
-	def store(self, filename=None, remove_alignment=False, resave_experiments=False, remove_consolidate=False):
+	def store(
+			self, filename=None, remove_alignment=False, resave_experiments=False,
+			remove_consolidate=False, compact=False, alignment_files=None,
+			):
 		"""
 		Save the project
 		
+		Only the files that have changed are written, by appending them to the Project file.
+		The previous versions are kept in a timestamped folder within ``changes``.
+		
 		:param filename: The filename to save the Project as
 		:type filename: str, optional
 		:param remove_alignment: Whether to remove the alignment data from the file. Default False
 		:type remove_alignment: bool, optional
-		:param resave_experiments: Whether the experiments should be resaved. Default False
-		:type resave_experiments: bool, optional
+		:param resave_experiments: Whether the experiments should be resaved,
+			or the names of the experiments to resave. Default False
+		:type resave_experiments: bool or list of str, optional
 		:param remove_consolidate: Whether to remove the Consolidate data. Default False
 		:type remove_consolidate: bool, optional
+		:param compact: Whether to rewrite the whole Project file afterwards,
+			discarding the superseded copies of the changed files. Default False
+		:type compact: bool, optional
+		:param alignment_files: New alignment data, as a mapping of filenames in the Project file to their contents
+		:type alignment_files: dict, optional
 		
 		:return: The filename of the saved project
 		:rtype: str
 		"""
 		
-		# 1. Extract the project tarfile to a temporary directory
-		# 2. Move any files that were changed to a timestamped folder
-		# 3. In that folder, create a file called "user" containing the username of the user who made the change
-		# 4. In the same folder, create a file called "device" containing the hostname of the device
-		# 5. Save the changed files to the temporary directory
-		# 6. Tar the contents of the temporary directory over the project file
-		# 7. Get rid of the temporary directory
+		# 1. Move any files that were changed to a timestamped folder
+		# 2. In that folder, create a file called "user" containing the username of the user who made the change
+		# 3. In the same folder, create a file called "device" containing the hostname of the device
+		# 4. Append the changed files to the project file, replacing the old versions
+		# 5. Mark any removed files as removed
 		
-		if filename:
+		if filename and str(filename) != str(self.filename.value):
+			# Save as a new file, starting from a copy of the current one
+			shutil.copyfile(self.filename.value, filename)
 			self.filename.value = filename
 		
 		if remove_alignment:
 			print(f"Removing Alignment data from {self.filename}")
 			self.alignment_performed = False
+			self.alignment_history = []
 		elif remove_consolidate:
 			print(f"Removing Consolidate data from {self.filename}")
 			self.consolidate_performed = False
@@ -283,95 +320,115 @@ class Project(Base.GSMBase):
 		# Set date modified value
 		self.date_modified.value = datetime.datetime.now().timestamp()
 		
-		# One of the files has been changed
-		with tempfile.TemporaryDirectory() as tempdir:
-			tarfile.open(self.filename.value, mode="r").extractall(tempdir)
-			
-			tempdir_p = pathlib.Path(tempdir)
-			
-			if not (tempdir_p / "changes").is_dir():
-				(tempdir_p / "changes").mkdir()
-			
-			timestamp_dir = tempdir_p / "changes" / datetime.datetime.fromtimestamp(
-				self.date_modified.value).strftime(
-					"%Y%m%d %H%M%S")
-			
-			timestamp_dir.mkdir()
-			
-			# The user and device who made the changes
-			user, device = watchdog.user_info()
-			(timestamp_dir / "user").write_text(user)
-			(timestamp_dir / "device").write_text(device)
-			
-			if resave_experiments:
-				# Move old experiment objects to timestamp_dir
+		archive = open_archive(self.filename.value)
+		
+		# Mapping of filenames in the archive to their new contents
+		changed_files = {}
+		
+		# Filenames to remove from the archive
+		removed_files = []
+		
+		if resave_experiments:
+			with tempfile.TemporaryDirectory() as tempdir:
 				for expr_obj, expr_filename in zip(self.experiment_objects, self.experiment_file_list):
+					if resave_experiments is not True and expr_obj.name not in resave_experiments:
+						continue
+					
 					expr_filename = filename_only(expr_filename)
-					shutil.move(tempdir_p / expr_filename, timestamp_dir / expr_filename)
-					expr_obj.store(tempdir_p / expr_filename)
-			
-			if self.method_unsaved:
-				shutil.copy2(
-						tempdir_p / filename_only(self.method.value),
-						timestamp_dir / filename_only(self.method.value))
-				print("Saving new Method")
-				self.method_data.save_method(tempdir_p / filename_only(self.method.value))
-				
-			# TODO: Add the new method file and change copy2 above to move
-			print(self.ammo_details_unsaved)
-
-			if self.ammo_details_unsaved:
-				shutil.move(
-						tempdir_p / filename_only(self.ammo_details.value),
-						timestamp_dir / filename_only(self.ammo_details.value)
-						)
-
-				self.ammo_data.store(tempdir_p / filename_only(self.ammo_details.value))
-			
-			shutil.move(tempdir_p / "info.json", timestamp_dir / "info.json")
-			
-			if remove_alignment:
-				# Move the alignment files to the timestamp_dir
-				for fname in {
-						"alignment_area.csv", "alignment_rt.csv",
-						"alignment_ms.json", "alignment_rt.json",  "alignment_area.json"
-						}:
-					try:
-						shutil.move(tempdir_p / fname, timestamp_dir / fname)
-					except FileNotFoundError:
-						pass
-			elif remove_consolidate:
-				# Move the consolidate files to the timestamp_dir
-				try:
-					shutil.move(tempdir_p / "consolidate.json", timestamp_dir / "consolidate.json")
-				except FileNotFoundError:
-					pass
+					expr_obj.store(pathlib.Path(tempdir) / expr_filename)
+					changed_files[expr_filename] = (pathlib.Path(tempdir) / expr_filename).read_bytes()
+					
+					# The temporary file is about to be deleted
+					expr_obj.filename.value = BytesIO(changed_files[expr_filename])
+		
+		if alignment_files:
+			changed_files.update(alignment_files)
+		
+		if self.method_unsaved:
+			print("Saving new Method")
+			with tempfile.TemporaryDirectory() as tempdir:
+				method_filename = pathlib.Path(tempdir) / filename_only(self.method.value)
+				self.method_data.save_method(method_filename)
+				changed_files[filename_only(self.method.value)] = method_filename.read_bytes()
+		
+		if self.ammo_details_unsaved:
+			with tempfile.TemporaryDirectory() as tempdir:
+				ammo_filename = pathlib.Path(tempdir) / filename_only(self.ammo_details.value)
+				self.ammo_data.store(ammo_filename)
+				changed_files[filename_only(self.ammo_details.value)] = ammo_filename.read_bytes()
+		
+		if remove_alignment:
+			removed_files += [
+					"alignment_area.csv", "alignment_rt.csv",
+					"alignment_ms.json", "alignment_rt.json", "alignment_area.json",
+					"alignment_peak_index.json",
+					]
+		elif remove_consolidate:
+			removed_files.append("consolidate.json")
+		
+		# Add the info file to the archive
+		changed_files["info.json"] = json.dumps(self.project_info_dict, indent=4).encode("utf-8")
+		
+		if self.consolidate_performed:
+			# Add the consolidate data file to the archive
+			# TODO: flag to show consolidated_peaks has been changed
+			consolidate_json = json.dumps(self.consolidated_peaks, indent=4, cls=ConsolidateEncoder)
+			changed_files["consolidate.json"] = consolidate_json.encode("utf-8")
+		
+		timestamp_dir = "changes/" + datetime.datetime.fromtimestamp(
+				self.date_modified.value).strftime("%Y%m%d %H%M%S %f")
+		
+		# Don't overwrite the history of an earlier save within the same clock tick
+		if f"{timestamp_dir}/user" in archive:
+			suffix = 2
+			while f"{timestamp_dir}-{suffix}/user" in archive:
+				suffix += 1
+			timestamp_dir = f"{timestamp_dir}-{suffix}"
+		
+		# The user and device who made the changes
+		user, device = watchdog.user_info()
+		
+		# The old versions of the changed and removed files
+		old_files = {
+				fname: archive.read(fname)
+				for fname in [*changed_files, *removed_files]
+				if fname in archive
+				}
+		
+		close_archive(self.filename.value)
+		with tarfile.open(self.filename.value, mode="a") as project_file:
+			add_bytes_to_archive(project_file, user.encode("utf-8"), f"{timestamp_dir}/user")
+			add_bytes_to_archive(project_file, device.encode("utf-8"), f"{timestamp_dir}/device")
 			
-			# Add the info file to the archive
-			info_json = json.dumps(self.project_info_dict, indent=4)
-			(tempdir_p / "info.json").write_text(info_json)
+			for fname, data in old_files.items():
+				add_bytes_to_archive(project_file, data, f"{timestamp_dir}/{fname}")
 			
-			if self.consolidate_performed:
-				# Add the consolidate data file to the archive
-				# for peak in self.consolidated_peaks:
-				# 	for hit in peak.hits:
-				# 		print(hit.reference_data)
-				# 		print(hit.reference_data.mass_spec)
-				# 		print(hit.reference_data.__dict__(recursive=True)["mass_spec"])
-				# 		print("^^^^^")
-				# TODO: flag to show consolidated_peaks has been changed
-				consolidate_json = json.dumps(self.consolidated_peaks, indent=4, cls=ConsolidateEncoder)
-				(tempdir_p / "consolidate.json").write_text(consolidate_json)
+			for fname, data in changed_files.items():
+				add_bytes_to_archive(project_file, data, fname)
 			
-			# Tar the contents of the temporary directory over the project file
-			with tarfile.open(self.filename.value, mode="w") as project_file:
-				project_file.add(tempdir_p, arcname="")
+			for fname in removed_files:
+				if fname in old_files:
+					add_removed_marker(project_file, fname)
+		
+		if compact:
+			self.compact()
 		
 		# Mark as saved
 		self.mark_all_saved()
 		
 		return self.filename.value
 	
+	def compact(self):
+		"""
+		Rewrite the Project file, discarding the copies of files that have been
+		replaced or removed since the Project file was last compacted.
+		
+		The history of changes in the ``changes`` folder is retained.
+		"""
+		
+		print(f"Compacting {self.filename}")
+		compact_archive(self.filename.value)
+	
 	def mark_all_saved(self):
 		self._unsaved_changes = False
 		self.ammo_details_unsaved = False
@@ -399,12 +456,13 @@ class Project(Base.GSMBase):
 	
 	def add_to_archive(self, filename, arcname=None):
 		# Check if the file already exists in the archive:
-		archive = tarfile.open(self.filename.value, mode="r")
+		archive = open_archive(self.filename.value)
 
-		if (arcname and arcname in archive.getnames()) or (filename in archive.getnames()):
+		if (arcname and arcname in archive) or (filename in archive):
 			# File is already in archive
 			return False
 		
+		close_archive(self.filename.value)
 		with tarfile.open(self.filename.value, mode="a") as project_file:
 			project_file.add(filename, arcname)
 		
@@ -436,22 +494,52 @@ class Project(Base.GSMBase):
 	def remove_experiment(self, filename):
 		self._experiments = [experiment for experiment in self._experiments if experiment["filename"] != filename]
 	
-	def _load_experiments(self):
+	def load_experiments(self, n_workers=None, progress_callback=None):
 		"""
-		Load the experiments from file
+		Load the experiments from file, using a pool of threads.
+		
+		:param n_workers: The maximum number of threads to use.
+			Defaults to the ``n_workers`` setting, or the number of CPUs if that is 0.
+		:type n_workers: int, optional
+		:param progress_callback: Function to call after each Experiment has been loaded.
+			Called with the number of Experiments loaded, the total number of Experiments,
+			and the name of the Experiment.
+		:type progress_callback: callable, optional
+		
+		:return: The Experiments, in the same order as :attr:`experiment_file_list`
+		:rtype: list of :class:`GuiV2.GSMatch2_Core.Experiment.Experiment`
 		"""
 		
-		for filename in self.experiment_file_list:
-			# self._experiment_objects.append(Experiment.load(filename))
-			
-			# Get Experiment tarfile from the Project tarfile and convert to BytesIO
-			expr_tarfile = BytesIO(get_file_from_archive(str(self.filename.value), filename_only(filename)).read())
+		archive = open_archive(self.filename.value)
+		file_list = self.experiment_file_list
 		
+		def load_experiment(filename):
+			# Get Experiment tarfile from the Project tarfile as BytesIO
+			expr_tarfile = archive.open(filename_only(filename))
+			
 			# Load the Experiment
-			expr = Experiment.Experiment.load(expr_tarfile)
+			return Experiment.Experiment.load(expr_tarfile)
+		
+		if n_workers is None:
+			n_workers = internal_config.n_workers or os.cpu_count() or 1
+		
+		n_workers = max(1, min(int(n_workers), len(file_list) or 1))
+		
+		experiment_objects = [None] * len(file_list)
+		
+		with ThreadPoolExecutor(max_workers=n_workers) as executor:
+			futures = {executor.submit(load_experiment, filename): idx for idx, filename in enumerate(file_list)}
 			
-			# Add the Experiment to the list of Experiment objects
-			self._experiment_objects.append(expr)
+			for n_done, future in enumerate(as_completed(futures), start=1):
+				idx = futures[future]
+				experiment_objects[idx] = future.result()
+				
+				if progress_callback:
+					progress_callback(n_done, len(file_list), experiment_objects[idx].name)
+		
+		self._experiment_objects = experiment_objects
+		
+		return self._experiment_objects
 	
 	@property
 	def experiment_objects(self):
@@ -464,9 +552,7 @@ class Project(Base.GSMBase):
 		if self._experiment_objects:
 			return self._experiment_objects
 		else:
-			self._experiment_objects = []
-			self._load_experiments()
-			return self._experiment_objects
+			return self.load_experiments()
 	
 	# Analysis
 	
@@ -481,7 +567,6 @@ class Project(Base.GSMBase):
 		# Imports
 		from pyms.DPA.Alignment import exprl2alignment
 		from pyms.DPA.PairwiseAlignment import align_with_tree, PairwiseAlignment
-		from pyms.json import PyMassSpecEncoder
 		
 		# Perform dynamic peak alignment
 		print("\nAligning\n")
@@ -494,56 +579,224 @@ class Project(Base.GSMBase):
 			pyms_expr_list.append(experiment.experiment_data)
 		
 		F1 = exprl2alignment(pyms_expr_list)
+
+		engine = self.method_data.alignment_engine
+
+		if engine == "pyms":
+			T1 = PairwiseAlignment(F1, self.method_data.alignment_rt_modulation, self.method_data.alignment_gap_penalty)
+			A1 = align_with_tree(T1, min_peaks=self.method_data.alignment_min_peaks)
+
+		elif engine == "banded":
+			guide_tree = self.load_guide_tree()
+			T1 = alignment.BandedPairwiseAlignment(
+					F1, self.method_data.alignment_rt_modulation, self.method_data.alignment_gap_penalty,
+					guide_tree=guide_tree,
+					)
+			A1 = alignment.align_with_tree(T1, min_peaks=self.method_data.alignment_min_peaks)
+
+			if guide_tree != T1.guide_tree:
+				self.save_guide_tree(T1.guide_tree)
+
+		else:
+			raise ValueError(f"Unknown alignment engine '{engine}'. Must be one of 'pyms' or 'banded'.")
+
+		alignment_data, alignment_files = self._alignment_files(A1, self.experiment_objects)
+		
+		self._set_alignment_data(*alignment_data)
+		self.alignment_performed = True
+		self.alignment_audit_record = watchdog.AuditRecord()
+		self.date_modified.value = datetime.datetime.now().timestamp()
+		self.store(alignment_files=alignment_files)
+	
+	def align_new_experiments(self, filenames):
+		"""
+		Add Experiments to the Project and align them to the existing alignment.
+		
+		The Experiments already in the Project are not aligned again. Instead, each new Experiment
+		is aligned in turn to the existing aligned peaks, which are then replaced by the new aligned peaks.
+		Aligned peaks that were excluded by the ``min_peaks`` setting are not available to align to,
+		so the result can differ slightly from aligning all of the Experiments at once.
+		
+		Any Consolidate data is removed, as it does not include the new Experiments.
+		
+		:param filenames: The filenames of the Experiments to add
+		:type filenames: list of str
+		"""
+		
+		if not self.alignment_performed:
+			raise ValueError("Alignment has not been performed. Add the Experiments and perform Alignment instead.")
+		
+		# Imports
+		from pyms.DPA.Alignment import exprl2alignment
+		
+		new_experiments = [Experiment.Experiment.load(filename) for filename in filenames]
+		
+		for filename, experiment in zip(filenames, new_experiments):
+			if filename in self.experiment_file_list or experiment.name in self.experiment_name_list:
+				raise ValueError(f"The experiment '{filename}' is already in the project")
+		
+		# The existing alignment, from the Experiments already in the Project
+		experiment_objects = self.experiment_objects
+		consensus = alignment.consensus_alignment(experiment_objects, self.peak_index_alignment)
+		
+		print("\nAligning new Experiments\n")
+		
+		A1 = alignment.align_to_consensus(
+				consensus,
+				exprl2alignment([experiment.experiment_data for experiment in new_experiments]),
+				self.method_data.alignment_rt_modulation,
+				self.method_data.alignment_gap_penalty,
+				engine=self.method_data.alignment_engine,
+				min_peaks=self.method_data.alignment_min_peaks,
+				)
+		
+		alignment_data, alignment_files = self._alignment_files(A1, experiment_objects + new_experiments)
+		
+		# The Project is only changed once the new alignment has been calculated,
+		# and is restored if it can't then be saved
+		previous_state = (
+				list(self._experiments), self._experiment_objects,
+				(self.rt_alignment, self.ms_alignment, self.area_alignment, self._peak_index_alignment),
+				list(self.alignment_history), self.consolidate_performed, self.date_modified.value,
+				)
+		
+		try:
+			for filename in filenames:
+				self.add_experiment(filename)
+			self._experiment_objects = experiment_objects + new_experiments
+			self._set_alignment_data(*alignment_data)
+			
+			new_names = [experiment.name for experiment in new_experiments]
+			self.alignment_history.append((watchdog.AuditRecord(), new_names))
+			self.date_modified.value = datetime.datetime.now().timestamp()
+			self.store(
+					resave_experiments=new_names,
+					remove_consolidate=self.consolidate_performed,
+					alignment_files=alignment_files,
+					)
+		
+		except Exception:
+			(
+					self._experiments, self._experiment_objects, old_alignment_data,
+					self.alignment_history, self.consolidate_performed, self.date_modified.value,
+					) = previous_state
+			self._set_alignment_data(*old_alignment_data)
+			raise
+	
+	def _alignment_files(self, A1, experiment_objects):
+		"""
+		Returns the alignment data from the given alignment, and the files to save it to the Project file.
+		
+		The Project itself is not changed.
+		
+		:param A1: The alignment of the Experiments
+		:type A1: pyms.DPA.Alignment.Alignment
+		:param experiment_objects: The Experiments in the alignment, in the same order
+		:type experiment_objects: list of :class:`GuiV2.GSMatch2_Core.Experiment.Experiment`
 		
-		T1 = PairwiseAlignment(F1, self.method_data.alignment_rt_modulation, self.method_data.alignment_gap_penalty)
-		A1 = align_with_tree(T1, min_peaks=self.method_data.alignment_min_peaks)
+		:return: The retention time, mass spectrum, area and peak index alignments,
+			and a mapping of filenames in the Project file to their contents
+		:rtype: tuple
+		"""
+		
+		from pyms.json import PyMassSpecEncoder
 		
-		# Save alignment to file and then add to tarfile
 		with tempfile.TemporaryDirectory() as tmp:
 			
 			A1.write_csv(
 				os.path.join(tmp, 'alignment_rt.csv'),
 				os.path.join(tmp, 'alignment_area.csv'))
-			self.add_to_archive(os.path.join(tmp, 'alignment_rt.csv'), arcname="alignment_rt.csv")
-			self.add_to_archive(os.path.join(tmp, 'alignment_area.csv'), arcname="alignment_area.csv")
 		
-			self.rt_alignment = A1.get_peak_alignment(require_all_expr=False)
-			self.rt_alignment.to_json(os.path.join(tmp, 'alignment_rt.json'))
-			self.add_to_archive(os.path.join(tmp, 'alignment_rt.json'), arcname="alignment_rt.json")
+			rt_alignment = A1.get_peak_alignment(require_all_expr=False)
+			rt_alignment.to_json(os.path.join(tmp, 'alignment_rt.json'))
 
-			self.ms_alignment = A1.get_ms_alignment(require_all_expr=False)
-			# self.ms_alignment.to_json(os.path.join(tmp, 'alignment_ms.json'))
+			ms_alignment = A1.get_ms_alignment(require_all_expr=False)
+			# ms_alignment.to_json(os.path.join(tmp, 'alignment_ms.json'))
 			with open(os.path.join(tmp, 'alignment_ms.json'), "w") as fp:
-				json.dump(self.ms_alignment.to_dict(), fp, cls=PyMassSpecEncoder)
-			self.add_to_archive(os.path.join(tmp, 'alignment_ms.json'), arcname="alignment_ms.json")
-		
-			self.area_alignment = A1.get_area_alignment(require_all_expr=False)
-			self.area_alignment.to_json(os.path.join(tmp, 'alignment_area.json'))
-			self.add_to_archive(os.path.join(tmp, 'alignment_area.json'), arcname="alignment_area.json")
+				json.dump(ms_alignment.to_dict(), fp, cls=PyMassSpecEncoder)
 		
-		self.alignment_performed = True
-		self.alignment_audit_record = watchdog.AuditRecord()
-		self.date_modified.value = datetime.datetime.now().timestamp()
-		self.store()
+			area_alignment = A1.get_area_alignment(require_all_expr=False)
+			area_alignment.to_json(os.path.join(tmp, 'alignment_area.json'))
+			
+			# The index of each aligned peak in its Experiment's peak list
+			peak_index_alignment = get_peak_index_alignment(A1, experiment_objects, rt_alignment.index)
+			peak_index_alignment.to_json(os.path.join(tmp, 'alignment_peak_index.json'))
+			
+			alignment_files = {
+					fname: pathlib.Path(tmp, fname).read_bytes()
+					for fname in [
+							"alignment_rt.csv", "alignment_area.csv",
+							"alignment_rt.json", "alignment_ms.json", "alignment_area.json",
+							"alignment_peak_index.json",
+							]
+					}
+			
+			return (rt_alignment, ms_alignment, area_alignment, peak_index_alignment), alignment_files
+	
+	def _set_alignment_data(self, rt_alignment, ms_alignment, area_alignment, peak_index_alignment):
+		"""
+		Set the alignment data, as returned by :meth:`_alignment_files`
+		"""
 		
+		self.rt_alignment = rt_alignment
+		self.ms_alignment = ms_alignment
+		self.area_alignment = area_alignment
+		self._peak_index_alignment = peak_index_alignment
+
+	def load_guide_tree(self):
+		"""
+		Returns the guide tree saved by the last banded alignment, or ``None`` if there isn't one.
+
+		The guide tree is kept when the alignment is removed, so it can be reused
+		if the Experiments are aligned again with the same settings.
+
+		:rtype: dict or None
+		"""
+
+		archive = open_archive(self.filename.value)
+
+		if "alignment_guide_tree.json" in archive:
+			return json.load(archive.open("alignment_guide_tree.json"))
+		else:
+			return None
+
+	def save_guide_tree(self, guide_tree):
+		"""
+		Save the guide tree from a banded alignment to the Project file,
+		replacing any previously saved guide tree.
+
+		:param guide_tree:
+		:type guide_tree: dict
+		"""
+
+		close_archive(self.filename.value)
+		with tarfile.open(self.filename.value, mode="a") as project_file:
+			add_bytes_to_archive(
+					project_file,
+					json.dumps(guide_tree).encode("utf-8"),
+					"alignment_guide_tree.json",
+					)
+
 	def load_alignment_data(self):
 		
 		if self.alignment_performed:
 			from pyms.Spectrum import MassSpectrum
 			
-			self.rt_alignment = pandas.read_json(get_file_from_archive(self.filename.Path, 'alignment_rt.json'))
+			archive = open_archive(self.filename.value)
+			
+			self.rt_alignment = pandas.read_json(archive.open('alignment_rt.json'))
 			
 			# To make sure that columns of dataframe are in the same order as the experiment name list
 			if self.rt_alignment.columns.tolist() != self.experiment_name_list:
 				self.rt_alignment = self.rt_alignment[self.experiment_name_list]
 				
-			self.area_alignment = pandas.read_json(get_file_from_archive(self.filename.Path, 'alignment_area.json'))
+			self.area_alignment = pandas.read_json(archive.open('alignment_area.json'))
 			
 			# To make sure that columns of dataframe are in the same order as the experiment name list
 			if self.area_alignment.columns.tolist() != self.experiment_name_list:
 				self.area_alignment = self.area_alignment[self.experiment_name_list]
 				
-			raw_ms_alignment = json.load(get_file_from_archive(self.filename.Path, 'alignment_ms.json'))
+			raw_ms_alignment = json.load(archive.open('alignment_ms.json'))
 			
 			ordered_ms_alignment = {}
 			
@@ -558,11 +811,43 @@ class Project(Base.GSMBase):
 			
 			self.ms_alignment = pandas.DataFrame(data=ordered_ms_alignment)
 			
+			if "alignment_peak_index.json" in archive:
+				self._peak_index_alignment = pandas.read_json(archive.open('alignment_peak_index.json'))
+				
+				# To make sure that columns of dataframe are in the same order as the experiment name list
+				if self._peak_index_alignment.columns.tolist() != self.experiment_name_list:
+					self._peak_index_alignment = self._peak_index_alignment[self.experiment_name_list]
+			else:
+				# Projects aligned before the indices were stored; found from the retention times when needed
+				self._peak_index_alignment = None
+	
+	@property
+	def peak_index_alignment(self):
+		"""
+		Returns the index of each aligned peak in the peak list of each Experiment,
+		or -1 if the Experiment does not have that peak.
+		
+		For Projects aligned before the indices were stored in the Project file,
+		the indices are found from the retention times of the aligned peaks.
+		
+		:rtype: pandas.DataFrame
+		"""
+		
+		if self._peak_index_alignment is None and self.rt_alignment is not None:
+			self._peak_index_alignment = pandas.DataFrame(
+					{
+							experiment.name: experiment.get_peak_indices(
+									self.rt_alignment[experiment.name].to_numpy(dtype=float))
+							for experiment in self.experiment_objects
+							},
+					index=self.rt_alignment.index,
+					)
+		
+		return self._peak_index_alignment
+			
 	def load_consolidate_results(self):
 		if self.consolidate_performed:
-			archive = tarfile.open(self.filename.value, mode="r")
-			raw_consolidated_peaks = json.load(get_file_from_archive(archive, "consolidate.json"))
-			archive.close()
+			raw_consolidated_peaks = json.load(open_archive(self.filename.value).open("consolidate.json"))
 			
 			self.consolidated_peaks = []
 			
@@ -571,9 +856,24 @@ class Project(Base.GSMBase):
 				
 	# Identify Compounds
 	
-	def identify_compounds(self):
+	def identify_compounds(self, progress_callback=None, cancel_event=None, resume=False):
 		"""
 		Perform Compound Identification on the selected experiments
+		
+		Each experiment is saved to the Project file as soon as it has been identified.
+		
+		:param progress_callback: Function called with an
+			:class:`~GuiV2.GSMatch2_Core.Project.identify_pipeline.IdentificationProgress`
+			after each peak is searched and each experiment is completed
+		:type progress_callback: function, optional
+		:param cancel_event: Event which cancels Compound Identification when set
+		:type cancel_event: threading.Event or multiprocessing.Event, optional
+		:param resume: Whether to skip experiments that have already been identified,
+			rather than raising an error. Default False
+		:type resume: bool, optional
+		
+		:return: Whether Compound Identification was completed for every experiment
+		:rtype: bool
 		"""
 		
 		if not self.alignment_performed:
@@ -586,7 +886,7 @@ class Project(Base.GSMBase):
 			if experiment.identification_performed:
 				identify_performed.append(experiment)
 				
-		if identify_performed:
+		if identify_performed and not resume:
 			error_string = "Compound Identification has already been performed for the following experiments"
 
 			for experiment in identify_performed:
@@ -594,79 +894,46 @@ class Project(Base.GSMBase):
 
 			raise ValueError(error_string)
 		
-		# Perform compound identification for each experiment
-		
-		# Based on the identification settings, determine which peaks to identify
-		
-		peak_areas = []
-
-		# Can use pandas._libs.json.dumps to get "dict" like output for a class.
-		# Probably one way as it might not include all internal variables
-		
-		pandas.set_option("display.max_rows", None, "display.max_columns", None)
-		
-		# Calculate average peak area for each of the aligned peaks
-		for index, areas in self.area_alignment.iterrows():
-			# peak_areas.append(statistics.mean([area for area in areas if not numpy.isnan(area)]))
-			peak_areas.append(float(numpy.nanmean(areas)))
-		
-		peak_areas = pandas.DataFrame(peak_areas, columns=["Peak Area"])
+		pipeline = IdentificationPipeline(self, progress_callback=progress_callback, cancel_event=cancel_event)
 		
-		print(peak_areas)
+		return pipeline.run()
 		
-		# Filter to only aligned peaks that appear in more samples than `ident_min_aligned_peaks`
-		print(f"Filtering to only those peaks in more than {self.method_data.ident_min_aligned_peaks} experiments")
-		peaks_to_identify = self.rt_alignment.dropna(
-				# thresh=4)
-				thresh=self.method_data.ident_min_aligned_peaks)
-		print(peaks_to_identify)
-
-		# TODO: Filter peaks by min_match_factor
+	def get_peaks_to_identify(self):
+		"""
+		Determine which peaks to identify, based on the identification settings in the Method.
 		
-		# Remove peaks from peak_areas if they are not in peaks_to_identify,
-		# i.e. they appear in more samples than `ident_min_aligned_peaks`
-		peak_areas = peak_areas.filter(peaks_to_identify.index, axis=0)
-		print(peak_areas)
-		# Sort peak_areas from largest (top) to smallest
-		peak_areas = peak_areas.sort_values(by="Peak Area")
+		Experiments that have already been identified are skipped.
 		
-		# Get indices of top n peaks based on `ident_top_peaks`
-		top_peaks_indices = []
+		:return: ``(experiment, peaks)`` tuples
+		:rtype: list of tuple
+		"""
 		
 		method_data = self.method_data
 		
-		print("########")
-		print(peak_areas.tail(self.method_data.ident_top_peaks))
+		top_peaks = select_top_peaks(
+				self.rt_alignment,
+				self.area_alignment,
+				min_aligned_peaks=method_data.ident_min_aligned_peaks,
+				n_peaks=method_data.ident_top_peaks,
+				min_peak_area=method_data.ident_min_peak_area,
+				)
 		
-		# Limit to the largest `ident_top_peaks` peaks
-		for peak_no, areas in peak_areas.tail(self.method_data.ident_top_peaks).iterrows():
-			# If average peak area is less then min_peak_area, skip
-			if numpy.mean(areas) >= self.method_data.ident_min_peak_area:
-				top_peaks_indices.append(peak_no)
+		# TODO: Filter peaks by min_match_factor
 		
-		print(top_peaks_indices)
+		peaks_to_identify = self.rt_alignment.iloc[top_peaks]
+		peak_indices = self.peak_index_alignment.iloc[top_peaks]
+		print(f"Identifying {len(top_peaks)} aligned peaks: {peaks_to_identify.index.tolist()}")
 		
-		#
-		# # Limit to the largest `ident_top_peaks` peaks
-		# for top_peak_idx, row in enumerate(peak_areas.iterrows()):
-		# 	if top_peak_idx < self.method_data.ident_top_peaks:
-		# 		# If average peak area is less then min_peak_area, skip
-		# 		if numpy.mean(row[1:]) >= self.method_data.ident_min_peak_area:
-		# 			top_peaks_indices.append(row[0])
-				
-		# Remove peaks from peaks_to_identify if they are not in
-		# top_peaks_indices, i.e. they are one of the top n largest peaks
-		peaks_to_identify = peaks_to_identify.filter(top_peaks_indices, axis=0)
+		experiment_peaks = []
 		
 		for experiment in self.experiment_objects:
-			# experiment.identify_compounds2(peaks_to_identify[experiment.name])
-			experiment.identify_compounds3(
-					peaks_to_identify[experiment.name],
-					n_hits=method_data.ident_nist_n_hits,
-					)
+			if experiment.identification_performed:
+				continue
 			
-		# Resave the project, including the experiment files
-		self.store(resave_experiments=True)
+			experiment_peaks.append((experiment, experiment.get_peaks_to_identify(
+					peaks_to_identify[experiment.name],
+					peak_indices=peak_indices[experiment.name],
+					)))
 		
 		# TODO: Here's what to do:
 		#  Make Experiment file mutable ONLY to remove compound identification data
@@ -680,10 +947,57 @@ class Project(Base.GSMBase):
 		#            (where the average ignores experiments that don't have the peak)
 		# DDF 27/Jan/2020
 		
-		return
+		return experiment_peaks
 		
 	# Properties
 	
+	@property
+	def search_engine(self):
+		"""
+		Returns the search engine shared between the experiments in the Project,
+		using the backend chosen in the internal configuration.
+		
+		The engine is initialised when it is first used,
+		and remains initialised until :meth:`close_search_engine` is called.
+		
+		:rtype: GuiV2.GSMatch2_Core.nist_search.SearchEngine or
+			GuiV2.GSMatch2_Core.local_search.LocalSearchEngine
+		"""
+		
+		if self._search_engine is None:
+			self._search_engine = create_search_engine()
+		
+		return self._search_engine
+	
+	def close_search_engine(self):
+		"""
+		Uninitialise the search engine, if it has been initialised
+		"""
+		
+		if self._search_engine is not None:
+			self._search_engine.uninit()
+	
+	def write_msp(self, filename):
+		"""
+		Write the mass spectra of the identified peaks in every Experiment in the Project
+		to a single MSP file, so they can be searched in one go.
+		
+		:param filename: The filename of the MSP file
+		:type filename: str or pathlib.Path
+		
+		:return: The number of spectra written
+		:rtype: int
+		"""
+		
+		def spectra():
+			for experiment in self.experiment_objects:
+				if experiment.identification_performed:
+					for peak in experiment.ident_peaks:
+						ms = peak.mass_spectrum
+						yield f"{experiment.name}_{peak.rt / 60}", ms.mass_list, ms.mass_spec
+		
+		return write_msp(filename, spectra())
+	
 	def _get_all_properties(self):
 		"""
 		Returns a list containing all of the properties, in the order they should be displayed
@@ -701,7 +1015,7 @@ class Project(Base.GSMBase):
 		"""
 		Gets Ammunition Details from the Project tarfile and convert to BytesIO
 		"""
-		return BytesIO(get_file_from_archive(self.filename.value, filename_only(self.ammo_details.value)).read())
+		return open_archive(self.filename.value).open(filename_only(self.ammo_details.value))
 	
 	@property
 	def unsaved_changes(self):
@@ -714,7 +1028,7 @@ class Project(Base.GSMBase):
 	
 	def export_method(self, output_filename):
 		with open(output_filename, 'w') as f:
-			f.write(get_file_from_archive(self.filename.Path, self.method.filename).read().decode("utf-8"))
+			f.write(open_archive(self.filename.value).read(self.method.filename).decode("utf-8"))
 	
 	def export_ammo_details(self, output_filename):
 		self.ammo_file.seek(0)
@@ -730,36 +1044,29 @@ class Project(Base.GSMBase):
 		:type ms_comp_data:
 		"""
 		
-		# Initialise search engine.
-		search = pyms_nist_search.Engine(
-				Base.FULL_PATH_TO_MAIN_LIBRARY,
-				pyms_nist_search.NISTMS_MAIN_LIB,
-				Base.FULL_PATH_TO_WORK_DIR,
-				# debug=True,
-				)
+		search = self.search_engine
 		
-		peak_numbers = set()
+		# The identified peaks in each experiment, by aligned peak number
+		experiment_peaks = []
 		for experiment in self.experiment_objects:
+			peaks_by_number = {}
 			for peak in experiment.ident_peaks:
-				peak_numbers.add(peak.peak_number)
-				
-		# Convert peak_numbers to a list and sort smallest to largest
-		peak_numbers = sorted(list(peak_numbers))
+				peaks_by_number.setdefault(peak.peak_number, peak)
+			experiment_peaks.append(peaks_by_number)
+		
+		# Sort peak_numbers smallest to largest
+		peak_numbers = sorted(set().union(*experiment_peaks))
 		
 		aligned_peaks = []
 		self.consolidated_peaks = []
 		
+		# The hits for each consolidated peak, with the location of the reference data in the library
+		pending_hits = []
+		
 		n_hits = 5
 		
 		for n in peak_numbers:
-			row = []
-			for experiment in self.experiment_objects:
-				for peak in experiment.ident_peaks:
-					if peak.peak_number == n:
-						row.append(peak)
-						break
-				else:
-					row.append(None)
+			row = [peaks_by_number.get(n) for peaks_by_number in experiment_peaks]
 			
 			aligned_peaks.append(row)
 			
@@ -817,24 +1124,36 @@ class Project(Base.GSMBase):
 							rmf_data.append(numpy.nan)
 							hit_num_data.append(numpy.nan)
 				
-				print(f"Obtaining reference data for {compound} (CAS {CAS})")
-				ref_data = search.get_reference_data(spec_loc)
-				# print(ref_data)
-				hits_data.append(ConsolidatedSearchResult(
+				hits_data.append((spec_loc, dict(
 						name=compound, cas=CAS, mf_list=mf_data, rmf_list=rmf_data,
-						hit_numbers=hit_num_data, reference_data=ref_data,
-						))
-			
-			# Sort consolidated hit list
-			hits_data = sorted(hits_data, key=lambda k: (len(k), k.match_factor, k.average_hit_number), reverse=True)
-			consolidated_peak.hits = hits_data  # [:n_hits]
+						hit_numbers=hit_num_data,
+						)))
 			
 			consolidated_peak.ms_comparison = ms_comp_data.loc[n]
 			
 			self.consolidated_peaks.append(consolidated_peak)
+			pending_hits.append(hits_data)
+		
+		# Obtain the reference data for every compound at once
+		spec_locs = {spec_loc for hits_data in pending_hits for spec_loc, _ in hits_data}
+		print(f"Obtaining reference data for {len(spec_locs)} compounds")
+		reference_data = search.get_reference_data_bulk(spec_locs)
+		
+		for consolidated_peak, hits_data in zip(self.consolidated_peaks, pending_hits):
+			hits_data = [
+					ConsolidatedSearchResult(reference_data=reference_data[spec_loc], **kwargs)
+					for spec_loc, kwargs in hits_data
+					]
+			
+			# Sort consolidated hit list
+			hits_data = sorted(hits_data, key=lambda k: (len(k), k.match_factor, k.average_hit_number), reverse=True)
+			consolidated_peak.hits = hits_data  # [:n_hits]
 		
 		# print(len(self.consolidated_peaks))
 		
+		if search.cache is not None:
+			print(search.cache)
+		
 		# Matches Sheet
 		MatchesCSVExporter(
 				self,
@@ -862,62 +1181,23 @@ class Project(Base.GSMBase):
 		# 	for dictionary in peak_data:
 		# 		jsonfile.write(json.dumps(dictionary))
 		# 		jsonfile.write("\n")
-		
-		search.uninit()
 
 	def ms_comparisons(self, ms_data):
 		"""
 		Between Samples Spectra Comparison
-
-		:param ms_data:
-		:type ms_data:
-
-		:return:
-		:rtype:
-		"""
-		
-		from itertools import permutations
-		
-		perms = []
-		
-		for i in permutations(self.experiment_name_list, 2):
-			# from https://stackoverflow.com/questions/10201977/how-to-reverse-tuples-in-python
-			if i[::-1] not in perms:
-				perms.append(i)
-
-		rows_list = []
-		
-		for peak_number, spectra in ms_data.iterrows():
-			rows_list.append((peak_number, spectra, perms))
-		
-		with Pool(len(ms_data.columns)) as p:
-			ms_comparison = p.map(single_ms_comparison, rows_list)
 		
-		# TODO: linear mode
-
-		# for row_idx in range(len(ms_data)):
-		# similarity_list = []
-		# row = ms_data.iloc[row_idx]
-		# for perm in perms:
-
-		# top_spec = numpy.column_stack((row.loc[perm[0]].mass_list, row.loc[perm[0]].mass_spec))
-		# bottom_spec = numpy.column_stack((row.loc[perm[1]].mass_list, row.loc[perm[1]].mass_spec))
-		# similarity_list.append(SpectrumSimilarity.SpectrumSimilarity(top_spec, bottom_spec, t = 0.25, b = 1,
-		# xlim = (45, 500), x_threshold = 0, print_graphic = False)[0]*1000)
-
-		# #ms_comparison.append(rounders((numpy.mean(similarity_list)*100),"0"))
-		# ms_comparison.append(similarity_list)
-		
-		# Convert list of (peak_number, comparisons) pairs to data frame
-		column_labels = ["{} & {}".format(*perm) for perm in perms]
-		comparison_dict = {}
+		Compares the mass spectra of each aligned peak between every pair of experiments,
+		with all peaks compared at once.
 		
-		for peak_number, comparison in ms_comparison:
-			comparison_dict[peak_number] = comparison
+		:param ms_data: The mass spectrum for each aligned peak in each experiment
+		:type ms_data: pandas.DataFrame
 		
-		comparison_df = pandas.DataFrame.from_dict(data=comparison_dict, columns=column_labels, orient="index")
+		:return: The similarity scores, out of 1000, with one row per aligned peak and
+			one column for each pair of experiments
+		:rtype: pandas.DataFrame
+		"""
 		
-		return comparison_df
+		return similarity.ms_comparisons(ms_data, self.experiment_name_list)
 
 	def consolidate(self):
 		"""
@@ -990,14 +1270,14 @@ class Project(Base.GSMBase):
 		for filename in os.listdir(path):
 			os.unlink(os.path.join(path, filename))
 		
+		arguments = [(sample, rt_data, ms_data, path) for sample in rt_data.columns.values]
+		
+		# Only worth starting the worker processes when there are many spectra per experiment
 		if len(rt_data) > 20:
-			arguments = [(sample, rt_data, ms_data, path) for sample in rt_data.columns.values]
-			with Pool(len(arguments)) as p:
-				
-				p.map(self.spectrum_image_wrapper, arguments)
+			parallel.map(self.spectrum_image_wrapper, arguments)
 		else:
-			for sample in rt_data.columns.values:
-				self.generate_spectrum_image(sample, rt_data, ms_data, path)
+			for argument in arguments:
+				self.spectrum_image_wrapper(argument)
 	
 	def generate_spectra(self):
 		self.generate_spectra_from_alignment(self.rt_alignment, self.ms_alignment)
@@ -1041,49 +1321,114 @@ def load(*args, **kwargs):
 	return Project.load(*args, **kwargs)
 
 
-def single_ms_comparison(arguments):
-	"""
-	Performs a single Mass Spectrum similarity calculation for the same peak in
-		two different samples.
-
-	:param arguments: tuple containing mass spectrum data and the samples to
-		which these spectra belong
-	:type arguments: tuple
-	:return:
-	:rtype:
+def get_peak_index_alignment(alignment, experiments, index=None):
 	"""
+	Returns the index of each aligned peak in the peak list of its Experiment
 	
-	peak_number, ms_data, perms = arguments
+	:param alignment: The alignment of the Experiments' peaks
+	:type alignment: pyms.DPA.Alignment.Alignment
+	:param experiments: The Experiments that were aligned
+	:type experiments: list of GuiV2.GSMatch2_Core.Experiment.Experiment
+	:param index: The index of the aligned peaks, e.g. from the retention time alignment
+	:type index: pandas.Index, optional
 	
-	similarity_list = []
+	:return: The index of each aligned peak in the peak list of each Experiment,
+		or -1 if the Experiment does not have that peak, with one column per Experiment.
+	:rtype: pandas.DataFrame
+	"""
+	
+	experiments = {experiment.name: experiment for experiment in experiments}
+	columns = {}
 	
-	for perm in perms:
-		top_ms = ms_data.loc[perm[0]]
-		bottom_ms = ms_data.loc[perm[1]]
+	for expr_code, aligned_peaks in zip(alignment.expr_code, alignment.peakpos):
+		peak_list = experiments[expr_code].peak_list
 		
-		if top_ms is None or bottom_ms is None:
-			similarity_list.append(None)
-		else:
-			top_spec = numpy.column_stack((ms_data.loc[perm[0]].mass_list, ms_data.loc[perm[0]].mass_spec))
-			bottom_spec = numpy.column_stack((ms_data.loc[perm[1]].mass_list, ms_data.loc[perm[1]].mass_spec))
-			similarity_list.append(spectrum_similarity.SpectrumSimilarity(
-					top_spec, bottom_spec, t=0.25, b=1, xlim=(45, 500),
-					x_threshold=0, print_graphic=False
-					)[0] * 1000)
+		# The aligned peaks are copies of the peaks in the peak list, with the same UID and retention time
+		by_uid = {(peak.UID, peak.rt): peak_idx for peak_idx, peak in enumerate(peak_list)}
+		by_rt = {peak.rt: peak_idx for peak_idx, peak in enumerate(peak_list)}
 		
-	return peak_number, similarity_list
+		columns[expr_code] = [
+				-1 if peak is None else by_uid.get((peak.UID, peak.rt), by_rt.get(peak.rt, -1))
+				for peak in aligned_peaks
+				]
+	
+	return pandas.DataFrame(columns, index=index, columns=list(experiments))
+
+
+def select_top_peaks(rt_alignment, area_alignment, min_aligned_peaks=0, n_peaks=80, min_peak_area=0):
+	"""
+	Select the aligned peaks to perform Compound Identification on.
+	
+	These are the ``n_peaks`` aligned peaks with the largest average peak area that appear in
+	at least ``min_aligned_peaks`` experiments, excluding any whose average peak area
+	is less than ``min_peak_area``.
+	
+	:param rt_alignment: The retention times of the aligned peaks
+	:type rt_alignment: pandas.DataFrame
+	:param area_alignment: The peak areas of the aligned peaks
+	:type area_alignment: pandas.DataFrame
+	:param min_aligned_peaks: The minimum number of experiments an aligned peak must appear in
+	:type min_aligned_peaks: int, optional
+	:param n_peaks: The maximum number of aligned peaks to select
+	:type n_peaks: int, optional
+	:param min_peak_area: The minimum average peak area
+	:type min_peak_area: float, optional
+	
+	:return: The positions of the selected aligned peaks, smallest to largest
+	:rtype: numpy.ndarray
+	"""
+	
+	n_aligned = rt_alignment.notna().to_numpy().sum(axis=1)
+	
+	# Average peak area for each of the aligned peaks, ignoring experiments that don't have the peak
+	areas = area_alignment.to_numpy(dtype=float)
+	with numpy.errstate(invalid="ignore"):
+		counts = numpy.count_nonzero(~numpy.isnan(areas), axis=1)
+		mean_areas = numpy.nansum(areas, axis=1) / counts
+	
+	candidates = numpy.flatnonzero((n_aligned >= min_aligned_peaks) & ~numpy.isnan(mean_areas))
+	
+	# Limit to the largest `n_peaks` peaks
+	if n_peaks > 0:
+		largest = candidates[numpy.argsort(mean_areas[candidates], kind="stable")][-n_peaks:]
+	else:
+		largest = candidates[:0]
+	
+	# Exclude peaks with an average peak area less than `min_peak_area`
+	return numpy.sort(largest[mean_areas[largest] >= min_peak_area])
 
 
 def align_in_separate_process(project):
 	project.align()
 
 
-def identify_in_separate_process(project):
-	project.identify_compounds()
+def identify_in_separate_process(project, progress_queue=None, cancel_event=None, resume=False):
+	"""
+	Perform Compound Identification, for use as the target of a :class:`multiprocessing.Process`.
+	
+	:param project:
+	:type project: Project
+	:param progress_queue: Queue to put the progress events onto
+	:type progress_queue: multiprocessing.Queue, optional
+	:param cancel_event: Event which cancels Compound Identification when set
+	:type cancel_event: multiprocessing.Event, optional
+	:param resume: Whether to skip experiments that have already been identified. Default False
+	:type resume: bool, optional
+	"""
+	
+	progress_callback = None if progress_queue is None else progress_queue.put
+	
+	try:
+		project.identify_compounds(progress_callback=progress_callback, cancel_event=cancel_event, resume=resume)
+	finally:
+		project.close_search_engine()
 	
 	
 def consolidate_in_separate_process(project):
-	project.consolidate()
+	try:
+		project.consolidate()
+	finally:
+		project.close_search_engine()
 
 
 def make_chart_data(project, peak_filter=None):
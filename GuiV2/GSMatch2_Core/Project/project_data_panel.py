@@ -29,6 +29,7 @@
 # stdlib
 import datetime
 import multiprocessing
+import queue
 import threading
 import warnings
 
@@ -538,35 +539,69 @@ Do you want to remove the existing Alignment data and continue?""",
 		
 		print(identify_performed)
 		
+		resume = False
+		
 		if identify_performed:
 			error_string = "Compound Identification has already been performed for the following experiments"
 
 			for experiment in identify_performed:
 				error_string += f"\n{experiment.name}: {experiment.ident_audit_record}"
 
-			with wx.MessageDialog(
-					self,
-					f"{error_string}\n\nDo you want to remove the existing data and continue?",
-					caption="Identify Compounds already performed",
-					style=wx.OK | wx.CANCEL | wx.CANCEL_DEFAULT | wx.CENTRE | wx.ICON_ERROR) as dlg:
-				dlg.SetOKLabel("Remove && Continue")
-				res = dlg.ShowModal()
-
-				if res == wx.ID_OK:
-					self.remove_identification_data()
-				else:
-					return
+			if len(identify_performed) < len(self.project.experiment_objects):
+				# A previous Compound Identification was cancelled or failed part way through
+				with wx.MessageDialog(
+						self,
+						f"{error_string}\n\nDo you want to identify the remaining experiments, "
+						f"or remove the existing data and start again?",
+						caption="Identify Compounds already performed",
+						style=wx.YES_NO | wx.CANCEL | wx.CANCEL_DEFAULT | wx.CENTRE | wx.ICON_QUESTION) as dlg:
+					dlg.SetYesNoCancelLabels("Resume", "Remove && Restart", "Cancel")
+					res = dlg.ShowModal()
+					
+					if res == wx.ID_YES:
+						resume = True
+					elif res == wx.ID_NO:
+						self.remove_identification_data()
+					else:
+						return
+			else:
+				with wx.MessageDialog(
+						self,
+						f"{error_string}\n\nDo you want to remove the existing data and continue?",
+						caption="Identify Compounds already performed",
+						style=wx.OK | wx.CANCEL | wx.CANCEL_DEFAULT | wx.CENTRE | wx.ICON_ERROR) as dlg:
+					dlg.SetOKLabel("Remove && Continue")
+					res = dlg.ShowModal()
+	
+					if res == wx.ID_OK:
+						self.remove_identification_data()
+					else:
+						return
+		
+		# Run in a separate process, with the progress events sent back through a queue
+		progress_queue = multiprocessing.Queue()
+		cancel_event = multiprocessing.Event()
+		process = multiprocessing.Process(
+				target=Project.identify_in_separate_process,
+				args=(self.project, progress_queue, cancel_event, resume),
+				)
+		process.start()
 		
-		# Create progressbar
-		thread = WorkerThread(self, Project.identify_in_separate_process)
-		thread.start()
-		self.prog_dialog = AnimatedProgDialog("Compound Identification In Progress...", self)
-		self.prog_dialog.ShowModal()
+		last_event = show_identification_progress(self, process, progress_queue, cancel_event)
+		process.join()
 		
+		# Completed experiments have been saved even if identification was cancelled or failed
 		self.reload_project()
 		
-		wx.CallAfter(pub.sendMessage, "on_ident_performed", project=self.project)
-		wx.CallAfter(self.create_ident_pages)
+		if last_event is not None and last_event.event == "failed":
+			wx.MessageDialog(
+					self, f"Compound Identification failed:\n{last_event.message}",
+					caption="Error", style=wx.OK | wx.CENTRE | wx.ICON_ERROR
+					).ShowModal()
+		
+		if all(experiment.identification_performed for experiment in self.project.experiment_objects):
+			wx.CallAfter(pub.sendMessage, "on_ident_performed", project=self.project)
+			wx.CallAfter(self.create_ident_pages)
 		# self.destroy_prog_dialog()
 
 	def consolidate(self):
@@ -887,6 +922,68 @@ Do you want to remove the existing Consolidate data and continue?""",
 
 # end of class ProjectDataPanel
 
+
+def show_identification_progress(parent, process, progress_queue, cancel_event):
+	"""
+	Show the progress of Compound Identification running in another process,
+	until the process finishes. If the user presses Cancel the ``cancel_event`` is set.
+
+	:param parent:
+	:type parent: wx.Window
+	:param process: The process performing Compound Identification
+	:type process: multiprocessing.Process
+	:param progress_queue: Queue the process puts its progress events onto
+	:type progress_queue: multiprocessing.Queue
+	:param cancel_event: Event which cancels Compound Identification when set
+	:type cancel_event: multiprocessing.Event
+
+	:return: The last progress event received
+	:rtype: GuiV2.GSMatch2_Core.Project.identify_pipeline.IdentificationProgress
+	"""
+	
+	maximum = 1000
+	last_event = None
+	
+	with wx.ProgressDialog(
+			"Compound Identification In Progress...",
+			"Preparing Compound Identification",
+			maximum=maximum,
+			parent=parent,
+			style=wx.PD_APP_MODAL | wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME | wx.PD_AUTO_HIDE,
+			) as dlg:
+		
+		value = 0
+		message = "Preparing Compound Identification"
+		
+		while process.is_alive() or not progress_queue.empty():
+			try:
+				event = progress_queue.get(timeout=0.1)
+			except queue.Empty:
+				event = None
+			
+			if event is not None:
+				last_event = event
+				
+				if event.n_experiments:
+					fraction = event.experiments_done
+					if event.event == "peak" and event.n_searches:
+						fraction += event.searches_done / event.n_searches
+					value = min(maximum - 1, int(maximum * fraction / event.n_experiments))
+				
+				if event.experiment is not None and not cancel_event.is_set():
+					message = (
+							f"Identifying Compounds for {event.experiment} "
+							f"({event.experiments_done + 1} of {event.n_experiments})"
+							)
+			
+			if not dlg.Update(value, message)[0] and not cancel_event.is_set():
+				# The search in progress is allowed to finish
+				cancel_event.set()
+				message = "Cancelling..."
+	
+	return last_event
+
+
 # TODO: Allow cancelling of operations
 
 class WorkerThread(threading.Thread):
@@ -0,0 +1,214 @@
+#  !/usr/bin/env python
+#   -*- coding: utf-8 -*-
+#
+#  similarity.py
+#
+#  This file is part of GunShotMatch
+#
+#  Copyright © 2020 Dominic Davis-Foster <dominic@davis-foster.co.uk>
+#
+#  GunShotMatch is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  GunShotMatch is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Similarity of the mass spectra of each aligned peak between every pair of Experiments.
+#
+#  Gives the same scores as
+#  ``chemistry_tools.spectrum_similarity.SpectrumSimilarity(top, bottom, t=0.25, b=1, xlim=(45, 500))``
+#  for every pair, but with all the spectra of all the aligned peaks placed on a common m/z grid,
+#  so the scores are found with a single matrix multiplication.
+#
+
+# stdlib
+import itertools
+
+# 3rd party
+import numpy
+import pandas
+
+
+def similarity_matrices(ms_data, b=1, xlim=(45, 500)):
+	"""
+	Returns the similarity between the mass spectra of each aligned peak in every pair of Experiments.
+
+	As with :func:`chemistry_tools.spectrum_similarity.SpectrumSimilarity`, the intensities are
+	expressed as a percentage of the most intense ion, and ions outside of ``xlim`` or less
+	intense than ``b`` are discarded. The score is the cosine of the angle between the spectra.
+
+	:param ms_data: The mass spectrum for each aligned peak (rows) in each Experiment (columns),
+		or ``None`` if the Experiment does not have that peak
+	:type ms_data: pandas.DataFrame
+	:param b: The minimum intensity of the ions, as a percentage of the most intense ion
+	:type b: float, optional
+	:param xlim: The range of m/z values to compare, inclusive
+	:type xlim: tuple of (float, float), optional
+
+	:return: Array (aligned peaks x Experiments x Experiments) of the similarity scores, from 0 to 1.
+		``NaN`` where either Experiment does not have the peak.
+	:rtype: numpy.ndarray
+	"""
+
+	n_peaks, n_experiments = ms_data.shape
+
+	peak_idx = []
+	experiment_idx = []
+	mass_lists = []
+	intensity_lists = []
+
+	for (row, column), mass_spec in numpy.ndenumerate(ms_data.to_numpy(dtype=object)):
+		if mass_spec is None or not hasattr(mass_spec, "mass_list") or not len(mass_spec.mass_list):
+			continue
+
+		peak_idx.append(row)
+		experiment_idx.append(column)
+		mass_lists.append(numpy.asarray(mass_spec.mass_list, dtype=float))
+		intensity_lists.append(numpy.asarray(mass_spec.intensity_list, dtype=float))
+
+	present = numpy.zeros((n_peaks, n_experiments), dtype=bool)
+
+	if not mass_lists:
+		return numpy.full((n_peaks, n_experiments, n_experiments), numpy.nan)
+
+	present[peak_idx, experiment_idx] = True
+
+	# All the ions from all the spectra, with the spectrum each came from
+	lengths = numpy.array([len(mass_list) for mass_list in mass_lists])
+	spectrum = numpy.repeat(numpy.arange(len(mass_lists)), lengths)
+	masses = numpy.concatenate(mass_lists)
+	intensities = numpy.concatenate(intensity_lists)
+
+	# Normalise to the most intense ion in the whole spectrum, before limiting to xlim
+	starts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+	with numpy.errstate(divide="ignore", invalid="ignore"):
+		normalised = intensities / numpy.maximum.reduceat(intensities, starts)[spectrum] * 100
+
+	keep = (masses >= xlim[0]) & (masses <= xlim[1]) & (normalised >= b)
+
+	# The common m/z grid
+	grid, mz_idx = numpy.unique(masses[keep], return_inverse=True)
+
+	spectra = numpy.zeros((n_peaks, n_experiments, len(grid)))
+	spectra[
+			numpy.asarray(peak_idx)[spectrum[keep]],
+			numpy.asarray(experiment_idx)[spectrum[keep]],
+			mz_idx,
+			] = normalised[keep]
+
+	# Spectra with no ions left give NaN, as with SpectrumSimilarity
+	with numpy.errstate(divide="ignore", invalid="ignore"):
+		unit_spectra = spectra / numpy.linalg.norm(spectra, axis=2, keepdims=True)
+
+	scores = numpy.matmul(unit_spectra, unit_spectra.transpose(0, 2, 1))
+
+	# Pairs where either Experiment doesn't have the peak
+	scores[~(present[:, :, None] & present[:, None, :])] = numpy.nan
+
+	return scores
+
+
+def ms_comparisons(ms_data, experiment_names=None, b=1, xlim=(45, 500)):
+	"""
+	Returns the similarity between the mass spectra of each aligned peak in every pair of Experiments,
+	scaled to 1000.
+
+	:param ms_data: The mass spectrum for each aligned peak (rows) in each Experiment (columns),
+		or ``None`` if the Experiment does not have that peak
+	:type ms_data: pandas.DataFrame
+	:param experiment_names: The Experiments to compare, in order. Defaults to all columns of ``ms_data``.
+	:type experiment_names: list of str, optional
+	:param b: The minimum intensity of the ions, as a percentage of the most intense ion
+	:type b: float, optional
+	:param xlim: The range of m/z values to compare, inclusive
+	:type xlim: tuple of (float, float), optional
+
+	:return: The similarity scores, with one row per aligned peak and one column for each pair of Experiments,
+		labelled ``"<first> & <second>"``
+	:rtype: pandas.DataFrame
+	"""
+
+	if experiment_names is None:
+		experiment_names = list(ms_data.columns)
+
+	scores = similarity_matrices(ms_data[experiment_names], b=b, xlim=xlim) * 1000
+
+	pairs = list(itertools.combinations(range(len(experiment_names)), 2))
+	first = [pair[0] for pair in pairs]
+	second = [pair[1] for pair in pairs]
+
+	return pandas.DataFrame(
+			scores[:, first, second],
+			index=ms_data.index,
+			columns=[f"{experiment_names[i]} & {experiment_names[j]}" for i, j in pairs],
+			)
+
+
+if __name__ == "__main__":
+	# Benchmark against SpectrumSimilarity for each pair, with random spectra
+	# for 40 experiments x 300 aligned peaks
+	# stdlib
+	import sys
+	import time
+	from types import SimpleNamespace
+
+	# 3rd party
+	from chemistry_tools import spectrum_similarity
+
+	n_experiments = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+	n_peaks = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+
+	rng = numpy.random.RandomState(1234)
+	names = [f"Experiment {idx}" for idx in range(n_experiments)]
+	data = {}
+
+	for name in names:
+		column = []
+		for _ in range(n_peaks):
+			if rng.rand() < 0.1:
+				column.append(None)
+			else:
+				mass_list = numpy.sort(rng.choice(numpy.arange(40, 520), 60, replace=False)).astype(float)
+				column.append(SimpleNamespace(mass_list=list(mass_list), intensity_list=list(rng.gamma(0.5, 1000, 60))))
+		data[name] = column
+
+	ms_data = pandas.DataFrame(data)
+
+	start = time.perf_counter()
+	comparisons = ms_comparisons(ms_data, names)
+	vectorised_time = time.perf_counter() - start
+
+	# Only time the pairwise calculation for a sample of the peaks, as it is slow
+	sample = range(min(n_peaks, 5))
+	max_difference = 0
+	start = time.perf_counter()
+
+	for peak in sample:
+		for label, (first, second) in zip(comparisons.columns, itertools.combinations(names, 2)):
+			top, bottom = ms_data.loc[peak, first], ms_data.loc[peak, second]
+			if top is None or bottom is None:
+				continue
+
+			expected = spectrum_similarity.SpectrumSimilarity(
+					numpy.column_stack((top.mass_list, top.intensity_list)),
+					numpy.column_stack((bottom.mass_list, bottom.intensity_list)),
+					t=0.25, b=1, xlim=(45, 500), x_threshold=0, print_graphic=False,
+					)[0] * 1000
+
+			max_difference = max(max_difference, abs(expected - comparisons.loc[peak, label]))
+
+	pairwise_time = (time.perf_counter() - start) / len(sample) * n_peaks
+
+	print(f"{n_experiments} experiments x {n_peaks} aligned peaks")
+	print(f"Vectorised: {vectorised_time:0.2f} s")
+	print(f"Pairwise:   {pairwise_time:0.2f} s (estimated from {len(sample)} peaks)")
+	print(f"Largest difference in score: {max_difference:0.2e}")
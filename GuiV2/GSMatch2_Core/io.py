@@ -26,20 +26,298 @@
 
 # stdlib
 import json
+import os
 import pathlib
 import tarfile
+import tempfile
+import threading
+from collections import OrderedDict
 from io import BytesIO
 
+# 3rd party
+import numpy
+
 # this package
 from GuiV2.GSMatch2_Core.InfoProperties import Property
 
 
+# The maximum number of archives to keep open in :func:`open_archive`
+MAX_OPEN_ARCHIVES = 8
+
+# PAX header marking a file as having been removed from an archive that is updated by appending.
+# See :func:`add_removed_marker`
+REMOVED_PAX_KEY = "GSMatch.removed"
+
+
+class ArchiveReader:
+	"""
+	Reads files from an Experiment or Project archive.
+
+	The archive is opened once and its members are indexed once,
+	so multiple files can be read without rescanning the archive.
+	Reads are serialised with a lock so a reader can be shared between threads.
+
+	If the archive contains more than one file with the same name the last one is used,
+	and files marked as removed by :func:`add_removed_marker` are ignored.
+	"""
+	
+	def __init__(self, archive):
+		"""
+		:param archive: The archive to read. If a :class:`tarfile.TarFile` is given it is not
+			closed when the reader is closed.
+		:type archive: str or pathlib.Path or io.BytesIO or tarfile.TarFile
+		"""
+		
+		self.path = None
+		self.compressed = False
+		self._owns_tarfile = True
+		
+		if isinstance(archive, (str, pathlib.Path)):
+			self.path = str(archive)
+			
+			try:
+				self.tarfile = tarfile.open(self.path, "r:")
+			except tarfile.ReadError:
+				self.tarfile = tarfile.open(self.path, "r")
+				self.compressed = True
+		
+		elif isinstance(archive, BytesIO):
+			archive.seek(0)
+			self.tarfile = tarfile.open(fileobj=archive, mode="r")
+		elif isinstance(archive, tarfile.TarFile):
+			self.tarfile = archive
+			self._owns_tarfile = False
+		else:
+			raise TypeError(
+					f"'archive' must be a string, pathlib.Path, io.BytesIO or tarfile.TarFile object, not {type(archive)}.")
+		
+		self._members = {}
+		
+		for member in self.tarfile.getmembers():
+			if REMOVED_PAX_KEY in member.pax_headers:
+				self._members.pop(member.name, None)
+			else:
+				self._members[member.name] = member
+		
+		self._lock = threading.RLock()
+	
+	@property
+	def names(self):
+		"""
+		Returns the names of the files in the archive
+
+		:rtype: list of str
+		"""
+		
+		return list(self._members)
+	
+	def __contains__(self, filename):
+		return filename in self._members
+	
+	def getmember(self, filename):
+		"""
+		Returns the :class:`tarfile.TarInfo` object for the given file
+
+		:param filename:
+		:type filename: str
+
+		:rtype: tarfile.TarInfo
+		"""
+		
+		try:
+			return self._members[filename]
+		except KeyError:
+			raise KeyError(f"filename '{filename}' not found in archive") from None
+	
+	def read(self, filename):
+		"""
+		Returns the contents of the given file in the archive
+
+		:param filename:
+		:type filename: str
+
+		:rtype: bytes
+		"""
+		
+		member = self.getmember(filename)
+		
+		with self._lock:
+			return self.tarfile.extractfile(member).read()
+	
+	def open(self, filename):
+		"""
+		Returns the given file in the archive as a file-like object
+
+		:param filename:
+		:type filename: str
+
+		:rtype: io.BytesIO
+		"""
+		
+		return BytesIO(self.read(filename))
+	
+	def load_array(self, filename, mmap=True):
+		"""
+		Load a numpy array stored in the archive as a ``.npy`` file.
+
+		If the reader was opened from the path of an uncompressed archive the
+		array is memory-mapped rather than being read into memory.
+
+		:param filename: The name of the ``.npy`` file in the archive
+		:type filename: str
+		:param mmap: Whether to memory-map the array if possible. Default True
+		:type mmap: bool, optional
+
+		:return: A read-only view of the array if it was memory-mapped, otherwise the array
+		:rtype: numpy.ndarray
+		"""
+		
+		member = self.getmember(filename)
+		
+		if mmap and self.path and not self.compressed and not member.issparse():
+			with self._lock:
+				fp = self.tarfile.extractfile(member)
+				
+				version = numpy.lib.format.read_magic(fp)
+				if version == (1, 0):
+					shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(fp)
+				else:
+					shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(fp)
+				header_length = fp.tell()
+			
+			if not dtype.hasobject:
+				return numpy.memmap(
+						self.path, dtype=dtype, mode="r", shape=shape,
+						order="F" if fortran_order else "C",
+						offset=member.offset_data + header_length,
+						)
+		
+		return numpy.load(self.open(filename), allow_pickle=False)
+	
+	def close(self):
+		"""
+		Close the archive
+		"""
+		
+		if self._owns_tarfile:
+			with self._lock:
+				self.tarfile.close()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+
+# Readers for archives on disk, keyed by path, in least recently used order.
+# Each value is a tuple of ``(mtime, size, reader)``
+_open_archives = OrderedDict()
+
+_open_archives_lock = threading.Lock()
+
+
+def open_archive(archive):
+	"""
+	Returns an :class:`ArchiveReader` for the given archive.
+
+	Readers for archives on disk are cached, and reused as long as the file has not been modified.
+	Up to :data:`MAX_OPEN_ARCHIVES` archives are kept open, with the least recently used closed first.
+	Readers for in-memory archives, such as the Experiments within a Project, are kept with
+	the buffer, and released along with it.
+	The reader should not be closed by the caller.
+
+	:param archive:
+	:type archive: str or pathlib.Path or io.BytesIO or tarfile.TarFile or
+		GuiV2.GSMatch2_Core.InfoProperties.Property
+
+	:rtype: ArchiveReader
+	"""
+	
+	if isinstance(archive, Property):
+		archive = archive.value
+	
+	if isinstance(archive, ArchiveReader):
+		return archive
+	
+	elif isinstance(archive, tarfile.TarFile):
+		return ArchiveReader(archive)
+	
+	elif isinstance(archive, BytesIO):
+		with _open_archives_lock:
+			reader = getattr(archive, "_archive_reader", None)
+			
+			if reader is None:
+				reader = ArchiveReader(archive)
+				archive._archive_reader = reader
+			
+			return reader
+	
+	elif isinstance(archive, (str, pathlib.Path)):
+		path = os.path.abspath(str(archive))
+		stat = os.stat(path)
+		
+		with _open_archives_lock:
+			if path in _open_archives:
+				mtime, size, reader = _open_archives[path]
+				
+				if (mtime, size) == (stat.st_mtime_ns, stat.st_size):
+					_open_archives.move_to_end(path)
+					return reader
+				
+				# The file has been modified since it was opened
+				del _open_archives[path]
+				reader.close()
+			
+			reader = ArchiveReader(path)
+			_open_archives[path] = (stat.st_mtime_ns, stat.st_size, reader)
+			
+			while len(_open_archives) > MAX_OPEN_ARCHIVES:
+				_open_archives.popitem(last=False)[1][2].close()
+			
+			return reader
+	
+	else:
+		raise TypeError(
+				f"'archive' must be a string, GuiV2.GSMatch2_Core.InfoProperties.Property, pathlib.Path, "
+				f"io.BytesIO or tarfile.TarFile object, not {type(archive)}."
+				)
+
+
+def close_archive(archive=None):
+	"""
+	Close the cached :class:`ArchiveReader` for the given archive,
+	e.g. before the archive is overwritten.
+
+	:param archive: The path of the archive, or the in-memory archive.
+		If ``None`` all cached readers for archives on disk are closed.
+	:type archive: str or pathlib.Path or io.BytesIO, optional
+	"""
+	
+	with _open_archives_lock:
+		if isinstance(archive, BytesIO):
+			reader = getattr(archive, "_archive_reader", None)
+			
+			if reader is not None:
+				del archive._archive_reader
+				reader.close()
+			
+			return
+		
+		if archive is None:
+			paths = list(_open_archives)
+		else:
+			paths = [os.path.abspath(str(archive))]
+		
+		for path in paths:
+			if path in _open_archives:
+				_open_archives.pop(path)[2].close()
+
+
 def load_info_json(filename):
 	"""
 	Load the info.json file from the given experiment or Project
 
-	Based on https://stackoverflow.com/a/23308087
-
 	:param filename:
 	:type filename:
 
@@ -47,50 +325,152 @@ def load_info_json(filename):
 	:rtype: dict
 	"""
 	
-	if isinstance(filename, (str, pathlib.Path)):
-		filename = tarfile.open(str(filename), "r")
-	elif isinstance(filename, BytesIO):
-		filename = tarfile.open(fileobj=filename, mode="r")
-	elif isinstance(filename, Property):
-		filename = tarfile.open(filename.value, mode="r")
-	elif not isinstance(filename, tarfile.TarFile):
-		raise TypeError(
-				f"'filename' must be a string, GuiV2.GSMatch2_Core.InfoProperties.Property, pathlib.Path, "
-				f"io.BytesIO or tarfile.TarFile object, not {type(filename)}."
-				)
-	
-	info_json = json.load(get_file_from_archive(filename, "info.json"))
-	filename.close()
-	return info_json
+	return json.loads(open_archive(filename).read("info.json").decode("utf-8"))
 
 
 def get_file_from_archive(archive, filename):
 	"""
 	Returns the given file from the given archive
 
-	Based on https://stackoverflow.com/a/23308087
-
 	:param archive:
-	:type archive:
+	:type archive: str or pathlib.Path or io.BytesIO or tarfile.TarFile
 	:param filename:
-	:type filename:
+	:type filename: str
 
 	:return:
-	:rtype:
+	:rtype: io.BytesIO
 	"""
 	
-	if isinstance(archive, (str, pathlib.Path)):
-		archive = tarfile.open(str(archive), "r")
-	elif isinstance(archive, BytesIO):
-		archive.seek(0)
-		archive = tarfile.open(fileobj=archive, mode="r")
-	elif not isinstance(archive, tarfile.TarFile):
-		raise TypeError(
-				f"'archive' must be a string, pathlib.Path, io.BytesIO or tarfile.TarFile object, not {type(archive)}.")
+	return open_archive(archive).open(filename)
+
+
+def archive_contains(archive, filename):
+	"""
+	Returns whether the given archive contains the given file
+
+	:param archive:
+	:type archive: str or pathlib.Path or io.BytesIO or tarfile.TarFile
+	:param filename:
+	:type filename: str
+
+	:rtype: bool
+	"""
+	
+	return filename in open_archive(archive)
+
+
+def add_bytes_to_archive(archive, data, arcname):
+	"""
+	Add a file with the given contents to the given archive
+
+	:param archive:
+	:type archive: tarfile.TarFile
+	:param data: The contents of the file
+	:type data: bytes
+	:param arcname: The name of the file in the archive
+	:type arcname: str
+	"""
+	
+	tarinfo = tarfile.TarInfo(arcname)
+	tarinfo.size = len(data)
+	archive.addfile(tarinfo=tarinfo, fileobj=BytesIO(data))
+
+
+def add_removed_marker(archive, arcname):
+	"""
+	Mark the given file as removed from an archive that is being appended to.
+
+	The marker is an empty file with the same name, so older versions of
+	GunShotMatch will see an empty file.
+	Files marked as removed are ignored by :class:`ArchiveReader`
+	and are discarded by :func:`compact_archive`.
+
+	:param archive:
+	:type archive: tarfile.TarFile
+	:param arcname: The name of the file to mark as removed
+	:type arcname: str
+	"""
+	
+	tarinfo = tarfile.TarInfo(arcname)
+	tarinfo.size = 0
+	tarinfo.pax_headers = {REMOVED_PAX_KEY: "1"}
+	archive.addfile(tarinfo=tarinfo)
+
+
+def compact_archive(filename):
+	"""
+	Rewrite the given archive keeping only the latest copy of each file,
+	discarding files that have been replaced or removed since it was last compacted.
+
+	:param filename:
+	:type filename: str or pathlib.Path
+	"""
+	
+	filename = os.path.abspath(str(filename))
+	reader = ArchiveReader(filename)
+	
+	try:
+		fd, tmp_filename = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(filename))
+		os.close(fd)
+		
+		try:
+			with tarfile.open(tmp_filename, mode="w") as archive:
+				for name in reader.names:
+					member = reader.getmember(name)
+					
+					if member.isfile():
+						archive.addfile(member, reader.tarfile.extractfile(member))
+					else:
+						archive.addfile(member)
+		except BaseException:
+			os.unlink(tmp_filename)
+			raise
+	finally:
+		reader.close()
+	
+	close_archive(filename)
+	os.replace(tmp_filename, filename)
+
+
+def add_array_to_archive(archive, array, arcname):
+	"""
+	Add a numpy array to the given archive as a ``.npy`` file.
+
+	The archive should be uncompressed so the array can later be memory-mapped by :func:`load_array_from_archive`.
+
+	:param archive:
+	:type archive: tarfile.TarFile
+	:param array:
+	:type array: numpy.ndarray
+	:param arcname: The name of the file in the archive
+	:type arcname: str
+	"""
+	
+	buf = BytesIO()
+	numpy.save(buf, numpy.ascontiguousarray(array), allow_pickle=False)
 	
-	extracted_file = archive.extractfile(dict(zip(
-			archive.getnames(),
-			archive.getmembers()
-			))[filename])
+	tarinfo = tarfile.TarInfo(arcname)
+	tarinfo.size = buf.tell()
+	buf.seek(0)
+	archive.addfile(tarinfo=tarinfo, fileobj=buf)
+
+
+def load_array_from_archive(archive, filename, mmap=True):
+	"""
+	Load a numpy array stored in the given archive as a ``.npy`` file.
+
+	If ``archive`` is the path of an uncompressed archive the array is memory-mapped
+	rather than being read into memory. Otherwise the array is read into memory.
+
+	:param archive:
+	:type archive: str or pathlib.Path or io.BytesIO or tarfile.TarFile
+	:param filename: The name of the ``.npy`` file in the archive
+	:type filename: str
+	:param mmap: Whether to memory-map the array if possible. Default True
+	:type mmap: bool, optional
+
+	:return: A read-only view of the array if it was memory-mapped, otherwise the array
+	:rtype: numpy.ndarray
+	"""
 	
-	return extracted_file
+	return open_archive(archive).load_array(filename, mmap=mmap)
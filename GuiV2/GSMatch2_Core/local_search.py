@@ -0,0 +1,818 @@
+#  !/usr/bin/env python
+#   -*- coding: utf-8 -*-
+#
+#  local_search.py
+#
+#  This file is part of GunShotMatch
+#
+#  Copyright © 2020 Dominic Davis-Foster <dominic@davis-foster.co.uk>
+#
+#  GunShotMatch is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  GunShotMatch is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Search engine for a spectral library in an MSP or JCAMP-DX file,
+#  without NIST MS Search.
+#
+#  The library spectra are binned to integer m/z, weighted, and stored as the rows of
+#  a sparse matrix, normalised to unit length. The match factors for a batch of
+#  mass spectra are then found with a single matrix multiplication.
+#
+#  The match factor is the squared cosine of the angle between the weighted spectra,
+#  scaled to 999, as described by:
+#
+#  Stein, S. E. and Scott, D. R. (1994)
+#  Optimization and testing of mass spectral library search algorithms for compound identification.
+#  J. Am. Soc. Mass Spectrom. 5 (9), 859–866. https://doi.org/10.1016/1044-0305(94)87009-8
+#
+#  To avoid scoring every spectrum in the library, only the library spectra which share
+#  at least one of their most intense ions with the unknown spectrum are scored,
+#  optionally limited to a range of molecular weights.
+#
+#  The reverse match factor ignores ions in the unknown spectrum that are absent from the library spectrum.
+#  The additional terms of NIST MS Search's composite match factor are not included,
+#  so match factors are similar, but not identical, to those from NIST MS Search.
+#
+
+# stdlib
+import pathlib
+import re
+import threading
+
+# 3rd party
+import numpy
+from pyms.Spectrum import MassSpectrum
+from pyms_nist_search import ReferenceData, SearchResult
+from scipy import sparse
+
+# this package
+from GuiV2.GSMatch2_Core.Config import internal_config
+from GuiV2.GSMatch2_Core.nist_search import DEFAULT_CHUNK_SIZE, spectrum_fingerprint
+
+
+# Weighting of the intensities and m/z values before the dot product, from Stein and Scott (1994)
+INTENSITY_POWER = 0.6
+MZ_POWER = 3
+
+# The maximum match factor, as used by NIST MS Search
+MAX_MATCH_FACTOR = 999
+
+# The number of most intense ions of each spectrum used to find the library spectra to score
+INDEX_IONS = 8
+
+JCAMP_SUFFIXES = {".jdx", ".dx", ".jcamp"}
+
+_peak_re = re.compile(r"(\d+(?:\.\d*)?)[\s:]+(\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)")
+_jcamp_peak_re = re.compile(r"(\d+(?:\.\d*)?)\s*,\s*(\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)")
+_nist_no_re = re.compile(r"NIST#:\s*(\d+)", re.IGNORECASE)
+
+
+def _new_entry(name):
+	return {
+			"name": name,
+			"cas": "---",
+			"formula": '',
+			"mw": 0.0,
+			"nist_no": 0,
+			"contributor": '',
+			"synonyms": [],
+			"mass_list": [],
+			"intensity_list": [],
+			}
+
+
+def read_msp_library(filename):
+	"""
+	Read the spectra and their details from an MSP library file, one at a time
+
+	:param filename: The filename of the MSP file
+	:type filename: str or pathlib.Path
+
+	:return: Dictionaries with the keys ``name``, ``cas``, ``formula``, ``mw``, ``nist_no``,
+		``contributor``, ``synonyms``, ``mass_list`` and ``intensity_list``
+	:rtype: generator of dict
+	"""
+
+	entry = None
+
+	with open(filename, encoding="latin-1") as fp:
+		for line in fp:
+			line = line.strip()
+
+			if not line:
+				continue
+
+			if line[0].isdigit():
+				# One or more "mass intensity" pairs
+				if entry is not None:
+					for mass, intensity in _peak_re.findall(line):
+						entry["mass_list"].append(float(mass))
+						entry["intensity_list"].append(float(intensity))
+				continue
+
+			key, sep, value = line.partition(":")
+			if not sep:
+				continue
+
+			key = key.strip().lower()
+			value = value.strip()
+
+			if key == "name":
+				if entry is not None:
+					yield entry
+				entry = _new_entry(value)
+
+			elif entry is None:
+				continue
+
+			elif key in {"cas#", "casno", "cas"}:
+				# NIST exports have e.g. "CAS#: 64-17-5; NIST#: 228"
+				cas, _, rest = value.partition(";")
+				entry["cas"] = cas.strip() or "---"
+
+				nist_no = _nist_no_re.search(rest)
+				if nist_no:
+					entry["nist_no"] = int(nist_no.group(1))
+
+			elif key in {"nist#", "db#"}:
+				if value.isdigit():
+					entry["nist_no"] = int(value)
+
+			elif key == "formula":
+				entry["formula"] = value
+
+			elif key == "mw":
+				try:
+					entry["mw"] = float(value)
+				except ValueError:
+					pass
+
+			elif key == "synon":
+				entry["synonyms"].append(value)
+
+			elif key == "contributor":
+				entry["contributor"] = value
+
+	if entry is not None:
+		yield entry
+
+
+def read_jcamp_library(filename):
+	"""
+	Read the spectra and their details from a JCAMP-DX library file, one at a time
+
+	:param filename: The filename of the JCAMP-DX file
+	:type filename: str or pathlib.Path
+
+	:return: Dictionaries with the same keys as :func:`read_msp_library`
+	:rtype: generator of dict
+	"""
+
+	entry = None
+	in_data = False
+
+	with open(filename, encoding="latin-1") as fp:
+		for line in fp:
+			line = line.strip()
+
+			if not line or line.startswith("$$"):
+				continue
+
+			if line.startswith("##"):
+				in_data = False
+				label, _, value = line[2:].partition("=")
+				label = label.strip().upper()
+				value = value.strip()
+
+				if label == "TITLE":
+					entry = _new_entry(value)
+
+				elif entry is None:
+					continue
+
+				elif label in {"CAS REGISTRY NO", "CAS REGISTRY NUMBER"}:
+					entry["cas"] = value or "---"
+
+				elif label == "MOLFORM":
+					entry["formula"] = value
+
+				elif label == "MW":
+					try:
+						entry["mw"] = float(value)
+					except ValueError:
+						pass
+
+				elif label == "ORIGIN":
+					entry["contributor"] = value
+
+				elif label in {"XYDATA", "PEAK TABLE"}:
+					in_data = True
+
+				elif label == "END":
+					if entry["mass_list"]:
+						yield entry
+					entry = None
+
+			elif in_data and entry is not None:
+				for mass, intensity in _jcamp_peak_re.findall(line):
+					entry["mass_list"].append(float(mass))
+					entry["intensity_list"].append(float(intensity))
+
+
+def _binned_matrix(spectra, n_bins=None):
+	"""
+	Returns the weighted intensities of the given spectra, binned to integer m/z
+
+	:param spectra: ``(mass_list, intensity_list)`` tuples
+	:type spectra: list of tuple
+	:param n_bins: The number of m/z bins. If not given the largest m/z in the spectra is used.
+	:type n_bins: int, optional
+
+	:return: The binned spectra, and the sum of the squared weighted intensities of
+		each spectrum, including any ions beyond ``n_bins``
+	:rtype: tuple of (scipy.sparse.csr_matrix, numpy.ndarray)
+	"""
+
+	lengths = numpy.fromiter((len(mass_list) for mass_list, _ in spectra), dtype=int, count=len(spectra))
+	rows = numpy.repeat(numpy.arange(len(spectra)), lengths)
+
+	if lengths.sum():
+		bins = numpy.rint(numpy.concatenate([mass_list for mass_list, _ in spectra])).astype(int)
+		intensities = numpy.concatenate([intensity_list for _, intensity_list in spectra]).astype(float)
+	else:
+		bins = numpy.zeros(0, dtype=int)
+		intensities = numpy.zeros(0, dtype=float)
+
+	all_bins = max(int(bins.max(initial=0)) + 1, n_bins or 0)
+
+	# Intensities in the same bin are summed before weighting
+	matrix = sparse.coo_matrix((intensities, (rows, bins)), shape=(len(spectra), all_bins)).tocsr()
+	matrix.sum_duplicates()
+	matrix.eliminate_zeros()
+
+	matrix.data = matrix.data ** INTENSITY_POWER * matrix.indices.astype(float) ** MZ_POWER
+	norms2 = numpy.asarray(matrix.multiply(matrix).sum(axis=1)).ravel()
+
+	if n_bins is not None and all_bins > n_bins:
+		matrix = matrix[:, :n_bins]
+
+	return matrix, norms2
+
+
+def _top_ions(matrix, n_ions):
+	"""
+	Returns which of the ions in each spectrum are among its ``n_ions`` most intense ions
+
+	:param matrix: Binned spectra from :func:`_binned_matrix`
+	:type matrix: scipy.sparse.csr_matrix
+	:param n_ions:
+	:type n_ions: int
+
+	:return: Matrix with the same shape as ``matrix``, with a 1 for each of the most intense ions
+	:rtype: scipy.sparse.csr_matrix
+	"""
+
+	rows = numpy.repeat(numpy.arange(matrix.shape[0]), numpy.diff(matrix.indptr))
+
+	# Undo the m/z weighting, which leaves the intensities in the same order
+	intensities = matrix.data / numpy.maximum(matrix.indices, 1).astype(float) ** MZ_POWER
+
+	# Sort by spectrum, then most intense first, and rank the ions within each spectrum
+	order = numpy.lexsort((-intensities, rows))
+	rank = numpy.arange(len(order)) - matrix.indptr[rows[order]]
+	keep = order[rank < n_ions]
+
+	return sparse.csr_matrix(
+			(numpy.ones(len(keep), dtype=numpy.float32), (rows[keep], matrix.indices[keep])),
+			shape=matrix.shape,
+			)
+
+
+class SpectralLibrary:
+	"""
+	A mass spectral library held in memory, for searching with :class:`LocalSearchEngine`
+
+	To avoid scoring every spectrum in the library, the library spectra are indexed by their
+	most intense ions. Only library spectra which share at least one of their most intense
+	ions with the most intense ions of the unknown spectrum are scored.
+	"""
+
+	def __init__(self, entries, n_index_ions=INDEX_IONS):
+		"""
+		:param entries: Dictionaries with the keys returned by :func:`read_msp_library`
+		:type entries: iterable of dict
+		:param n_index_ions: The number of most intense ions of each spectrum to index
+		:type n_index_ions: int, optional
+		"""
+
+		self.entries = [entry for entry in entries if entry["mass_list"]]
+		self.n_index_ions = int(n_index_ions)
+		self.mw = numpy.array([entry["mw"] for entry in self.entries], dtype=float)
+
+		if not self.entries:
+			self.matrix = sparse.csr_matrix((0, 1), dtype=numpy.float32)
+			self.mask = self.matrix.copy()
+			self.ion_index = self.matrix.copy()
+			return
+
+		matrix, norms2 = _binned_matrix([(entry["mass_list"], entry["intensity_list"]) for entry in self.entries])
+
+		# Normalise each spectrum to unit length, leaving empty spectra as zeros
+		with numpy.errstate(divide="ignore"):
+			scale = numpy.where(norms2 > 0, 1 / numpy.sqrt(norms2), 0)
+
+		self.matrix = sparse.diags(scale).dot(matrix).tocsr().astype(numpy.float32)
+
+		# Which ions are present in each spectrum, for the reverse match factor
+		self.mask = self.matrix.copy()
+		self.mask.data[:] = 1
+
+		# The inverted index of the most intense ions, for finding the candidates to score
+		self.ion_index = _top_ions(matrix, self.n_index_ions)
+
+	@classmethod
+	def from_file(cls, filename, n_index_ions=INDEX_IONS):
+		"""
+		Load a library from an MSP or JCAMP-DX file
+
+		:param filename:
+		:type filename: str or pathlib.Path
+		:param n_index_ions: The number of most intense ions of each spectrum to index
+		:type n_index_ions: int, optional
+
+		:rtype: SpectralLibrary
+		"""
+
+		filename = pathlib.Path(filename)
+
+		if filename.suffix.lower() in JCAMP_SUFFIXES:
+			return cls(read_jcamp_library(filename), n_index_ions)
+		else:
+			return cls(read_msp_library(filename), n_index_ions)
+
+	def __len__(self):
+		return len(self.entries)
+
+	@property
+	def n_bins(self):
+		"""
+		Returns the number of m/z bins
+
+		:rtype: int
+		"""
+
+		return self.matrix.shape[1]
+
+	def get_candidates(self, spectra, mw_range=None):
+		"""
+		Returns the library spectra to score for each of the given spectra
+
+		:param spectra: ``(mass_list, intensity_list)`` tuples
+		:type spectra: list of tuple
+		:param mw_range: If given, only library spectra for compounds with a molecular weight
+			in this range, inclusive, are candidates. Spectra without a molecular weight are always candidates.
+		:type mw_range: tuple of (float, float), optional
+
+		:return: The locations of the candidates in the library, and a boolean array
+			(candidates x spectra) showing which of them are candidates for each spectrum
+		:rtype: tuple of (numpy.ndarray, numpy.ndarray)
+		"""
+
+		queries, _ = _binned_matrix(spectra, self.n_bins)
+
+		# (library spectra x queries) count of the most intense ions in common
+		shared = self.ion_index.dot(_top_ions(queries, self.n_index_ions).T).tocsr()
+		shared.eliminate_zeros()
+
+		spec_locs = numpy.flatnonzero(numpy.diff(shared.indptr))
+
+		if mw_range is not None:
+			mw = self.mw[spec_locs]
+			spec_locs = spec_locs[(mw <= 0) | ((mw >= mw_range[0]) & (mw <= mw_range[1]))]
+
+		return spec_locs, shared[spec_locs].toarray() > 0
+
+	def search(self, spectra, n_hits=5, use_index=True, mw_range=None):
+		"""
+		Search the library for each of the given spectra
+
+		:param spectra: ``(mass_list, intensity_list)`` tuples
+		:type spectra: list of tuple
+		:param n_hits: The number of hits to return for each spectrum
+		:type n_hits: int, optional
+		:param use_index: Whether to only score the library spectra which share one of their
+			most intense ions with the spectrum. If False every library spectrum is scored.
+		:type use_index: bool, optional
+		:param mw_range: If given, only library spectra for compounds with a molecular weight
+			in this range, inclusive, are scored. Spectra without a molecular weight are always scored.
+		:type mw_range: tuple of (float, float), optional
+
+		:return: ``(spec_loc, match_factor, reverse_match_factor)`` tuples for the hits for each
+			spectrum, best first. Library spectra with a match factor of 0 are not included.
+		:rtype: list of lists of tuple
+		"""
+
+		if not spectra:
+			return []
+		if not len(self):
+			return [[] for _ in spectra]
+
+		if use_index:
+			spec_locs, is_candidate = self.get_candidates(spectra, mw_range)
+
+			# Spectra with no candidates, e.g. with no ions in common with the library, are searched in full
+			no_candidates = numpy.flatnonzero(~is_candidate.any(axis=0))
+		else:
+			spec_locs = numpy.arange(len(self))
+			if mw_range is not None:
+				mw = self.mw
+				spec_locs = spec_locs[(mw <= 0) | ((mw >= mw_range[0]) & (mw <= mw_range[1]))]
+			is_candidate = None
+			no_candidates = []
+
+		results = self._score(spectra, spec_locs, is_candidate, n_hits)
+
+		if use_index and len(no_candidates):
+			full_results = self.search(
+					[spectra[query_idx] for query_idx in no_candidates], n_hits,
+					use_index=False, mw_range=mw_range,
+					)
+			for query_idx, hits in zip(no_candidates, full_results):
+				results[query_idx] = hits
+
+		return results
+
+	def _score(self, spectra, spec_locs, is_candidate, n_hits):
+		"""
+		Score the given spectra against the library spectra at ``spec_locs``
+
+		:param spectra: ``(mass_list, intensity_list)`` tuples
+		:type spectra: list of tuple
+		:param spec_locs: The locations of the library spectra to score
+		:type spec_locs: numpy.ndarray
+		:param is_candidate: Boolean array (``spec_locs`` x spectra) showing which library spectra
+			to score for each spectrum. If ``None`` all are scored.
+		:type is_candidate: numpy.ndarray or None
+		:param n_hits:
+		:type n_hits: int
+
+		:rtype: list of lists of tuple
+		"""
+
+		if not len(spec_locs):
+			return [[] for _ in spectra]
+
+		queries, norms2 = _binned_matrix(spectra, self.n_bins)
+		queries = queries.astype(numpy.float32)
+
+		# (library spectra x queries)
+		dot = numpy.asarray(self.matrix[spec_locs].dot(queries.T).todense())
+		masked_norms2 = numpy.asarray(self.mask[spec_locs].dot(queries.multiply(queries).T).todense())
+
+		dot2 = dot * dot
+
+		with numpy.errstate(divide="ignore", invalid="ignore"):
+			match_factors = numpy.where(norms2 > 0, dot2 / norms2, 0) * MAX_MATCH_FACTOR
+			reverse_match_factors = numpy.where(masked_norms2 > 0, dot2 / masked_norms2, 0) * MAX_MATCH_FACTOR
+
+		match_factors = numpy.rint(match_factors).astype(int)
+		reverse_match_factors = numpy.rint(reverse_match_factors).astype(int)
+
+		if is_candidate is not None:
+			match_factors[~is_candidate] = 0
+
+		n_hits = min(int(n_hits), len(spec_locs))
+		results = []
+
+		for query_idx in range(len(spectra)):
+			query_mf = match_factors[:, query_idx]
+			query_rmf = reverse_match_factors[:, query_idx]
+
+			if n_hits < len(spec_locs):
+				candidates = numpy.argpartition(-query_mf, n_hits - 1)[:n_hits]
+			else:
+				candidates = numpy.arange(len(spec_locs))
+
+			# Best match factor first, then best reverse match factor
+			candidates = candidates[numpy.lexsort((-query_rmf[candidates], -query_mf[candidates]))]
+
+			results.append([
+					(int(spec_locs[idx]), int(query_mf[idx]), int(query_rmf[idx]))
+					for idx in candidates
+					if query_mf[idx] > 0
+					])
+
+		return results
+
+
+def check_recall(library, spectra, n_hits=1, mw_range=None):
+	"""
+	Returns the proportion of the given spectra for which searching with the index
+	finds hits as good as scoring every spectrum in the library.
+
+	The spectra should not be in the library, e.g. spectra held out when the library was built.
+
+	:param library:
+	:type library: SpectralLibrary
+	:param spectra: ``(mass_list, intensity_list)`` tuples
+	:type spectra: list of tuple
+	:param n_hits: The number of top hits to compare
+	:type n_hits: int, optional
+	:param mw_range: Molecular weight range for both searches
+	:type mw_range: tuple of (float, float), optional
+
+	:rtype: float
+	"""
+
+	if not spectra:
+		return 1.0
+
+	indexed = library.search(spectra, n_hits, use_index=True, mw_range=mw_range)
+	exhaustive = library.search(spectra, n_hits, use_index=False, mw_range=mw_range)
+
+	# Compare the match factors, so that ties between library spectra don't count as misses
+	found = sum(
+			[hit[1] for hit in indexed_hits] == [hit[1] for hit in exhaustive_hits]
+			for indexed_hits, exhaustive_hits in zip(indexed, exhaustive)
+			)
+
+	return found / len(spectra)
+
+
+class LocalSearchEngine:
+	"""
+	Search engine for a mass spectral library in an MSP or JCAMP-DX file,
+	which can be used in place of :class:`~GuiV2.GSMatch2_Core.nist_search.SearchEngine`.
+
+	The results are :class:`pyms_nist_search.SearchResult` and :class:`pyms_nist_search.ReferenceData` objects,
+	the same as from NIST MS Search, with the location of the spectrum in the library as ``spec_loc``.
+
+	The library is loaded when it is first searched, and remains loaded until :meth:`uninit` is called.
+	"""
+
+	def __init__(self, library_path=None, use_index=True, mw_range=None):
+		"""
+		:param library_path: The path to the mass spectral library. Defaults to
+			:attr:`~GuiV2.GSMatch2_Core.Config.InternalConfig.local_library_path`
+		:type library_path: str or pathlib.Path, optional
+		:param use_index: Whether to only score the library spectra which share one of their
+			most intense ions with the unknown spectrum. Default True
+		:type use_index: bool, optional
+		:param mw_range: If given, only library spectra for compounds with a molecular weight
+			in this range are scored
+		:type mw_range: tuple of (float, float), optional
+		"""
+
+		if library_path is None:
+			library_path = internal_config.local_library_path
+
+		self.library_path = library_path
+		self.use_index = use_index
+		self.mw_range = mw_range
+
+		# Searching is fast enough not to need the persistent search result cache
+		self.cache = None
+
+		self._library = None
+		self._lock = threading.RLock()
+
+	def __getstate__(self):
+		# The library will be loaded again in the other process
+		state = self.__dict__.copy()
+		state["_library"] = None
+		state["_lock"] = None
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.RLock()
+
+	@property
+	def library_id(self):
+		"""
+		Returns a string identifying the library being searched
+
+		:rtype: str
+		"""
+
+		return f"{pathlib.Path(self.library_path).absolute().as_posix()}:local"
+
+	@property
+	def is_initialised(self):
+		"""
+		Returns whether the library is currently loaded
+
+		:rtype: bool
+		"""
+
+		return self._library is not None
+
+	@property
+	def library(self):
+		"""
+		Returns the mass spectral library, loading it if necessary
+
+		:rtype: SpectralLibrary
+		"""
+
+		self.init()
+		return self._library
+
+	def init(self):
+		"""
+		Load the library, if it is not already loaded
+		"""
+
+		with self._lock:
+			if self._library is None:
+				if not self.library_path:
+					raise ValueError("No library has been set for the local search engine")
+
+				print(f"Loading mass spectral library from {self.library_path}")
+				self._library = SpectralLibrary.from_file(self.library_path)
+				print(f"Loaded {len(self._library)} spectra")
+
+	def uninit(self):
+		"""
+		Unload the library, if it is loaded
+		"""
+
+		with self._lock:
+			self._library = None
+
+	def restart(self):
+		"""
+		Unload and then load the library
+		"""
+
+		with self._lock:
+			self.uninit()
+			self.init()
+
+	def __enter__(self):
+		self.init()
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.uninit()
+
+	def full_spectrum_search(self, mass_spec, n_hits=5):
+		"""
+		Perform a Full Spectrum Search of the mass spectral library
+
+		:param mass_spec: The mass spectrum to search against the library
+		:type mass_spec: pyms.Spectrum.MassSpectrum
+		:param n_hits: The number of hits to return
+		:type n_hits: int, optional
+
+		:return: List of possible identities for the mass spectrum
+		:rtype: list of pyms_nist_search.SearchResult
+		"""
+
+		return self.batch_spectrum_search([mass_spec], n_hits)[0]
+
+	def batch_spectrum_search(
+			self, mass_specs, n_hits=5, chunk_size=DEFAULT_CHUNK_SIZE,
+			progress_callback=None, results=None,
+			):
+		"""
+		Perform a Full Spectrum Search of the mass spectral library for each of the given mass spectra.
+
+		Near-identical spectra are only searched once, and the unique spectra
+		are searched in chunks, each with a single matrix multiplication.
+
+		:param mass_specs: The mass spectra to search against the library
+		:type mass_specs: list of pyms.Spectrum.MassSpectrum
+		:param n_hits: The number of hits to return for each spectrum
+		:type n_hits: int, optional
+		:param chunk_size: The number of spectra to search at once
+		:type chunk_size: int, optional
+		:param progress_callback: Function called after each chunk with the number of unique spectra
+			searched so far and the total number of unique spectra
+		:type progress_callback: function, optional
+		:param results: Mapping of spectrum fingerprints to the results of earlier searches,
+			as for :meth:`GuiV2.GSMatch2_Core.nist_search.SearchEngine.batch_spectrum_search`
+		:type results: dict, optional
+
+		:return: List of possible identities for each mass spectrum, in the same order as ``mass_specs``
+		:rtype: list of lists of pyms_nist_search.SearchResult
+		"""
+
+		library = self.library
+		chunk_size = max(1, int(chunk_size))
+
+		if results is None:
+			results = {}
+
+		# Map each spectrum to the first spectrum with the same fingerprint
+		unique_specs = {}
+		fingerprints = []
+
+		for mass_spec in mass_specs:
+			fingerprint = spectrum_fingerprint(mass_spec)
+			fingerprints.append(fingerprint)
+			if fingerprint not in results:
+				unique_specs.setdefault(fingerprint, mass_spec)
+
+		unique_items = list(unique_specs.items())
+
+		for chunk_start in range(0, len(unique_items), chunk_size):
+			chunk = unique_items[chunk_start:chunk_start + chunk_size]
+
+			spectra = [(mass_spec.mass_list, mass_spec.intensity_list) for _, mass_spec in chunk]
+			all_hits = library.search(spectra, n_hits, use_index=self.use_index, mw_range=self.mw_range)
+
+			for (fingerprint, _), hits in zip(chunk, all_hits):
+				results[fingerprint] = [
+						self._make_search_result(spec_loc, match_factor, reverse_match_factor)
+						for spec_loc, match_factor, reverse_match_factor in hits
+						]
+
+			if progress_callback is not None:
+				progress_callback(min(chunk_start + chunk_size, len(unique_items)), len(unique_items))
+
+		# Each spectrum gets its own list, as the hits are stored separately for each peak
+		return [list(results[fingerprint]) for fingerprint in fingerprints]
+
+	def _make_search_result(self, spec_loc, match_factor, reverse_match_factor):
+		entry = self._library.entries[spec_loc]
+
+		return SearchResult(
+				name=entry["name"],
+				cas=entry["cas"],
+				match_factor=match_factor,
+				reverse_match_factor=reverse_match_factor,
+				spec_loc=spec_loc,
+				)
+
+	def get_reference_data(self, spec_loc):
+		"""
+		Get reference data from the library for the compound at the given location
+
+		:param spec_loc:
+		:type spec_loc: int
+
+		:rtype: pyms_nist_search.ReferenceData
+		"""
+
+		entry = self.library.entries[spec_loc]
+
+		return ReferenceData(
+				name=entry["name"],
+				cas=entry["cas"],
+				nist_no=entry["nist_no"],
+				id=str(spec_loc),
+				mw=entry["mw"],
+				formula=entry["formula"],
+				contributor=entry["contributor"],
+				mass_spec=MassSpectrum(entry["mass_list"], entry["intensity_list"]),
+				synonyms=entry["synonyms"][:],
+				)
+
+	def get_reference_data_bulk(self, spec_locs):
+		"""
+		Get reference data from the library for the compounds at each of the given locations.
+
+		:param spec_locs:
+		:type spec_locs: iterable of int
+
+		:return: Mapping of locations to reference data
+		:rtype: dict
+		"""
+
+		return {spec_loc: self.get_reference_data(spec_loc) for spec_loc in set(spec_locs)}
+
+
+if __name__ == "__main__":
+	# Check that searching with the index finds the same top hit as scoring every library spectrum,
+	# holding out every 20th spectrum of the library given on the command line as the unknowns
+	# stdlib
+	import sys
+	import time
+
+	entries = list(SpectralLibrary.from_file(sys.argv[1]).entries)
+	held_out = [(entry["mass_list"], entry["intensity_list"]) for entry in entries[::20]]
+	library = SpectralLibrary([entry for idx, entry in enumerate(entries) if idx % 20])
+
+	print(f"{len(library)} library spectra, {len(held_out)} held out")
+
+	_, is_candidate = library.get_candidates(held_out)
+	print(f"Candidates: {is_candidate.sum(axis=0).mean():0.1f} of {len(library)} library spectra on average")
+
+	for use_index in (False, True):
+		start = time.perf_counter()
+		library.search(held_out, 5, use_index=use_index)
+		print(f"use_index={use_index}: {len(held_out) / (time.perf_counter() - start):0.1f} spectra/s")
+
+	print(f"Top hit recall: {check_recall(library, held_out):0.2%}")
@@ -0,0 +1,491 @@
+#  !/usr/bin/env python
+#   -*- coding: utf-8 -*-
+#
+#  nist_search.py
+#
+#  This file is part of GunShotMatch
+#
+#  Copyright © 2020 Dominic Davis-Foster <dominic@davis-foster.co.uk>
+#
+#  GunShotMatch is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  GunShotMatch is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+
+# stdlib
+import atexit
+import hashlib
+import pathlib
+import threading
+import traceback
+
+# 3rd party
+import pyms_nist_search
+
+# this package
+from GuiV2.GSMatch2_Core import Base
+from GuiV2.GSMatch2_Core.Config import internal_config
+from GuiV2.GSMatch2_Core.search_cache import get_search_cache
+
+
+# The number of unique spectra searched at once by :meth:`SearchEngine.batch_spectrum_search`
+DEFAULT_CHUNK_SIZE = 50
+
+# The intensity scale used for :func:`spectrum_fingerprint`, the same as that used by NIST MS Search
+FINGERPRINT_SCALE = 999
+
+
+def spectrum_fingerprint(mass_spec):
+	"""
+	Returns a fingerprint of the given mass spectrum that is the same for near-identical spectra.
+
+	The m/z values are rounded to the nearest integer and the intensities are normalised to
+	the base peak and rounded to integers between 0 and 999, as NIST MS Search does when
+	searching the library. Ions with an intensity of 0 on that scale are discarded.
+
+	:param mass_spec:
+	:type mass_spec: pyms.Spectrum.MassSpectrum
+
+	:rtype: str
+	"""
+
+	mass_list = mass_spec.mass_list
+	intensity_list = mass_spec.intensity_list
+
+	max_intensity = max(intensity_list, default=0)
+	sha1 = hashlib.sha1()
+
+	if max_intensity > 0:
+		for mass, intensity in sorted(zip(mass_list, intensity_list)):
+			scaled = int(round(intensity / max_intensity * FINGERPRINT_SCALE))
+			if scaled > 0:
+				sha1.update(f"{int(round(mass))}:{scaled};".encode("ascii"))
+
+	return sha1.hexdigest()
+
+
+def identify_peaks(peaks, search, n_hits=5, chunk_size=DEFAULT_CHUNK_SIZE, progress_callback=None, results=None):
+	"""
+	Identify the given peaks with a single batch search, and add the hits to each peak.
+
+	The peaks may come from several Experiments.
+
+	:param peaks:
+	:type peaks: list of :class:`~GuiV2.GSMatch2_Core.Experiment.identification.QualifiedPeak`
+	:param search:
+	:type search: SearchEngine
+	:param n_hits: The number of hits to return for each peak
+	:type n_hits: int, optional
+	:param chunk_size: The number of unique spectra to search while holding the lock
+	:type chunk_size: int, optional
+	:param progress_callback: Function called after each chunk with the number of unique spectra
+		searched so far and the total number of unique spectra
+	:type progress_callback: function, optional
+	:param results: Search results from earlier calls, which are reused and added to.
+		See :meth:`SearchEngine.batch_spectrum_search`
+	:type results: dict, optional
+	"""
+
+	print(f"Identifying {len(peaks)} peaks...")
+
+	hit_lists = search.batch_spectrum_search(
+			[peak.mass_spectrum for peak in peaks],
+			n_hits,
+			chunk_size=chunk_size,
+			progress_callback=progress_callback,
+			results=results,
+			)
+
+	for peak, hit_list in zip(peaks, hit_lists):
+		# Add search results to peak
+		peak.hits.extend(hit_list)
+
+	if search.cache is not None:
+		print(search.cache)
+
+
+def create_search_engine():
+	"""
+	Returns a new search engine for Compound Identification,
+	using the backend chosen in the internal configuration.
+
+	:rtype: SearchEngine or GuiV2.GSMatch2_Core.local_search.LocalSearchEngine
+	"""
+
+	if internal_config.search_backend == "local":
+		# this package
+		from GuiV2.GSMatch2_Core.local_search import LocalSearchEngine
+
+		return LocalSearchEngine()
+
+	return SearchEngine()
+
+
+class SearchError(Exception):
+	"""
+	Raised when a search with NIST MS Search fails, even after restarting the search engine
+	"""
+
+
+class SearchEngine:
+	"""
+	A long-lived NIST MS Search engine that can be shared between Experiments.
+
+	The underlying :class:`pyms_nist_search.Engine` is initialised when it is first used,
+	which loads the library, and is then reused for every search until :meth:`uninit` is called.
+	Only one :class:`pyms_nist_search.Engine` can be used at a time, so searches are serialised with a lock.
+
+	If a search fails the engine is restarted and the search retried.
+	If it still fails a :class:`SearchError` is raised for that search,
+	but the engine remains usable for later searches.
+
+	Search results and reference data are stored in the persistent
+	:class:`~GuiV2.GSMatch2_Core.search_cache.SearchCache`, if it is enabled,
+	and the engine is only initialised when something is not in the cache.
+	"""
+
+	def __init__(
+			self, lib_path=None, lib_type=pyms_nist_search.NISTMS_MAIN_LIB,
+			work_dir=None, debug=False, max_retries=1, use_cache=True,
+			):
+		"""
+		:param lib_path: The path to the mass spectral library. Defaults to :data:`Base.FULL_PATH_TO_MAIN_LIBRARY`
+		:type lib_path: str or pathlib.Path, optional
+		:param lib_type: The type of library. One of ``NISTMS_MAIN_LIB``, ``NISTMS_USER_LIB``, ``NISTMS_REP_LIB``
+		:type lib_type: int, optional
+		:param work_dir: The path to the working directory. Defaults to :data:`Base.FULL_PATH_TO_WORK_DIR`
+		:type work_dir: str or pathlib.Path, optional
+		:param debug: Whether to enable debug mode for the search engine
+		:type debug: bool, optional
+		:param max_retries: The number of times to restart the engine and retry a failed search
+		:type max_retries: int, optional
+		:param use_cache: Whether to use the persistent cache of search results
+		:type use_cache: bool, optional
+		"""
+
+		if lib_path is None:
+			lib_path = Base.FULL_PATH_TO_MAIN_LIBRARY
+		if work_dir is None:
+			work_dir = Base.FULL_PATH_TO_WORK_DIR
+
+		self.lib_path = lib_path
+		self.lib_type = lib_type
+		self.work_dir = work_dir
+		self.debug = debug
+		self.max_retries = max(0, int(max_retries))
+
+		if use_cache:
+			self.cache = get_search_cache()
+		else:
+			self.cache = None
+
+		self._engine = None
+		self._lock = threading.RLock()
+		self._atexit_registered = False
+
+	def __getstate__(self):
+		# The engine cannot be sent to another process; it will be initialised again there
+		state = self.__dict__.copy()
+		state["_engine"] = None
+		state["_lock"] = None
+		state["_atexit_registered"] = False
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.RLock()
+
+	@property
+	def library_id(self):
+		"""
+		Returns a string identifying the library being searched, for the search result cache
+
+		:rtype: str
+		"""
+
+		return f"{pathlib.Path(self.lib_path).absolute().as_posix()}:{self.lib_type}"
+
+	@property
+	def is_initialised(self):
+		"""
+		Returns whether the search engine is currently initialised
+
+		:rtype: bool
+		"""
+
+		return self._engine is not None
+
+	def init(self):
+		"""
+		Initialise the search engine, if it is not already initialised
+		"""
+
+		with self._lock:
+			if self._engine is None:
+				print("Initialising NIST MS Search engine")
+
+				self._engine = pyms_nist_search.Engine(
+						self.lib_path,
+						self.lib_type,
+						self.work_dir,
+						debug=self.debug,
+						)
+
+				if not self._atexit_registered:
+					atexit.register(self.uninit)
+					self._atexit_registered = True
+
+	def uninit(self):
+		"""
+		Uninitialise the search engine, if it is initialised
+		"""
+
+		with self._lock:
+			if self._engine is not None:
+				engine = self._engine
+				self._engine = None
+
+				try:
+					engine.uninit()
+				except Exception:
+					traceback.print_exc()
+
+	def restart(self):
+		"""
+		Uninitialise and then initialise the search engine
+		"""
+
+		with self._lock:
+			self.uninit()
+			self.init()
+
+	def __enter__(self):
+		self.init()
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.uninit()
+
+	def _call(self, method_name, *args, **kwargs):
+		"""
+		Call the given method of the search engine, restarting the engine and retrying on failure
+
+		:param method_name:
+		:type method_name: str
+		"""
+
+		with self._lock:
+			for attempt in range(self.max_retries + 1):
+				try:
+					self.init()
+					return getattr(self._engine, method_name)(*args, **kwargs)
+				except Exception as e:
+					print(f"NIST MS Search '{method_name}' failed: {type(e).__name__}: {e}")
+
+					if attempt < self.max_retries:
+						print("Restarting NIST MS Search engine")
+
+					# The engine may be left in an unknown state, so start again
+					self.uninit()
+
+					if attempt >= self.max_retries:
+						raise SearchError(f"NIST MS Search '{method_name}' failed: {e}") from e
+
+	def full_spectrum_search(self, mass_spec, n_hits=5):
+		"""
+		Perform a Full Spectrum Search of the mass spectral library
+
+		:param mass_spec: The mass spectrum to search against the library
+		:type mass_spec: pyms.Spectrum.MassSpectrum
+		:param n_hits: The number of hits to return
+		:type n_hits: int, optional
+
+		:return: List of possible identities for the mass spectrum
+		:rtype: list of pyms_nist_search.SearchResult
+		"""
+
+		if self.cache is None:
+			return self._call("full_spectrum_search", mass_spec, n_hits)
+
+		fingerprint = spectrum_fingerprint(mass_spec)
+
+		hit_list = self.cache.get_search_results(fingerprint, self.library_id, n_hits)
+		if hit_list is None:
+			hit_list = self._call("full_spectrum_search", mass_spec, n_hits)
+			self.cache.put_search_results(fingerprint, self.library_id, n_hits, hit_list)
+
+		return hit_list
+
+	def batch_spectrum_search(
+			self, mass_specs, n_hits=5, chunk_size=DEFAULT_CHUNK_SIZE,
+			progress_callback=None, results=None,
+			):
+		"""
+		Perform a Full Spectrum Search of the mass spectral library for each of the given mass spectra.
+
+		Near-identical spectra (see :func:`spectrum_fingerprint`) are only searched once.
+		The unique spectra are searched in chunks, with the search engine locked for the whole of each chunk.
+
+		If the search for a spectrum fails, even after restarting the engine,
+		an empty list is returned for that spectrum rather than abandoning the whole batch.
+
+		:param mass_specs: The mass spectra to search against the library
+		:type mass_specs: list of pyms.Spectrum.MassSpectrum
+		:param n_hits: The number of hits to return for each spectrum
+		:type n_hits: int, optional
+		:param chunk_size: The number of unique spectra to search while holding the lock
+		:type chunk_size: int, optional
+		:param progress_callback: Function called after each chunk with the number of unique spectra
+			searched so far and the total number of unique spectra
+		:type progress_callback: function, optional
+		:param results: Mapping of spectrum fingerprints to the results of earlier searches.
+			Spectra already in the mapping aren't searched again, and the new results are added to it,
+			so the same mapping can be passed to several calls to share the searches between them.
+		:type results: dict, optional
+
+		:return: List of possible identities for each mass spectrum, in the same order as ``mass_specs``
+		:rtype: list of lists of pyms_nist_search.SearchResult
+		"""
+
+		# Map each spectrum to the first spectrum with the same fingerprint
+		unique_specs = {}
+		fingerprints = []
+
+		if results is None:
+			results = {}
+
+		for mass_spec in mass_specs:
+			fingerprint = spectrum_fingerprint(mass_spec)
+			fingerprints.append(fingerprint)
+			if fingerprint not in results:
+				unique_specs.setdefault(fingerprint, mass_spec)
+
+		unique_items = list(unique_specs.items())
+		chunk_size = max(1, int(chunk_size))
+
+		for chunk_start in range(0, len(unique_items), chunk_size):
+			with self._lock:
+				for fingerprint, mass_spec in unique_items[chunk_start:chunk_start + chunk_size]:
+					try:
+						results[fingerprint] = self.full_spectrum_search(mass_spec, n_hits)
+					except SearchError:
+						# Don't let one bad search stop the identification of the other spectra
+						traceback.print_exc()
+						results[fingerprint] = []
+
+			if progress_callback is not None:
+				progress_callback(min(chunk_start + chunk_size, len(unique_items)), len(unique_items))
+
+		# Each spectrum gets its own list, as the hits are stored separately for each peak
+		return [list(results[fingerprint]) for fingerprint in fingerprints]
+
+	def get_reference_data(self, spec_loc):
+		"""
+		Get reference data from the library for the compound at the given location
+
+		:param spec_loc:
+		:type spec_loc: int
+
+		:rtype: pyms_nist_search.ReferenceData
+		"""
+
+		if self.cache is None:
+			return self._call("get_reference_data", spec_loc)
+
+		reference_data = self.cache.get_reference_data(spec_loc, self.library_id)
+		if reference_data is None:
+			reference_data = self._call("get_reference_data", spec_loc)
+			self.cache.put_reference_data(spec_loc, self.library_id, reference_data)
+
+		return reference_data
+
+	def get_reference_data_bulk(self, spec_locs):
+		"""
+		Get reference data from the library for the compounds at each of the given locations.
+
+		Reference data already in the cache is read with a single query,
+		and the remaining locations are read from the library with the search engine locked throughout.
+		If the reference data for a location can't be read, even after restarting the engine,
+		``None`` is returned for that location.
+
+		:param spec_locs:
+		:type spec_locs: iterable of int
+
+		:return: Mapping of locations to reference data
+		:rtype: dict
+		"""
+
+		spec_locs = sorted(set(spec_locs))
+
+		if self.cache is None:
+			reference_data = {}
+		else:
+			reference_data = self.cache.get_many_reference_data(spec_locs, self.library_id)
+
+		new_reference_data = {}
+
+		with self._lock:
+			for spec_loc in spec_locs:
+				if spec_loc in reference_data:
+					continue
+
+				try:
+					new_reference_data[spec_loc] = self._call("get_reference_data", spec_loc)
+				except SearchError:
+					traceback.print_exc()
+					reference_data[spec_loc] = None
+
+		if self.cache is not None and new_reference_data:
+			self.cache.put_many_reference_data(new_reference_data, self.library_id)
+
+		reference_data.update(new_reference_data)
+
+		return reference_data
+
+
+if __name__ == "__main__":
+	# Benchmark the batch search against searching for each peak in turn,
+	# using the identified peaks from a Project file given on the command line.
+	# The persistent cache is disabled, as otherwise the second pass would only time cache hits
+	# stdlib
+	import sys
+	import time
+
+	# this package
+	from GuiV2.GSMatch2_Core.Project import Project
+
+	project = Project.load(sys.argv[1])
+
+	mass_specs = []
+	for experiment in project.experiment_objects:
+		if experiment.identification_performed:
+			mass_specs.extend(peak.mass_spectrum for peak in experiment.ident_peaks)
+
+	print(f"{len(mass_specs)} spectra, {len(set(map(spectrum_fingerprint, mass_specs)))} unique")
+
+	with SearchEngine(use_cache=False) as search:
+		# Warm up the engine so that loading the library isn't counted
+		search.full_spectrum_search(mass_specs[0], 10)
+
+		start = time.perf_counter()
+		for mass_spec in mass_specs:
+			search.full_spectrum_search(mass_spec, 10)
+		loop_time = time.perf_counter() - start
+
+		start = time.perf_counter()
+		search.batch_spectrum_search(mass_specs, 10)
+		batch_time = time.perf_counter() - start
+
+	print(f"Per-peak loop: {len(mass_specs) / loop_time:0.1f} spectra/s")
+	print(f"Batch search:  {len(mass_specs) / batch_time:0.1f} spectra/s")
@@ -0,0 +1,182 @@
+#  !/usr/bin/env python
+#   -*- coding: utf-8 -*-
+#
+#  parallel.py
+#
+#  This file is part of GunShotMatch
+#
+#  Copyright © 2020 Dominic Davis-Foster <dominic@davis-foster.co.uk>
+#
+#  GunShotMatch is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  GunShotMatch is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  A process pool shared by everything in GunShotMatch that processes data in parallel.
+#
+#  The pool has at most one process per CPU, or fewer if the ``n_workers`` setting
+#  in the internal configuration is lower, and is created when it is first needed
+#  and then reused. Inputs with fewer items than the ``parallel_threshold`` setting
+#  are processed in the calling process, as starting the pool would take longer.
+#
+#  The pool is terminated when the process that created it exits.
+#
+
+# stdlib
+import math
+import multiprocessing
+import os
+import threading
+
+# this package
+from GuiV2.GSMatch2_Core.Config import internal_config
+
+
+# The number of chunks per worker that the items are divided into by default,
+# to balance the load while keeping the overhead of sending each chunk low
+CHUNKS_PER_WORKER = 4
+
+_pool = None
+_pool_size = 0
+_pool_pid = None
+_lock = threading.Lock()
+
+
+def get_n_workers(n_items=None):
+	"""
+	Returns the number of worker processes to use
+
+	:param n_items: The number of items to process. If given, no more workers than items are used.
+	:type n_items: int, optional
+
+	:rtype: int
+	"""
+
+	n_cpus = os.cpu_count() or 1
+	n_workers = min(internal_config.n_workers or n_cpus, n_cpus)
+
+	if n_items is not None:
+		n_workers = min(n_workers, n_items)
+
+	return max(1, n_workers)
+
+
+def get_pool():
+	"""
+	Returns the shared process pool, creating it if necessary
+
+	:rtype: multiprocessing.pool.Pool
+	"""
+
+	global _pool, _pool_size, _pool_pid
+
+	n_workers = get_n_workers()
+
+	with _lock:
+		# A pool can't be used from a forked child of the process that created it
+		if _pool is not None and (_pool_size != n_workers or _pool_pid != os.getpid()):
+			if _pool_pid == os.getpid():
+				_pool.terminate()
+			_pool = None
+
+		if _pool is None:
+			_pool = multiprocessing.Pool(n_workers)
+			_pool_size = n_workers
+			_pool_pid = os.getpid()
+
+		return _pool
+
+
+def shutdown_pool():
+	"""
+	Terminate the shared process pool, if it has been created
+	"""
+
+	global _pool
+
+	with _lock:
+		if _pool is not None and _pool_pid == os.getpid():
+			_pool.terminate()
+			_pool.join()
+		_pool = None
+
+
+def _run_sequentially(n_items, min_items):
+	if min_items is None:
+		min_items = internal_config.parallel_threshold
+
+	return (
+			n_items < max(2, min_items)
+			or get_n_workers(n_items) == 1
+			# Worker processes can't start processes of their own
+			or multiprocessing.current_process().daemon
+			)
+
+
+def imap(function, iterable, chunksize=None, ordered=True, min_items=None):
+	"""
+	Apply ``function`` to each item in ``iterable``, using the shared process pool.
+
+	:param function: The function to apply. It must be picklable, e.g. defined at the top level of a module.
+	:type function: function
+	:param iterable: The items to process
+	:type iterable: iterable
+	:param chunksize: The number of items sent to a worker at a time.
+		Defaults to dividing the items into :data:`CHUNKS_PER_WORKER` chunks per worker.
+	:type chunksize: int, optional
+	:param ordered: Whether the results must be in the same order as the items. Default True
+	:type ordered: bool, optional
+	:param min_items: If there are fewer items than this they are processed in the calling process.
+		Defaults to the ``parallel_threshold`` setting.
+	:type min_items: int, optional
+
+	:return: The result for each item, as it becomes available
+	:rtype: iterator
+	"""
+
+	items = list(iterable)
+
+	if _run_sequentially(len(items), min_items):
+		return (function(item) for item in items)
+
+	if chunksize is None:
+		chunksize = math.ceil(len(items) / (get_n_workers(len(items)) * CHUNKS_PER_WORKER))
+
+	pool = get_pool()
+
+	if ordered:
+		return pool.imap(function, items, max(1, chunksize))
+	else:
+		return pool.imap_unordered(function, items, max(1, chunksize))
+
+
+def map(function, iterable, chunksize=None, min_items=None):  # pylint: disable=redefined-builtin
+	"""
+	Apply ``function`` to each item in ``iterable``, using the shared process pool,
+	and return the results once they are all available.
+
+	:param function: The function to apply. It must be picklable, e.g. defined at the top level of a module.
+	:type function: function
+	:param iterable: The items to process
+	:type iterable: iterable
+	:param chunksize: The number of items sent to a worker at a time
+	:type chunksize: int, optional
+	:param min_items: If there are fewer items than this they are processed in the calling process.
+		Defaults to the ``parallel_threshold`` setting.
+	:type min_items: int, optional
+
+	:return: The result for each item, in the same order as the items
+	:rtype: list
+	"""
+
+	return list(imap(function, iterable, chunksize=chunksize, min_items=min_items))
@@ -0,0 +1,417 @@
+#  !/usr/bin/env python
+#   -*- coding: utf-8 -*-
+#
+#  search_cache.py
+#
+#  This file is part of GunShotMatch
+#
+#  Copyright © 2020 Dominic Davis-Foster <dominic@davis-foster.co.uk>
+#
+#  GunShotMatch is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  GunShotMatch is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Persistent cache of NIST MS Search results.
+#
+#  The results are stored in an SQLite database in the configuration directory:
+#
+#  * ``search_results``: The pickled hits from a Full Spectrum Search, keyed by
+#    the fingerprint of the mass spectrum, the library and the number of hits
+#  * ``reference_data``: The pickled reference data for a library entry, keyed
+#    by the library and the location of the spectrum in the library
+#
+#  Entries are evicted in least recently used order once the total size
+#  of the cached data exceeds the limit set in the internal configuration.
+#
+
+# stdlib
+import collections
+import pickle
+import sqlite3
+import threading
+import time
+
+# this package
+from GuiV2.GSMatch2_Core.Config import internal_config
+
+
+# Increment when the format of the cached data changes, to invalidate existing entries
+CACHE_VERSION = 1
+
+# The proportion of the maximum size to evict down to, so that eviction doesn't happen on every addition
+EVICT_TO = 0.9
+
+
+class SearchCache:
+	"""
+	Persistent cache of NIST MS Search results and reference data.
+
+	The numbers of hits and misses since the cache was opened are counted in :attr:`stats`.
+	"""
+
+	def __init__(self, filename, max_size):
+		"""
+		:param filename: The filename of the database
+		:type filename: str or pathlib.Path
+		:param max_size: The maximum total size of the cached data, in bytes
+		:type max_size: int
+		"""
+
+		self.filename = str(filename)
+		self.max_size = int(max_size)
+
+		self.stats = collections.Counter()
+
+		self._connection = None
+		self._total_size = None
+		self._lock = threading.RLock()
+
+	def __getstate__(self):
+		# The connection cannot be sent to another process; it will be opened again there
+		state = self.__dict__.copy()
+		state["_connection"] = None
+		state["_total_size"] = None
+		state["_lock"] = None
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.RLock()
+
+	@property
+	def connection(self):
+		"""
+		Returns the connection to the database, opening it and creating the tables if necessary
+
+		:rtype: sqlite3.Connection
+		"""
+
+		with self._lock:
+			if self._connection is None:
+				connection = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+
+				# Allow other processes to read while results are being added
+				connection.execute("PRAGMA journal_mode=WAL")
+				# Losing the most recent additions in a power cut doesn't matter for a cache
+				connection.execute("PRAGMA synchronous=NORMAL")
+
+				version = connection.execute("PRAGMA user_version").fetchone()[0]
+				if version != CACHE_VERSION:
+					connection.execute("DROP TABLE IF EXISTS search_results")
+					connection.execute("DROP TABLE IF EXISTS reference_data")
+					connection.execute(f"PRAGMA user_version={CACHE_VERSION:d}")
+
+				connection.execute("""
+					CREATE TABLE IF NOT EXISTS search_results (
+						fingerprint TEXT NOT NULL,
+						library TEXT NOT NULL,
+						n_hits INTEGER NOT NULL,
+						data BLOB NOT NULL,
+						size INTEGER NOT NULL,
+						last_used REAL NOT NULL,
+						PRIMARY KEY (fingerprint, library, n_hits)
+					)""")
+				connection.execute("""
+					CREATE TABLE IF NOT EXISTS reference_data (
+						spec_loc INTEGER NOT NULL,
+						library TEXT NOT NULL,
+						data BLOB NOT NULL,
+						size INTEGER NOT NULL,
+						last_used REAL NOT NULL,
+						PRIMARY KEY (spec_loc, library)
+					)""")
+				connection.execute(
+						"CREATE INDEX IF NOT EXISTS search_results_last_used ON search_results (last_used)")
+				connection.execute(
+						"CREATE INDEX IF NOT EXISTS reference_data_last_used ON reference_data (last_used)")
+				connection.commit()
+
+				self._connection = connection
+
+			return self._connection
+
+	def close(self):
+		"""
+		Close the connection to the database
+		"""
+
+		with self._lock:
+			if self._connection is not None:
+				self._connection.close()
+				self._connection = None
+				self._total_size = None
+
+	def get_search_results(self, fingerprint, library, n_hits):
+		"""
+		Returns the cached hits for a Full Spectrum Search, or ``None`` if they are not in the cache.
+
+		Results from a search for more hits are also used.
+
+		:param fingerprint: The fingerprint of the mass spectrum
+		:type fingerprint: str
+		:param library: The identity of the library that was searched
+		:type library: str
+		:param n_hits: The number of hits
+		:type n_hits: int
+
+		:rtype: list of pyms_nist_search.SearchResult or None
+		"""
+
+		with self._lock:
+			row = self.connection.execute(
+					"""
+					SELECT rowid, data FROM search_results
+					WHERE fingerprint = ? AND library = ? AND n_hits >= ?
+					ORDER BY n_hits LIMIT 1
+					""",
+					(fingerprint, library, int(n_hits)),
+					).fetchone()
+
+			if row is None:
+				self.stats["search_misses"] += 1
+				return None
+
+			self._touch("search_results", row[0])
+			self.stats["search_hits"] += 1
+
+		return pickle.loads(row[1])[:n_hits]
+
+	def put_search_results(self, fingerprint, library, n_hits, hits):
+		"""
+		Add the hits from a Full Spectrum Search to the cache
+
+		:param fingerprint: The fingerprint of the mass spectrum
+		:type fingerprint: str
+		:param library: The identity of the library that was searched
+		:type library: str
+		:param n_hits: The number of hits
+		:type n_hits: int
+		:param hits:
+		:type hits: list of pyms_nist_search.SearchResult
+		"""
+
+		data = pickle.dumps(list(hits))
+
+		self._put(
+				"INSERT OR REPLACE INTO search_results VALUES (?, ?, ?, ?, ?, ?)",
+				(fingerprint, library, int(n_hits), data, len(data), time.time()),
+				)
+
+	def get_reference_data(self, spec_loc, library):
+		"""
+		Returns the cached reference data for the library entry, or ``None`` if it is not in the cache.
+
+		:param spec_loc: The location of the spectrum in the library
+		:type spec_loc: int
+		:param library: The identity of the library
+		:type library: str
+
+		:rtype: pyms_nist_search.ReferenceData or None
+		"""
+
+		with self._lock:
+			row = self.connection.execute(
+					"SELECT rowid, data FROM reference_data WHERE spec_loc = ? AND library = ?",
+					(int(spec_loc), library),
+					).fetchone()
+
+			if row is None:
+				self.stats["reference_misses"] += 1
+				return None
+
+			self._touch("reference_data", row[0])
+			self.stats["reference_hits"] += 1
+
+		return pickle.loads(row[1])
+
+	def put_reference_data(self, spec_loc, library, reference_data):
+		"""
+		Add the reference data for a library entry to the cache
+
+		:param spec_loc: The location of the spectrum in the library
+		:type spec_loc: int
+		:param library: The identity of the library
+		:type library: str
+		:param reference_data:
+		:type reference_data: pyms_nist_search.ReferenceData
+		"""
+
+		data = pickle.dumps(reference_data)
+
+		self._put(
+				"INSERT OR REPLACE INTO reference_data VALUES (?, ?, ?, ?, ?)",
+				(int(spec_loc), library, data, len(data), time.time()),
+				)
+
+	def get_many_reference_data(self, spec_locs, library):
+		"""
+		Returns the cached reference data for each of the given library entries that is in the cache.
+
+		:param spec_locs: The locations of the spectra in the library
+		:type spec_locs: iterable of int
+		:param library: The identity of the library
+		:type library: str
+
+		:return: Mapping of locations to reference data
+		:rtype: dict
+		"""
+
+		spec_locs = [int(spec_loc) for spec_loc in spec_locs]
+		reference_data = {}
+
+		with self._lock:
+			connection = self.connection
+
+			# Stay below SQLite's limit on the number of parameters
+			for chunk_start in range(0, len(spec_locs), 500):
+				chunk = spec_locs[chunk_start:chunk_start + 500]
+				placeholders = ", ".join("?" * len(chunk))
+				rows = connection.execute(
+						f"SELECT rowid, spec_loc, data FROM reference_data "
+						f"WHERE library = ? AND spec_loc IN ({placeholders})",
+						(library, *chunk),
+						).fetchall()
+
+				for rowid, spec_loc, data in rows:
+					reference_data[spec_loc] = pickle.loads(data)
+
+				connection.executemany(
+						"UPDATE reference_data SET last_used = ? WHERE rowid = ?",
+						[(time.time(), row[0]) for row in rows],
+						)
+
+			connection.commit()
+
+			self.stats["reference_hits"] += len(reference_data)
+			self.stats["reference_misses"] += len(spec_locs) - len(reference_data)
+
+		return reference_data
+
+	def put_many_reference_data(self, reference_data, library):
+		"""
+		Add the reference data for several library entries to the cache
+
+		:param reference_data: Mapping of locations in the library to reference data
+		:type reference_data: dict
+		:param library: The identity of the library
+		:type library: str
+		"""
+
+		rows = []
+		for spec_loc, data in reference_data.items():
+			data = pickle.dumps(data)
+			rows.append((int(spec_loc), library, data, len(data), time.time()))
+
+		with self._lock:
+			self.connection.executemany("INSERT OR REPLACE INTO reference_data VALUES (?, ?, ?, ?, ?)", rows)
+			self.connection.commit()
+			self._added(sum(row[3] for row in rows))
+
+	def _touch(self, table, rowid):
+		# Record the access for least recently used eviction
+		self.connection.execute(f"UPDATE {table} SET last_used = ? WHERE rowid = ?", (time.time(), rowid))
+		self.connection.commit()
+
+	def _put(self, sql, parameters):
+		with self._lock:
+			connection = self.connection
+			connection.execute(sql, parameters)
+			connection.commit()
+			self._added(parameters[-2])
+
+	def _added(self, size):
+		# Update the running total size after adding entries, and evict entries if it is too large
+		if self._total_size is None:
+			self._total_size = self.total_size
+		else:
+			# The size of any replaced entry is not subtracted, so this can only overestimate
+			self._total_size += size
+
+		if self._total_size > self.max_size:
+			self.evict()
+
+	@property
+	def total_size(self):
+		"""
+		Returns the total size of the cached data, in bytes
+
+		:rtype: int
+		"""
+
+		with self._lock:
+			return sum(
+					self.connection.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()[0]
+					for table in ("search_results", "reference_data")
+					)
+
+	def evict(self):
+		"""
+		Remove the least recently used entries until the cached data is smaller than the maximum size
+		"""
+
+		with self._lock:
+			connection = self.connection
+			total_size = self.total_size
+			target_size = self.max_size * EVICT_TO
+
+			entries = connection.execute(
+					"""
+					SELECT 'search_results', rowid, size, last_used FROM search_results
+					UNION ALL
+					SELECT 'reference_data', rowid, size, last_used FROM reference_data
+					ORDER BY last_used
+					""",
+					).fetchall()
+
+			for table, rowid, size, _ in entries:
+				if total_size <= target_size:
+					break
+
+				connection.execute(f"DELETE FROM {table} WHERE rowid = ?", (rowid,))
+				total_size -= size
+
+			connection.commit()
+			self._total_size = total_size
+
+	def clear(self):
+		"""
+		Remove all entries from the cache
+		"""
+
+		with self._lock:
+			self.connection.execute("DELETE FROM search_results")
+			self.connection.execute("DELETE FROM reference_data")
+			self.connection.commit()
+			self.connection.execute("VACUUM")
+			self._total_size = 0
+
+	def __str__(self):
+		return (
+				f"Search results: {self.stats['search_hits']} hits, {self.stats['search_misses']} misses. "
+				f"Reference data: {self.stats['reference_hits']} hits, {self.stats['reference_misses']} misses."
+				)
+
+
+def get_search_cache():
+	"""
+	Returns the NIST MS Search result cache, using the settings from the internal configuration,
+	or ``None`` if the cache is disabled.
+
+	:rtype: SearchCache or None
+	"""
+
+	if not internal_config.search_cache_size:
+		return None
+
+	return SearchCache(internal_config.search_cache_file, internal_config.search_cache_size * 1024 * 1024)
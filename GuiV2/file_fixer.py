@@ -46,6 +46,7 @@ sys.path.append("..")
 
 # this package
 from GuiV2.GSMatch2_Core import watchdog
+from GuiV2.GSMatch2_Core.io import compact_archive
 from GuiV2.GSMatch2_Core.Project.consolidate import (
 	ConsolidateEncoder,
 	)
@@ -83,6 +84,13 @@ parser.add_argument(
 		help="Remove Consolidate data from the Project file.",
 		)
 
+parser.add_argument(
+		"--compact",
+		action='store_true',
+		dest="compact",
+		help="Rewrite the Project file, discarding old copies of files that have since been replaced or removed.",
+		)
+
 parser.add_argument(
 		"project",
 		help="The Project file to fix.",
@@ -94,12 +102,13 @@ if not any([
 		args.remove_alignment,
 		# args.remove_identify,
 		args.remove_consolidate,
+		args.compact,
 		]):
 	parser.error(
 			'No action requested. Please specify at least one of '
-			'--remove-alignment '
+			'--remove-alignment, '
 			# '--remove-identify '
-			'or --remove-consolidate'
+			'--remove-consolidate or --compact'
 			)
 
 
@@ -107,6 +116,11 @@ if not any([
 if pathlib.Path(args.project).suffix != ".proj":
 	parser.error("'project' must be a Project file (*.proj)")
 
+# Discard files that have been replaced or removed, so they are not extracted below
+compact_archive(args.project)
+
+if not any([args.remove_alignment, args.remove_consolidate]):
+	sys.exit(0)
 		
 # Set date modified value
 date_modified = datetime.datetime.now().timestamp()
@@ -124,7 +138,7 @@ with tempfile.TemporaryDirectory() as tempdir:
 	if not (tempdir_p / "changes").is_dir():
 		(tempdir_p / "changes").mkdir()
 	
-	timestamp_dir = tempdir_p / "changes" / datetime.datetime.fromtimestamp(date_modified).strftime("%Y%m%d %H%M%S")
+	timestamp_dir = tempdir_p / "changes" / datetime.datetime.fromtimestamp(date_modified).strftime("%Y%m%d %H%M%S %f")
 	
 	timestamp_dir.mkdir()
 	
@@ -152,7 +166,8 @@ with tempfile.TemporaryDirectory() as tempdir:
 		# Move the alignment files to the timestamp_dir
 		for fname in {
 				"alignment_area.csv", "alignment_rt.csv",
-				"alignment_ms.json", "alignment_rt.json", "alignment_area.json"
+				"alignment_ms.json", "alignment_rt.json", "alignment_area.json",
+				"alignment_peak_index.json",
 				}:
 			try:
 				shutil.move(tempdir_p / fname, timestamp_dir / fname)
@@ -162,6 +177,7 @@ with tempfile.TemporaryDirectory() as tempdir:
 		# Update the project info
 		info["alignment_performed"] = False
 		info["alignment_audit_record"] = None
+		info["alignment_history"] = []
 	
 	if args.remove_consolidate:
 		# Move the consolidate files to the timestamp_dir